@@ -0,0 +1,65 @@
+import hmac
+import logging
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Form, Header, HTTPException
+
+from app.services.executor import QueueFullError
+from app.services.model_registry import get_model_registry
+from app.services.model_service import get_model_service
+from app.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Allow the request only with the configured ADMIN_TOKEN"""
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin API is disabled, set ADMIN_TOKEN to enable it")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, settings.ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+
+# Create admin router
+admin_router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@admin_router.get("/models")
+async def list_models():
+    """Active model and every registered version, with usage and feedback per version"""
+    active = get_model_service().active_model
+    return {
+        "active": active.describe() if active is not None else None,
+        "versions": await get_model_registry().versions()
+    }
+
+
+@admin_router.post("/models")
+async def deploy_model(
+    path: str = Form(...),
+    activate: bool = Form(True)
+):
+    """Load a checkpoint, warm it up and, if activate, switch every worker to it"""
+    try:
+        return {"success": True, "model": await get_model_registry().deploy(path, activate)}
+    except QueueFullError:
+        raise HTTPException(status_code=409, detail="Another model is being loaded")
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error deploying model {path}: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Error loading model: {str(e)}")
+
+
+@admin_router.post("/models/{version}/activate")
+async def activate_model(version: str):
+    """Switch back (or forward) to a registered version"""
+    try:
+        return {"success": True, "model": await get_model_registry().activate(version)}
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Model version {version} is not registered")
+    except QueueFullError:
+        raise HTTPException(status_code=409, detail="Another model is being loaded")
+    except Exception as e:
+        logger.error(f"Error activating model {version}: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Error activating model: {str(e)}")
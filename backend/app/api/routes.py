@@ -1,25 +1,93 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Query
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, UploadFile, File, Form, Query, Request, Response
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import desc
+from sqlalchemy import desc, func, tuple_
+import asyncio
+import base64
+import csv
+import datetime
+import io
+import json
 import uuid
 import os
+import re
 import logging
 import time
+import weakref
+import zlib
 from typing import List, Optional
-import shutil
 from pathlib import Path
 
-from app.models.database import Prediction, Feedback, get_db
+from app.models.database import Feedback, Prediction, async_session, get_db, get_write_queue
 from app.services.model_service import get_model_service
+from app.services.batch_scheduler import get_inference_scheduler
+from app.services.embedding_index import get_embedding_store
+from app.services.executor import QueueFullError, get_io_executor
+from app.services.explanation import render_overlay
+from app.services.image_store import content_hash, get_image_store
+from app.services.metrics import CACHE_LOOKUPS, PREDICTIONS, observe_stage
+from app.services.prediction_cache import PredictionCache, get_prediction_cache
+from app.services.quality_stats import read_stats
+from app.services.rate_limit import client_key, session_id
+from app.services.preprocessing import TTA_VIEWS
 from app.utils.config import settings
+from app.utils.file_utils import (
+    InvalidUploadError,
+    check_image_header,
+    count_archive_images,
+    iter_archive_images,
+    is_archive,
+    is_valid_file_extension,
+    sniff_image_type,
+)
+from app.api.upload import read_upload
 
 logger = logging.getLogger(__name__)
 
 # Create API router
 api_router = APIRouter()
 
+# Lowercase hex SHA-256, the key of a stored image
+IMAGE_HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+MODEL_VERSION_PATTERN = re.compile(r"[0-9A-Za-z_-]{1,64}")
+
+def _store_upload(background_tasks: BackgroundTasks, data, image_hash: str) -> dict:
+    """Reference the upload in the image store and return its Prediction columns.
+    
+    The original and its thumbnail are written after the response is sent,
+    and only if this content has not been stored before.
+    """
+    if not settings.SAVE_UPLOADS:
+        return {"filename": None, "image_hash": None}
+    
+    image_store = get_image_store()
+    extension = "png" if sniff_image_type(data) == "png" else "jpg"
+    get_write_queue().add_image_reference(image_hash, extension, len(data))
+    background_tasks.add_task(image_store.store_upload, data, image_hash, extension)
+    return {"filename": image_store.object_path(image_hash, extension), "image_hash": image_hash}
+
+def _image_urls(filename: Optional[str], image_hash: Optional[str]) -> dict:
+    """URLs of a prediction's image and thumbnail"""
+    if image_hash:
+        return {
+            "image_url": f"/api/images/{image_hash}",
+            "thumbnail_url": f"/api/images/{image_hash}/thumbnail" if settings.THUMBNAIL_SIZE > 0 else None
+        }
+    # Uploads from before the image store
+    return {"image_url": f"/uploads/{filename}" if filename else None, "thumbnail_url": None}
+
+def _rejected_upload(error: InvalidUploadError) -> HTTPException:
+    return HTTPException(status_code=error.status_code, detail=str(error))
+
+def _service_unavailable(error: QueueFullError) -> HTTPException:
+    """Build a 503 response telling the client when to retry"""
+    return HTTPException(
+        status_code=503,
+        detail=f"Server is busy, please retry later: {str(error)}",
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
 # Health check endpoint
 @api_router.get("/health")
 async def health_check():
@@ -28,16 +96,178 @@ async def health_check():
     return {
         "status": "ok",
         "model_loaded": model_service.is_model_loaded(),
+        "model_version": model_service.model_version,
+        "inference_backend": model_service.backend_info["name"],
+        "model_load": model_service.load_report,
         "timestamp": time.time()
     }
 
+def _explanation_url(image_hash: str, model_version: str) -> str:
+    return f"/api/images/{image_hash}/explanation/{model_version}"
+
+def _prediction_mode(tta: Optional[int], ensemble: bool) -> int:
+    """Number of TTA views for a request; rejects requests no loaded model can serve"""
+    if not get_model_service().is_model_loaded():
+        raise HTTPException(status_code=503, detail="Model is not loaded")
+    if ensemble and get_model_service().ensemble_size == 1:
+        raise HTTPException(status_code=400, detail="Ensemble mode is not available: ENSEMBLE_MODEL_PATHS is empty")
+    views = tta if tta is not None else settings.TTA_DEFAULT_VIEWS
+    return max(1, min(views, len(TTA_VIEWS)))
+
+async def _run_prediction(data: bytes, start_time: float, views: int = 1, ensemble: bool = False,
+                          explain: bool = False, client: str = "") -> dict:
+    """Predict one encoded image, using the prediction cache when enabled.
+    
+    start_time is the time.perf_counter() reading the request started at.
+    With views > 1 and/or ensemble, every view (and ensemble model) is
+    scored in the same batched forward pass and the prediction is their
+    mean, with the variance reported as uncertainty. explain adds a
+    Grad-CAM overlay computed in that same forward pass and stored by
+    content hash, so explaining the same scan again is a cache hit.
+    client is the rate_limit.client_key the forward pass is scheduled for.
+    """
+    model_service = get_model_service()
+    io_executor = get_io_executor()
+    
+    # One content hash addresses both the prediction cache and the image store
+    image_hash = await io_executor.run(content_hash, data)
+    
+    # An explanation is only served from cache if its overlay was rendered before
+    # Cache hits are attributed to the version the cache key was built for
+    model_version = model_service.model_version
+    image_store = get_image_store()
+    explained = False
+    if explain:
+        explanation = image_store.explanation_path(image_hash, model_version)
+        explained = await io_executor.run(os.path.exists, image_store.absolute(explanation))
+    
+    # Look up repeated scans by content hash
+    cache = get_prediction_cache()
+    cache_key = None
+    if settings.CACHE_ENABLED:
+        lookup_start = time.perf_counter()
+        cache_key = PredictionCache.key_for_hash(image_hash, model_service.prediction_version(views, ensemble))
+        cached = await io_executor.run(cache.get, cache_key) if explained or not explain else None
+        observe_stage("cache_lookup", time.perf_counter() - lookup_start)
+        CACHE_LOOKUPS.inc("hit" if cached is not None else "miss")
+        if cached is not None:
+            prediction = model_service.format_prediction(
+                cached["probability"], time.perf_counter() - start_time, cached.get("uncertainty")
+            )
+            PREDICTIONS.inc(prediction["class"])
+            return {
+                "success": True,
+                "prediction": prediction,
+                "image_info": cached["image_info"],
+                "image_hash": image_hash,
+                "model_version": model_version,
+                "explanation_url": _explanation_url(image_hash, model_version) if explain else None,
+                # Not recomputed; /similar falls back to an earlier prediction of this image
+                "embedding": None,
+                "latency": {
+                    "cache_hit": True
+                }
+            }
+    
+    # Reject unreadable or oversized images from the header alone
+    check_image_header(data)
+    
+    # Decode and preprocess the image in memory, off the event loop
+    preprocessed = await io_executor.run(model_service.preprocess_image, memoryview(data))
+    preprocess_time = time.perf_counter() - start_time
+    observe_stage("decode", preprocessed["timings"]["decode"])
+    observe_stage("preprocess", preprocessed["timings"]["preprocess"])
+    
+    # Stack test-time augmentation views so they share one forward pass
+    tensor = preprocessed["tensor"]
+    augment_time = 0.0
+    if views > 1:
+        augment_start = time.perf_counter()
+        tensor = await io_executor.run(model_service.build_views, tensor, views)
+        augment_time = time.perf_counter() - augment_start
+        observe_stage("augment", augment_time)
+    
+    # Perform prediction as part of a dynamically sized batch
+    batch_result = await get_inference_scheduler().submit(tensor, ensemble=ensemble, explain=explain, flow=client)
+    scores = batch_result["scores"]
+    # A model swap may have happened since the cache lookup
+    model_version = batch_result["model_version"]
+    if cache_key is not None:
+        cache_key = PredictionCache.key_for_hash(
+            image_hash, model_service.prediction_version(views, ensemble, batch_result["cache_version"])
+        )
+    probability, variance = model_service.summarize_scores(scores)
+    uncertainty = None
+    if len(scores) > 1:
+        uncertainty = {"variance": variance, "views": views, "models": len(scores) // views}
+    
+    # Render the heatmap over the original image off the event loop
+    explain_time = 0.0
+    if explain:
+        explain_start = time.perf_counter()
+        overlay = await io_executor.run(render_overlay, data, batch_result["cam"])
+        await io_executor.run(image_store.put_explanation, image_hash, model_version, overlay)
+        explain_time = time.perf_counter() - explain_start
+        observe_stage("explain", explain_time)
+    
+    result = {
+        "success": True,
+        "prediction": model_service.format_prediction(
+            probability, time.perf_counter() - start_time, uncertainty
+        ),
+        "image_info": {
+            "original_size": preprocessed["original_size"],
+            "processed_size": preprocessed["processed_size"],
+            "file_size": preprocessed["file_size"]
+        },
+        "image_hash": image_hash,
+        "model_version": model_version,
+        "explanation_url": _explanation_url(image_hash, model_version) if explain else None,
+        "embedding": batch_result["embedding"],
+        "latency": {
+            "cache_hit": False,
+            "preprocess_time": preprocess_time,
+            "augment_time": augment_time,
+            "explain_time": explain_time,
+            "queue_time": batch_result["queue_time"],
+            "inference_time": batch_result["inference_time"],
+            "batch_size": batch_result["batch_size"]
+        }
+    }
+    
+    PREDICTIONS.inc(result["prediction"]["class"])
+    
+    if cache_key is not None:
+        await io_executor.run(cache.set, cache_key, {
+            "probability": probability,
+            "uncertainty": uncertainty,
+            "image_info": result["image_info"]
+        })
+    
+    return result
+
+def _index_embedding(model_version: str, prediction_id: int, embedding):
+    """Make a prediction searchable by /similar; a failure here never fails the prediction"""
+    if not settings.EMBEDDING_INDEX_ENABLED or embedding is None:
+        return
+    try:
+        get_embedding_store().add(model_version, prediction_id, embedding)
+    except Exception as e:
+        logger.error(f"Error storing embedding of prediction {prediction_id}: {str(e)}")
+
 # Prediction endpoint
 @api_router.post("/predict")
 async def predict_image(
+    request: Request,
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
-    db: AsyncSession = Depends(get_db)
+    tta: Optional[int] = Query(None, ge=1, le=len(TTA_VIEWS), description="Test-time augmentation views to average"),
+    ensemble: bool = Query(False, description="Also average the ENSEMBLE_MODEL_PATHS models"),
+    explain: bool = Query(False, description="Return a Grad-CAM heatmap overlay")
 ):
     """Process an uploaded image and return tumor prediction"""
+    views = _prediction_mode(tta, ensemble)
+    
     # Validate file extension
     file_ext = file.filename.split(".")[-1].lower()
     if file_ext not in settings.ALLOWED_EXTENSIONS:
@@ -46,98 +276,458 @@ async def predict_image(
             detail=f"File extension not allowed. Allowed extensions: {', '.join(settings.ALLOWED_EXTENSIONS)}"
         )
     
-    # Generate a unique filename
-    unique_filename = f"{uuid.uuid4()}.{file_ext}"
-    file_path = os.path.join(settings.UPLOAD_DIR, unique_filename)
-    
     try:
-        # Save the file
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        start_time = time.perf_counter()
         
-        # Get model service
-        model_service = get_model_service()
+        # Read the upload once in chunks, stopping early at MAX_FILE_SIZE
+        # or when it does not start like an image
+        data = await read_upload(file)
+        observe_stage("upload_read", time.perf_counter() - start_time)
         
-        # Perform prediction
-        result = model_service.predict(file_path)
-        
-        if not result["success"]:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Prediction failed: {result.get('error', 'Unknown error')}"
-            )
+        # Refuse before inference if the prediction row could not be queued
+        get_write_queue().check_capacity()
         
-        # Generate prediction ID
-        prediction_id = str(uuid.uuid4())
+        result = await _run_prediction(data, start_time, views, ensemble, explain, client_key(request.scope))
         
         # Create session ID if not provided
-        user_session = str(uuid.uuid4())
+        user_session = session_id(request.scope) or str(uuid.uuid4())
         
-        # Save prediction to database
-        db_prediction = Prediction(
-            id=None,  # Auto-incremented
-            filename=unique_filename,
+        # Store the image once per distinct content, after the response
+        stored = _store_upload(background_tasks, data, result["image_hash"])
+        
+        # Queue the prediction row; it is written with the next bulk insert
+        prediction_id = get_write_queue().add_prediction(
             prediction=result["prediction"]["class"],
             confidence=result["prediction"]["confidence"],
             probability=result["prediction"]["probability"],
             processing_time=result["prediction"]["processing_time"],
-            user_session=user_session
+            user_session=user_session,
+            model_version=result["model_version"],
+            **stored
         )
-        
-        db.add(db_prediction)
-        await db.commit()
-        await db.refresh(db_prediction)
+        _index_embedding(result["model_version"], prediction_id, result["embedding"])
         
         # Return result
         return {
             "success": True,
             "prediction": result["prediction"],
             "image_info": result["image_info"],
+            "latency": result["latency"],
             "timestamp": time.time(),
-            "prediction_id": db_prediction.id,
-            "image_url": f"/uploads/{unique_filename}"
+            "prediction_id": prediction_id,
+            "model_version": result["model_version"],
+            **_image_urls(stored["filename"], stored["image_hash"]),
+            "explanation_url": result["explanation_url"]
         }
     
+    except InvalidUploadError as e:
+        logger.warning(f"Rejecting upload {file.filename}: {str(e)}")
+        raise _rejected_upload(e)
+    
+    except QueueFullError as e:
+        logger.warning(f"Rejecting prediction, server is busy: {str(e)}")
+        raise _service_unavailable(e)
+    
     except Exception as e:
         logger.error(f"Error processing prediction: {str(e)}")
-        # Clean up file if it exists
-        if os.path.exists(file_path):
-            os.remove(file_path)
         raise HTTPException(
             status_code=500,
             detail=f"Error processing prediction: {str(e)}"
         )
 
+def _study_aggregate(probabilities: List[float]) -> dict:
+    """Study-level summary of per-slice tumor probabilities"""
+    if not probabilities:
+        return {"class": None, "slices": 0}
+    tumor_slices = sum(1 for p in probabilities if p >= 0.5)
+    max_probability = max(probabilities)
+    return {
+        # A study is positive when any slice is
+        "class": "tumor" if tumor_slices else "no_tumor",
+        "slices": len(probabilities),
+        "tumor_slices": tumor_slices,
+        "tumor_fraction": tumor_slices / len(probabilities),
+        "max_probability": max_probability,
+        "mean_probability": sum(probabilities) / len(probabilities)
+    }
+
+def _ndjson(payload: dict) -> bytes:
+    return (json.dumps(payload) + "\n").encode()
+
+# Batch prediction endpoint
+@api_router.post("/predict/batch")
+async def predict_study(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    files: Optional[List[UploadFile]] = File(None),
+    archive: Optional[UploadFile] = File(None),
+    tta: Optional[int] = Query(None, ge=1, le=len(TTA_VIEWS), description="Test-time augmentation views to average"),
+    ensemble: bool = Query(False, description="Also average the ENSEMBLE_MODEL_PATHS models")
+):
+    """Predict every slice of a study and stream per-slice results as NDJSON.
+    
+    Accepts several image files and/or one zip/tar archive. Each slice is
+    streamed as soon as it is classified, followed by a study-level aggregate.
+    Prediction rows go through the write-behind queue and are bulk inserted.
+    """
+    views = _prediction_mode(tta, ensemble)
+    slices = []
+    for upload in files or []:
+        if not is_valid_file_extension(upload.filename):
+            raise HTTPException(
+                status_code=400,
+                detail=f"File extension not allowed for {upload.filename}. Allowed extensions: {', '.join(settings.ALLOWED_EXTENSIONS)}"
+            )
+        read_start = time.perf_counter()
+        try:
+            slices.append((upload.filename, await read_upload(upload)))
+        except InvalidUploadError as e:
+            raise HTTPException(status_code=e.status_code, detail=f"{upload.filename}: {str(e)}")
+        observe_stage("upload_read", time.perf_counter() - read_start)
+    
+    if archive is not None:
+        if not is_archive(archive.filename):
+            raise HTTPException(status_code=400, detail="Archive must be a zip or tar file")
+        read_start = time.perf_counter()
+        try:
+            archive_data = await read_upload(archive, settings.MAX_BATCH_UPLOAD_SIZE, sniff=False)
+        except InvalidUploadError as e:
+            raise _rejected_upload(e)
+        observe_stage("upload_read", time.perf_counter() - read_start)
+        try:
+            archive_count = await get_io_executor().run(
+                count_archive_images, archive_data, archive.filename, settings.BATCH_MAX_FILES + 1
+            )
+        except QueueFullError as e:
+            raise _service_unavailable(e)
+        except InvalidUploadError as e:
+            raise _rejected_upload(e)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Could not read archive: {str(e)}")
+        members = iter_archive_images(archive_data, archive.filename, archive_count)
+    else:
+        archive_count = 0
+        members = None
+    
+    if not slices and not archive_count:
+        raise HTTPException(status_code=400, detail="No images found in request")
+    if len(slices) + archive_count > settings.BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many images, at most {settings.BATCH_MAX_FILES} are allowed per study"
+        )
+    
+    try:
+        get_write_queue().check_capacity()
+    except QueueFullError as e:
+        raise _service_unavailable(e)
+    
+    study_id = str(uuid.uuid4())
+    # Every slice of the study is scheduled as the same client
+    client = client_key(request.scope)
+    
+    async def stream():
+        # Keep enough slices in flight to fill batches without flooding the queue
+        in_flight = asyncio.Semaphore(max(1, settings.BATCH_MAX_SIZE * 2 // views))
+        results = asyncio.Queue()
+        tasks = []
+        
+        async def run_slice(index, name, data):
+            try:
+                outcome = (index, name, data, await _run_prediction(data, time.perf_counter(), views, ensemble, client=client), None)
+            except Exception as e:
+                outcome = (index, name, data, None, e)
+            await results.put(outcome)
+        
+        async def schedule():
+            # Archive members are decompressed only when a slot frees up and a
+            # slot is freed once its result is streamed, so at most the slices
+            # in flight are held in memory
+            uploads = iter(slices)
+            index = 0
+            try:
+                while True:
+                    await in_flight.acquire()
+                    item = next(uploads, None)
+                    if item is None and members is not None:
+                        item = await get_io_executor().run(next, members, None)
+                    if item is None:
+                        in_flight.release()
+                        break
+                    tasks.append(asyncio.create_task(run_slice(index, *item)))
+                    index += 1
+            except Exception as e:
+                await results.put((index, archive.filename, None, None, e))
+            await asyncio.gather(*tasks)
+            await results.put(None)
+        
+        scheduler = asyncio.create_task(schedule())
+        write_queue = get_write_queue()
+        prediction_ids = {}
+        probabilities = []
+        failed = 0
+        try:
+            while True:
+                outcome = await results.get()
+                if outcome is None:
+                    break
+                index, name, data, result, error = outcome
+                in_flight.release()
+                if error is not None:
+                    failed += 1
+                    logger.error(f"Error processing slice {name}: {str(error)}")
+                    yield _ndjson({
+                        "type": "slice",
+                        "index": index,
+                        "filename": name,
+                        "success": False,
+                        "error": str(error)
+                    })
+                    continue
+                
+                stored = _store_upload(background_tasks, data, result["image_hash"])
+                
+                prediction_id = write_queue.add_prediction(
+                    prediction=result["prediction"]["class"],
+                    confidence=result["prediction"]["confidence"],
+                    probability=result["prediction"]["probability"],
+                    processing_time=result["prediction"]["processing_time"],
+                    user_session=study_id,
+                    model_version=result["model_version"],
+                    **stored
+                )
+                prediction_ids[index] = prediction_id
+                _index_embedding(result["model_version"], prediction_id, result["embedding"])
+                probabilities.append(result["prediction"]["probability"])
+                
+                yield _ndjson({
+                    "type": "slice",
+                    "index": index,
+                    "filename": name,
+                    "success": True,
+                    "prediction": result["prediction"],
+                    "image_info": result["image_info"],
+                    "latency": result["latency"],
+                    "prediction_id": prediction_id,
+                    "model_version": result["model_version"],
+                    **_image_urls(stored["filename"], stored["image_hash"])
+                })
+        finally:
+            # Client went away: stop the remaining slices
+            scheduler.cancel()
+            for task in tasks:
+                task.cancel()
+        
+        yield _ndjson({
+            "type": "study",
+            "study_id": study_id,
+            "failed": failed,
+            "aggregate": _study_aggregate(probabilities),
+            "prediction_ids": prediction_ids,
+            "timestamp": time.time()
+        })
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson", background=background_tasks)
+
+# Prediction cache statistics
+@api_router.get("/cache/stats")
+async def cache_stats():
+    """Hit/miss counters and sizes for the prediction cache"""
+    stats = await get_io_executor().run(get_prediction_cache().stats)
+    return {
+        "enabled": settings.CACHE_ENABLED,
+        "model_version": get_model_service().cache_version,
+        **stats
+    }
+
+# Model quality statistics
+@api_router.get("/stats")
+async def get_stats(
+    days: int = Query(30, ge=1, le=366, description="Days of per-day counts and latency to return"),
+    db: AsyncSession = Depends(get_db)
+):
+    """Counts by class, feedback accuracy, confusion, calibration and per-day latency percentiles.
+    
+    Served from aggregates that are updated as predictions and feedback are
+    written, so the cost does not grow with the size of the history.
+    """
+    try:
+        # Include rows the write-behind queue should have written by now
+        await get_write_queue().flush_if_stale()
+        return await read_stats(db, days)
+    except Exception as e:
+        logger.error(f"Error retrieving stats: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error retrieving stats: {str(e)}"
+        )
+
+def _find_stored_image(sha256: str):
+    """Extension of a stored original, or None if the store does not have it"""
+    image_store = get_image_store()
+    for extension in ("png", "jpg"):
+        if os.path.exists(image_store.absolute(image_store.object_path(sha256, extension))):
+            return extension
+    return None
+
+def _immutable_headers(etag: str) -> dict:
+    return {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={settings.IMAGE_CACHE_MAX_AGE}, immutable"
+    }
+
+def _not_modified(request: Request, etag: str) -> Optional[Response]:
+    """304 response when the client already holds this ETag"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=_immutable_headers(etag))
+    return None
+
+# Stored images, addressed by the SHA-256 of their content
+@api_router.get("/images/{sha256}")
+async def get_image(sha256: str, request: Request):
+    """Original upload; its content never changes, so clients may cache it indefinitely"""
+    sha256 = sha256.lower()
+    if not IMAGE_HASH_PATTERN.fullmatch(sha256):
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    extension = await get_io_executor().run(_find_stored_image, sha256)
+    if extension is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    etag = f'"{sha256}"'
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    
+    image_store = get_image_store()
+    return FileResponse(
+        image_store.absolute(image_store.object_path(sha256, extension)),
+        media_type="image/png" if extension == "png" else "image/jpeg",
+        headers=_immutable_headers(etag)
+    )
+
+@api_router.get("/images/{sha256}/explanation/{model_version}")
+async def get_explanation(sha256: str, model_version: str, request: Request):
+    """Grad-CAM overlay rendered by /api/predict?explain=true"""
+    sha256 = sha256.lower()
+    if not IMAGE_HASH_PATTERN.fullmatch(sha256) or not MODEL_VERSION_PATTERN.fullmatch(model_version):
+        raise HTTPException(status_code=404, detail="Explanation not found")
+    
+    image_store = get_image_store()
+    path = image_store.absolute(image_store.explanation_path(sha256, model_version))
+    if not await get_io_executor().run(os.path.exists, path):
+        raise HTTPException(status_code=404, detail="Explanation not found")
+    
+    etag = f'"{sha256}-cam-{model_version}"'
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    return FileResponse(path, media_type="image/jpeg", headers=_immutable_headers(etag))
+
+@api_router.get("/images/{sha256}/thumbnail")
+async def get_thumbnail(sha256: str, request: Request):
+    """Downscaled preview for history views, generated on demand if missing"""
+    sha256 = sha256.lower()
+    if settings.THUMBNAIL_SIZE <= 0 or not IMAGE_HASH_PATTERN.fullmatch(sha256):
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    
+    image_store = get_image_store()
+    etag = f'"{sha256}-thumb{settings.THUMBNAIL_SIZE}"'
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    
+    io_executor = get_io_executor()
+    extension = await io_executor.run(_find_stored_image, sha256)
+    if extension is None:
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    
+    try:
+        path = await io_executor.run(image_store.ensure_thumbnail, sha256, extension)
+    except Exception as e:
+        logger.error(f"Error creating thumbnail for {sha256}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error creating thumbnail")
+    
+    media_type = "image/webp" if image_store.thumbnail_format == "webp" else "image/jpeg"
+    return FileResponse(path, media_type=media_type, headers=_immutable_headers(etag))
+
+def _encode_cursor(timestamp, prediction_id: int) -> str:
+    """Opaque keyset cursor for the position after (timestamp, id)"""
+    raw = f"{timestamp.isoformat()}|{prediction_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_cursor(cursor: str):
+    raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+    timestamp, prediction_id = raw.rsplit("|", 1)
+    return datetime.datetime.fromisoformat(timestamp), int(prediction_id)
+
+# Columns returned by the history endpoint
+HISTORY_COLUMNS = (
+    Prediction.id,
+    Prediction.filename,
+    Prediction.image_hash,
+    Prediction.model_version,
+    Prediction.prediction,
+    Prediction.confidence,
+    Prediction.probability,
+    Prediction.processing_time,
+    Prediction.timestamp,
+)
+
+def _history_query(user_session: Optional[str], cursor: Optional[str], skip: int, limit: int):
+    """Newest-first history page, by keyset cursor when given, else by offset"""
+    query = select(*HISTORY_COLUMNS).order_by(desc(Prediction.timestamp), desc(Prediction.id))
+    
+    # Filter by user session if provided
+    if user_session:
+        query = query.filter(Prediction.user_session == user_session)
+    
+    if cursor:
+        timestamp, prediction_id = _decode_cursor(cursor)
+        # Row-value comparison lets the (timestamp, id) index seek straight to the page
+        query = query.filter(
+            tuple_(Prediction.timestamp, Prediction.id) < tuple_(timestamp, prediction_id)
+        )
+    elif skip:
+        query = query.offset(skip)
+    
+    return query.limit(limit)
+
+def _count_query(user_session: Optional[str]):
+    query = select(func.count()).select_from(Prediction)
+    if user_session:
+        query = query.filter(Prediction.user_session == user_session)
+    return query
+
 # Get predictions history
 @api_router.get("/predictions")
 async def get_predictions(
     skip: int = Query(0, ge=0),
     limit: int = Query(10, ge=1, le=100),
     user_session: Optional[str] = None,
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    include_total: bool = Query(True, description="Set to false to skip counting when paging by cursor"),
     db: AsyncSession = Depends(get_db)
 ):
-    """Get prediction history with pagination"""
+    """Get prediction history with cursor (keyset) or offset pagination"""
     try:
-        # Build query
-        query = select(Prediction).order_by(desc(Prediction.timestamp))
+        # Include predictions the write-behind queue should have written by now
+        await get_write_queue().flush_if_stale()
         
-        # Filter by user session if provided
-        if user_session:
-            query = query.filter(Prediction.user_session == user_session)
-        
-        # Apply pagination
-        query = query.offset(skip).limit(limit)
+        try:
+            query = _history_query(user_session, cursor, skip, limit)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
         
         # Execute query
         result = await db.execute(query)
-        predictions = result.scalars().all()
+        predictions = result.all()
         
         # Count total
-        count_query = select(Prediction)
-        if user_session:
-            count_query = count_query.filter(Prediction.user_session == user_session)
-        count_result = await db.execute(count_query)
-        total_count = len(count_result.scalars().all())
+        total_count = None
+        if include_total:
+            total_count = (await db.execute(_count_query(user_session))).scalar_one()
         
         # Format results
         formatted_predictions = []
@@ -149,17 +739,26 @@ async def get_predictions(
                 "confidence": pred.confidence,
                 "probability": pred.probability,
                 "processing_time": pred.processing_time,
+                "model_version": pred.model_version,
                 "timestamp": pred.timestamp.isoformat(),
-                "image_url": f"/uploads/{pred.filename}"
+                **_image_urls(pred.filename, pred.image_hash)
             })
         
+        next_cursor = None
+        if len(predictions) == limit:
+            next_cursor = _encode_cursor(predictions[-1].timestamp, predictions[-1].id)
+        
         return {
             "predictions": formatted_predictions,
             "total": total_count,
             "skip": skip,
-            "limit": limit
+            "limit": limit,
+            "next_cursor": next_cursor
         }
     
+    except HTTPException:
+        raise
+    
     except Exception as e:
         logger.error(f"Error retrieving predictions: {str(e)}")
         raise HTTPException(
@@ -167,47 +766,340 @@ async def get_predictions(
             detail=f"Error retrieving predictions: {str(e)}"
         )
 
+# Columns written by the export endpoint, in order
+EXPORT_COLUMNS = (
+    Prediction.id,
+    Prediction.timestamp,
+    Prediction.user_session,
+    Prediction.filename,
+    Prediction.image_hash,
+    Prediction.model_version,
+    Prediction.prediction,
+    Prediction.confidence,
+    Prediction.probability,
+    Prediction.processing_time,
+)
+EXPORT_FIELDS = [column.key for column in EXPORT_COLUMNS]
+
+# Exports streaming in this worker; each holds a database connection until it finishes
+_exports_running = 0
+
+class _ExportSlot:
+    """One of the EXPORT_MAX_CONCURRENT export slots, held from admission until release()"""
+    
+    def __init__(self):
+        global _exports_running
+        _exports_running += 1
+        self._held = True
+    
+    def release(self):
+        global _exports_running
+        if self._held:
+            self._held = False
+            _exports_running -= 1
+
+class _ExportResponse(StreamingResponse):
+    """Streams an export and releases its slot when sending ends, however it ends.
+    
+    That covers a finished body, an error, a client that disconnects before
+    the first chunk, and a response that is dropped without being sent.
+    """
+    
+    def __init__(self, content, slot: _ExportSlot, **kwargs):
+        super().__init__(content, **kwargs)
+        self._slot = slot
+        weakref.finalize(self, slot.release)
+    
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._slot.release()
+
+def _naive_utc(value: Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+    """Timestamps are stored as naive UTC"""
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+def _accepts_gzip(request: Request) -> bool:
+    for encoding in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = encoding.partition(";")
+        if name.strip().lower() == "gzip" and params.replace(" ", "") not in ("q=0", "q=0.0"):
+            return True
+    return False
+
+def _export_query(user_session: Optional[str], start: Optional[datetime.datetime],
+                  end: Optional[datetime.datetime], prediction: Optional[str]):
+    """Oldest-first history matching the filters, fetched EXPORT_FETCH_SIZE rows at a time"""
+    query = select(*EXPORT_COLUMNS).order_by(Prediction.timestamp, Prediction.id)
+    if user_session:
+        query = query.filter(Prediction.user_session == user_session)
+    if start is not None:
+        query = query.filter(Prediction.timestamp >= start)
+    if end is not None:
+        query = query.filter(Prediction.timestamp < end)
+    if prediction:
+        query = query.filter(Prediction.prediction == prediction)
+    # Server-side cursor on PostgreSQL, so rows are never all in memory
+    return query.execution_options(yield_per=settings.EXPORT_FETCH_SIZE)
+
+async def _export_stream(query, export_format: str, compress: bool):
+    """Encode rows as they come off the cursor, one chunk per fetched partition"""
+    # wbits=31 writes a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(settings.EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31) if compress else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if export_format == "csv" else None
+    if writer is not None:
+        writer.writerow(EXPORT_FIELDS)
+    
+    def drain() -> bytes:
+        data = buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor is not None else data
+    
+    try:
+        async with async_session() as session:
+            result = await session.stream(query)
+            async for rows in result.partitions():
+                for row in rows:
+                    values = list(row)
+                    values[1] = values[1].isoformat() if values[1] is not None else None
+                    if writer is not None:
+                        writer.writerow(values)
+                    else:
+                        buffer.write(json.dumps(dict(zip(EXPORT_FIELDS, values))) + "\n")
+                # The compressor only returns output once it has filled a block
+                chunk = drain()
+                if chunk:
+                    yield chunk
+        chunk = drain()
+        if compressor is not None:
+            chunk += compressor.flush()
+        if chunk:
+            yield chunk
+    except Exception as e:
+        # Headers are already sent; the client sees a truncated response
+        logger.error(f"Error exporting predictions: {str(e)}")
+        raise
+
+# Export prediction history
+@api_router.get("/predictions/export")
+async def export_predictions(
+    request: Request,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$", description="ndjson or csv"),
+    user_session: Optional[str] = None,
+    start: Optional[datetime.datetime] = Query(None, description="Only predictions at or after this time"),
+    end: Optional[datetime.datetime] = Query(None, description="Only predictions before this time"),
+    prediction: Optional[str] = Query(None, pattern="^(tumor|no_tumor)$", description="Only this class")
+):
+    """Stream the whole prediction history, or a filtered part of it, as NDJSON or CSV.
+    
+    Rows are read from a database cursor and written out a partition at a
+    time, so memory use does not grow with the size of the export. The
+    response is gzip-compressed as it streams when the client accepts gzip.
+    """
+    start, end = _naive_utc(start), _naive_utc(end)
+    if start is not None and end is not None and end <= start:
+        raise HTTPException(status_code=400, detail="end must be after start")
+    if _exports_running >= settings.EXPORT_MAX_CONCURRENT:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many exports running, please retry later",
+            headers={"Retry-After": "10"}
+        )
+    # Take the slot before the first await, so concurrent requests see it
+    slot = _ExportSlot()
+    
+    try:
+        # Include predictions the write-behind queue should have written by now
+        await get_write_queue().flush_if_stale()
+    except BaseException:
+        slot.release()
+        raise
+    
+    compress = _accepts_gzip(request)
+    headers = {
+        "Content-Disposition": f'attachment; filename="predictions.{format}"',
+        "Vary": "Accept-Encoding"
+    }
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return _ExportResponse(
+        _export_stream(_export_query(user_session, start, end, prediction), format, compress),
+        slot,
+        media_type=media_type,
+        headers=headers
+    )
+
+# Similar past cases
+@api_router.get("/similar/{prediction_id}")
+async def similar_cases(
+    prediction_id: int,
+    k: int = Query(10, ge=1, le=100, description="Number of similar cases to return"),
+    distinct_images: bool = Query(True, description="Return each image once and skip repeats of the query image"),
+    db: AsyncSession = Depends(get_db)
+):
+    """Past predictions whose images the model sees as most similar, with their feedback.
+    
+    Similarity is the cosine of the 512-d head embeddings stored when each
+    prediction was made, compared only within the query's model version.
+    """
+    if not settings.EMBEDDING_INDEX_ENABLED:
+        raise HTTPException(status_code=404, detail="Similar-case search is disabled")
+    try:
+        # Read-your-writes for the query, which is often the prediction just made;
+        # neighbours still being batched show up on the next search
+        write_queue = get_write_queue()
+        if write_queue.has_pending_prediction(prediction_id):
+            await write_queue.flush()
+        else:
+            await write_queue.flush_if_stale()
+        
+        query = (await db.execute(
+            select(Prediction.model_version, Prediction.image_hash).filter(Prediction.id == prediction_id)
+        )).first()
+        if query is None:
+            raise HTTPException(status_code=404, detail=f"Prediction with ID {prediction_id} not found")
+        
+        # Cache hits are not embedded; any prediction of the same image by the same model will do
+        candidates = [prediction_id]
+        if query.image_hash:
+            candidates += (await db.execute(
+                select(Prediction.id)
+                .filter(Prediction.image_hash == query.image_hash, Prediction.model_version == query.model_version,
+                        Prediction.id != prediction_id)
+                .order_by(desc(Prediction.id))
+                .limit(100)
+            )).scalars().all()
+        
+        store = get_embedding_store()
+        io_executor = get_io_executor()
+        search_start = time.perf_counter()
+        embedding = await io_executor.run(store.get, query.model_version, candidates)
+        if embedding is None:
+            raise HTTPException(status_code=404, detail=f"No embedding is stored for prediction {prediction_id}")
+        
+        # Fetch extra neighbours to make up for the ones dropped below
+        fetch = k * 4 + 1 if distinct_images else k + 1
+        found = await io_executor.run(store.search, query.model_version, embedding[None, :], fetch)
+        search_time = time.perf_counter() - search_start
+        neighbours = [(i, similarity) for i, similarity in found["results"][0] if i != prediction_id]
+        
+        ids = [i for i, _ in neighbours]
+        rows = {
+            row.id: row for row in (await db.execute(
+                select(Prediction).filter(Prediction.id.in_(ids))
+            )).scalars().all()
+        } if ids else {}
+        feedback = {}
+        if rows:
+            for row in (await db.execute(
+                select(Feedback).filter(Feedback.prediction_id.in_(list(rows))).order_by(Feedback.timestamp)
+            )).scalars().all():
+                # The latest feedback on each prediction wins
+                feedback[row.prediction_id] = {
+                    "is_correct": bool(row.is_correct),
+                    "comment": row.comment,
+                    "timestamp": row.timestamp.isoformat() if row.timestamp else None
+                }
+        
+        results = []
+        seen_images = {query.image_hash} if query.image_hash else set()
+        for i, similarity in neighbours:
+            pred = rows.get(i)
+            # Rows deleted since their embedding was stored are skipped
+            if pred is None:
+                continue
+            if distinct_images and pred.image_hash:
+                if pred.image_hash in seen_images:
+                    continue
+                seen_images.add(pred.image_hash)
+            results.append({
+                "id": pred.id,
+                "similarity": similarity,
+                "prediction": pred.prediction,
+                "confidence": pred.confidence,
+                "probability": pred.probability,
+                "timestamp": pred.timestamp.isoformat() if pred.timestamp else None,
+                "feedback": feedback.get(pred.id),
+                **_image_urls(pred.filename, pred.image_hash)
+            })
+            if len(results) == k:
+                break
+        
+        return {
+            "prediction_id": prediction_id,
+            "model_version": query.model_version,
+            "results": results,
+            "index": found["index"],
+            "scanned": found["scanned"],
+            "search_time_ms": search_time * 1000.0
+        }
+    
+    except HTTPException:
+        raise
+    
+    except QueueFullError as e:
+        raise _service_unavailable(e)
+    
+    except Exception as e:
+        logger.error(f"Error searching similar cases: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error searching similar cases: {str(e)}"
+        )
+
 # Submit feedback
 @api_router.post("/feedback")
 async def submit_feedback(
     prediction_id: int = Form(...),
     is_correct: bool = Form(...),
-    comment: Optional[str] = Form(None),
-    db: AsyncSession = Depends(get_db)
+    comment: Optional[str] = Form(None)
 ):
     """Submit feedback for a prediction"""
     try:
-        # Check if prediction exists
-        result = await db.execute(
-            select(Prediction).filter(Prediction.id == prediction_id)
-        )
-        prediction = result.scalars().first()
+        write_queue = get_write_queue()
+        write_queue.check_capacity()
+        
+        # Check if prediction exists, either queued or already written;
+        # only the second case needs a database connection
+        exists = write_queue.has_pending_prediction(prediction_id)
+        if not exists:
+            async with async_session() as db:
+                result = await db.execute(
+                    select(Prediction.id).filter(Prediction.id == prediction_id)
+                )
+                exists = result.scalar() is not None
         
-        if not prediction:
+        if not exists:
             raise HTTPException(
                 status_code=404,
                 detail=f"Prediction with ID {prediction_id} not found"
             )
         
-        # Create feedback
-        feedback = Feedback(
+        # Queue feedback behind the prediction it refers to
+        feedback_id = write_queue.add_feedback(
             prediction_id=prediction_id,
             is_correct=1 if is_correct else 0,
             comment=comment
         )
         
-        db.add(feedback)
-        await db.commit()
-        
         return {
             "success": True,
             "message": "Feedback submitted successfully",
-            "feedback_id": feedback.id
+            "feedback_id": feedback_id
         }
     
     except HTTPException:
         raise
     
+    except QueueFullError as e:
+        logger.warning(f"Rejecting feedback, server is busy: {str(e)}")
+        raise _service_unavailable(e)
+    
     except Exception as e:
         logger.error(f"Error submitting feedback: {str(e)}")
         raise HTTPException(
@@ -0,0 +1,126 @@
+import json
+import logging
+
+from fastapi import UploadFile
+
+from app.utils.config import settings
+from app.utils.file_utils import SNIFF_BYTES, InvalidUploadError, sniff_image_type
+
+logger = logging.getLogger(__name__)
+
+# Room for multipart boundaries and part headers around a single file
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+async def read_upload(file: UploadFile, max_size: int = None, sniff: bool = True):
+    """Read an uploaded image in chunks, stopping as soon as it is too large or not an image.
+
+    Returns a bytearray, which every consumer (hashing, decoding, saving)
+    accepts without another copy.
+    """
+    if max_size is None:
+        max_size = settings.MAX_FILE_SIZE
+
+    # Multipart parsing may already know the size
+    if file.size is not None and file.size > max_size:
+        raise InvalidUploadError(f"File is larger than {max_size} bytes", status_code=413)
+
+    buffer = bytearray()
+    sniffed = not sniff
+    while True:
+        chunk = await file.read(settings.UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer += chunk
+        if len(buffer) > max_size:
+            raise InvalidUploadError(f"File is larger than {max_size} bytes", status_code=413)
+        if not sniffed and len(buffer) >= SNIFF_BYTES:
+            # Reject non-images after the first chunk instead of reading them whole
+            if sniff_image_type(buffer) is None:
+                raise InvalidUploadError("File is not a PNG or JPEG image", status_code=415)
+            sniffed = True
+
+    if not buffer:
+        raise InvalidUploadError("File is empty")
+    if not sniffed and sniff_image_type(buffer) is None:
+        raise InvalidUploadError("File is not a PNG or JPEG image", status_code=415)
+    return buffer
+
+
+class RequestTooLargeError(Exception):
+    """Raised from receive() when a request body goes over its limit"""
+
+
+class RequestSizeLimitMiddleware:
+    """ASGI middleware that caps request bodies before the multipart parser spools them.
+
+    Requests whose Content-Length is over the limit are answered with 413
+    without reading the body. Chunked or mislabelled bodies are counted as
+    they stream in and cut off with 413 as soon as they pass the limit.
+    """
+
+    def __init__(self, app, default_limit: int, path_limits: dict = None):
+        self.app = app
+        self.default_limit = default_limit
+        self.path_limits = path_limits or {}
+
+    async def _reject(self, send, limit: int):
+        body = json.dumps({"detail": f"Request body is larger than {limit} bytes"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"connection", b"close"),
+            ]
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in ("GET", "HEAD", "OPTIONS"):
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.path_limits.get(scope["path"], self.default_limit)
+
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                try:
+                    declared = int(value)
+                except ValueError:
+                    declared = 0
+                if declared > limit:
+                    logger.warning(f"Rejecting {scope['path']}: Content-Length {declared} is over {limit}")
+                    await self._reject(send, limit)
+                    return
+                break
+
+        state = {"received": 0, "exceeded": False, "started": False}
+
+        async def limited_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                state["received"] += len(message.get("body", b""))
+                if state["received"] > limit:
+                    state["exceeded"] = True
+                    raise RequestTooLargeError(f"Request body is larger than {limit} bytes")
+            return message
+
+        async def guarded_send(message):
+            if state["exceeded"]:
+                # The app turned the aborted body into an error of its own; answer 413 instead
+                if message["type"] == "http.response.start" and not state["started"]:
+                    state["started"] = True
+                    await self._reject(send, limit)
+                return
+            if message["type"] == "http.response.start":
+                state["started"] = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except RequestTooLargeError:
+            if not state["started"]:
+                state["started"] = True
+                await self._reject(send, limit)
@@ -0,0 +1,463 @@
+"""Score large collections of scans offline, without going through the API.
+
+Streams every image under the given directories and zip/tar archives
+through a pool of decode processes into batched inference, and writes the
+results as it goes: CSV, or Parquet part files when the output ends in
+.parquet (needs pyarrow). The run is checkpointed next to the output, so an
+interrupted run continues where it stopped with --resume.
+
+Decoding and inference use separate cores: --workers decode processes and
+--threads inference threads, split from the available cores by default.
+
+Usage (from the backend directory):
+    python -m app.bulk_score /data/scans --output scores.csv
+    python -m app.bulk_score scans.tar.gz more_scans/ --output scores.parquet --workers 4
+    python -m app.bulk_score /data/scans --output scores.csv --resume
+"""
+import os
+import sys
+import csv
+import json
+import time
+import queue
+import signal
+import argparse
+import itertools
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from app.services.inference_backends import BACKENDS
+from app.services.model_service import get_model_service
+from app.services.preprocessing import OpenCVPreprocessor, decode_image
+from app.utils.config import settings
+from app.utils.file_utils import is_archive, is_valid_file_extension, iter_archive_members
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ("key", "prediction", "probability", "confidence", "model_version", "error")
+
+
+def _walk_directory(directory: str):
+    """Images and archives under a directory, sorted so that reruns enumerate them in the same order"""
+    with os.scandir(directory) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_dir():
+            yield from _walk_directory(entry.path)
+        elif is_archive(entry.name):
+            yield from _archive_sources(entry.path)
+        elif entry.is_file() and is_valid_file_extension(entry.name):
+            yield entry.path, entry.path
+
+
+def _archive_sources(path: str):
+    for name, read in iter_archive_members(path):
+        yield f"{path}!{name}", read
+
+
+def iter_sources(paths):
+    """Yield (key, source) for every image under paths, in a stable order.
+
+    source is a file path, which the decode workers open themselves, or for
+    archive members a callable returning the bytes, which must be called
+    before the next item is taken.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from _walk_directory(path)
+        elif is_archive(path):
+            yield from _archive_sources(path)
+        elif is_valid_file_extension(path):
+            yield path, path
+        else:
+            logger.warning(f"Skipping {path}: not a directory, archive or image")
+
+
+_preprocessor = None
+
+
+def _init_worker():
+    """Decode workers leave Ctrl-C to the main process and use one OpenCV thread each"""
+    global _preprocessor
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import cv2
+    cv2.setNumThreads(1)
+    _preprocessor = OpenCVPreprocessor()
+
+
+def decode_chunk(sources):
+    """Decode and resize images in a worker process.
+
+    Returns one entry per source: (uint8 HWC pixels, None), or (None, error).
+    Only the resized uint8 image is sent back, a quarter of the size of the
+    normalized float32 tensor.
+    """
+    results = []
+    for source in sources:
+        try:
+            image, _ = decode_image(source)
+            results.append((_preprocessor.resize(image), None))
+        except Exception as e:
+            results.append((None, str(e) or type(e).__name__))
+    return results
+
+
+def _result_row(key, probability, model_version):
+    prediction = "tumor" if probability >= 0.5 else "no_tumor"
+    confidence = probability if prediction == "tumor" else 1 - probability
+    return (key, prediction, probability, confidence, model_version, "")
+
+
+class CsvResultWriter:
+    """Results appended to a CSV file, flushed to disk on commit"""
+
+    def __init__(self, path: str, state: dict = None):
+        if state:
+            # Drop rows written after the last checkpoint; they are scored again
+            os.truncate(path, state["offset"])
+        self._file = open(path, "a" if state else "w", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+        if not state:
+            self._writer.writerow(COLUMNS)
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+    def commit(self) -> dict:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return {"offset": os.fstat(self._file.fileno()).st_size}
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetResultWriter:
+    """Results as a directory of Parquet part files, one per commit"""
+
+    def __init__(self, path: str, state: dict = None):
+        import pyarrow
+        import pyarrow.parquet
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self._schema = pyarrow.schema([
+            ("key", pyarrow.string()),
+            ("prediction", pyarrow.string()),
+            ("probability", pyarrow.float64()),
+            ("confidence", pyarrow.float64()),
+            ("model_version", pyarrow.string()),
+            ("error", pyarrow.string()),
+        ])
+        self._path = path
+        self._parts = state["parts"] if state else 0
+        self._rows = []
+
+        os.makedirs(path, exist_ok=True)
+        # Parts written after the last checkpoint are written again
+        for name in os.listdir(path):
+            if name.startswith("part-") and int(name[5:10]) >= self._parts:
+                os.remove(os.path.join(path, name))
+
+    def write(self, rows):
+        self._rows.extend(rows)
+
+    def commit(self) -> dict:
+        if self._rows:
+            columns = list(zip(*self._rows))
+            table = self._pa.table(
+                [list(values) for values in columns], schema=self._schema
+            )
+            part = os.path.join(self._path, f"part-{self._parts:05d}.parquet")
+            tmp = f"{part}.tmp"
+            self._pq.write_table(table, tmp)
+            os.replace(tmp, part)
+            self._parts += 1
+            self._rows = []
+        return {"parts": self._parts}
+
+    def close(self):
+        pass
+
+
+class Checkpoint:
+    """How many enumerated sources have durable results, stored next to the output"""
+
+    def __init__(self, path: str, sources: list, model_version: str, processed: int = 0, writer: dict = None):
+        self.path = path
+        self.sources = sources
+        self.model_version = model_version
+        self.processed = processed
+        self.writer = writer
+
+    @classmethod
+    def load(cls, path: str):
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        return cls(path, data["sources"], data["model_version"], data["processed"], data["writer"])
+
+    def save(self, processed: int, writer: dict, complete: bool = False):
+        self.processed = processed
+        self.writer = writer
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({
+                "sources": self.sources,
+                "model_version": self.model_version,
+                "processed": processed,
+                "writer": writer,
+                "complete": complete
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+class InferenceStage(threading.Thread):
+    """Scores batches and writes their rows while the main thread prepares the next ones.
+
+    Commits the output and saves the checkpoint every commit_interval seconds.
+    """
+
+    def __init__(self, model_service, writer, checkpoint, commit_interval: float, depth: int = 2):
+        super().__init__(name="bulk-inference", daemon=True)
+        self._model_service = model_service
+        self._writer = writer
+        self._checkpoint = checkpoint
+        self._commit_interval = commit_interval
+        self._batches = queue.Queue(maxsize=depth)
+        self.error = None
+        self.written = 0
+        self.scored = 0
+        self.failed = 0
+
+    def put(self, batch):
+        """Queue a batch, waiting while the queue is full"""
+        while True:
+            if self.error is not None or not self.is_alive():
+                raise RuntimeError("Inference stage stopped")
+            try:
+                self._batches.put(batch, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def commit(self, complete: bool = False):
+        """Make everything written so far durable and record it in the checkpoint"""
+        state = self._writer.commit()
+        self._checkpoint.save(self._checkpoint.processed + self.written, state, complete)
+        self.written = 0
+
+    def run(self):
+        model_version = self._model_service.model_version
+        last_commit = time.monotonic()
+        try:
+            while True:
+                batch = self._batches.get()
+                if batch is None:
+                    return
+                keys, errors, tensor = batch
+                probabilities = iter(self._model_service.predict_batch(tensor) if tensor is not None else ())
+                rows = []
+                for key, error in zip(keys, errors):
+                    if error is None:
+                        rows.append(_result_row(key, next(probabilities), model_version))
+                    else:
+                        rows.append((key, None, None, None, model_version, error))
+                self._writer.write(rows)
+                self.written += len(rows)
+                self.failed += sum(1 for error in errors if error is not None)
+                self.scored += len(rows)
+
+                if time.monotonic() - last_commit >= self._commit_interval:
+                    self.commit()
+                    last_commit = time.monotonic()
+        except Exception as e:
+            self.error = e
+            logger.error(f"Error scoring batch: {str(e)}")
+
+
+def run(sources, executor, preprocessor, stage, skip: int, batch_size: int, chunk_size: int,
+        prefetch: int, log_interval: float):
+    """Feed decoded images to the inference stage in enumeration order, with at most prefetch chunks in flight"""
+    pending = deque()
+    keys, errors, images = [], [], []
+    start = last_log = time.monotonic()
+    last_scored = 0
+
+    def send_batch():
+        tensor = None
+        if images:
+            out = preprocessor.allocate(len(images))
+            for i, image in enumerate(images):
+                preprocessor.normalize_into(image, out[i])
+            tensor = torch.from_numpy(out)
+        stage.put((list(keys), list(errors), tensor))
+        keys.clear()
+        errors.clear()
+        images.clear()
+
+    def collect():
+        nonlocal last_log, last_scored
+        chunk_keys, future = pending.popleft()
+        for key, (image, error) in zip(chunk_keys, future.result()):
+            keys.append(key)
+            errors.append(error)
+            if error is None:
+                images.append(image)
+            else:
+                logger.warning(f"Could not decode {key}: {error}")
+            if len(keys) >= batch_size:
+                send_batch()
+
+        now = time.monotonic()
+        if now - last_log >= log_interval:
+            scored = stage.scored
+            logger.info(
+                f"{skip + scored} images done, {(scored - last_scored) / (now - last_log):.1f} images/s "
+                f"({scored / (now - start):.1f} images/s overall), {stage.failed} failed"
+            )
+            last_log, last_scored = now, scored
+
+    chunk = []
+    for key, source in itertools.islice(sources, skip, None):
+        # Archive members are read here, in order, since tar archives are streamed
+        chunk.append((key, source() if callable(source) else source))
+        if len(chunk) == chunk_size:
+            pending.append(([k for k, _ in chunk], executor.submit(decode_chunk, [s for _, s in chunk])))
+            chunk = []
+            while len(pending) >= prefetch:
+                collect()
+    if chunk:
+        pending.append(([k for k, _ in chunk], executor.submit(decode_chunk, [s for _, s in chunk])))
+    while pending:
+        collect()
+    if keys:
+        send_batch()
+
+
+def _default_split():
+    """Decode workers and inference threads for this machine; decoding is much cheaper than a forward pass"""
+    cores = os.cpu_count() or 1
+    workers = max(1, cores // 4)
+    return workers, max(1, cores - workers)
+
+
+def main(argv=None):
+    default_workers, default_threads = _default_split()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="Image files, directories and zip/tar archives to score")
+    parser.add_argument("--output", required=True, help="Results file: .csv, or .parquet for a directory of parts")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run from its checkpoint")
+    parser.add_argument("--model", default=settings.MODEL_PATH, help="Checkpoint to score with")
+    parser.add_argument("--backend", default=settings.INFERENCE_BACKEND, choices=BACKENDS, help="Inference backend")
+    parser.add_argument("--workers", type=int, default=default_workers, help="Decode processes")
+    parser.add_argument("--threads", type=int, default=default_threads, help="Inference threads")
+    parser.add_argument("--batch-size", type=int, default=64, help="Images per forward pass")
+    parser.add_argument("--chunk-size", type=int, default=16, help="Images per decode task")
+    parser.add_argument("--prefetch", type=int, default=None,
+                        help="Decode tasks in flight (default: 4 per worker)")
+    parser.add_argument("--commit-interval", type=float, default=30.0,
+                        help="Seconds between checkpoints; at most this much work is redone after an interruption")
+    parser.add_argument("--log-interval", type=float, default=10.0, help="Seconds between progress reports")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    parquet = args.output.lower().endswith(".parquet")
+    if parquet:
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            logger.error("Parquet output needs pyarrow (pip install pyarrow); use a .csv output instead")
+            return 1
+    sources = [os.path.abspath(path) for path in args.paths]
+    checkpoint_path = f"{args.output}.checkpoint"
+    checkpoint = Checkpoint.load(checkpoint_path) if args.resume else None
+    if checkpoint is None and os.path.exists(args.output):
+        logger.error(
+            f"{args.output} already exists"
+            + (" but has no checkpoint to resume from" if args.resume else "; pass --resume to continue it")
+        )
+        return 1
+    if checkpoint is not None and checkpoint.sources != sources:
+        logger.error(f"{args.output} was scored from {checkpoint.sources}, not {sources}")
+        return 1
+
+    # Start the decode processes before torch spins up its thread pools, which do not survive a fork
+    executor = ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker)
+    executor.submit(int).result()
+
+    torch.set_num_threads(args.threads)
+    settings.MODEL_PATH = args.model
+    settings.INFERENCE_BACKEND = args.backend
+    model_service = get_model_service()
+    if not model_service.is_model_loaded():
+        logger.error(f"Could not load a model from {args.model}")
+        executor.shutdown()
+        return 1
+    if checkpoint is not None and checkpoint.model_version != model_service.cache_version:
+        logger.error(
+            f"{args.output} was scored with model {checkpoint.model_version}, "
+            f"not {model_service.cache_version}"
+        )
+        executor.shutdown()
+        return 1
+
+    if checkpoint is None:
+        checkpoint = Checkpoint(checkpoint_path, sources, model_service.cache_version)
+    elif checkpoint.processed:
+        logger.info(f"Resuming after {checkpoint.processed} images")
+    skip = checkpoint.processed
+    writer = (ParquetResultWriter if parquet else CsvResultWriter)(args.output, checkpoint.writer)
+    stage = InferenceStage(model_service, writer, checkpoint, args.commit_interval)
+    stage.start()
+
+    logger.info(
+        f"Scoring with model {model_service.model_version} ({args.backend}), "
+        f"{args.workers} decode workers, {args.threads} inference threads"
+    )
+    start = time.monotonic()
+    status = 0
+    try:
+        run(
+            iter_sources(args.paths), executor, OpenCVPreprocessor(), stage, skip,
+            batch_size=args.batch_size,
+            chunk_size=args.chunk_size,
+            prefetch=args.prefetch or 4 * args.workers,
+            log_interval=args.log_interval
+        )
+    except KeyboardInterrupt:
+        logger.warning("Interrupted; saving progress, rerun with --resume to continue")
+        status = 130
+    except Exception as e:
+        logger.error(f"Error scoring images: {str(e)}")
+        status = 1
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        # Let the inference stage finish the batches already queued
+        if stage.is_alive():
+            stage.put(None)
+            stage.join()
+        if stage.error is not None:
+            status = 1
+        else:
+            stage.commit(complete=status == 0)
+        writer.close()
+
+    elapsed = time.monotonic() - start
+    logger.info(
+        f"Scored {stage.scored} images ({stage.failed} failed) in {elapsed:.1f}s: "
+        f"{stage.scored / elapsed if elapsed > 0 else 0:.1f} images/s; "
+        f"{checkpoint.processed} done in total, results in {args.output}"
+    )
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
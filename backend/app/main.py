@@ -1,11 +1,20 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
 from fastapi.staticfiles import StaticFiles
 import os
 import logging
 from pathlib import Path
 
+from app.api.admin import admin_router
 from app.api.routes import api_router
+from app.api.upload import MULTIPART_OVERHEAD, RequestSizeLimitMiddleware
+from app.models.database import get_write_queue
+from app.services.batch_scheduler import get_inference_scheduler
+from app.services.executor import get_io_executor
+from app.services.metrics import CONTENT_TYPE, MetricsMiddleware, registry
+from app.services.model_service import get_model_service
+from app.services.rate_limit import RateLimitMiddleware, get_address_rate_limiter, get_rate_limiter
 from app.utils.config import settings
 
 # Configure logging
@@ -21,6 +30,15 @@ app = FastAPI(
     version="1.0.0",
 )
 
+# Enforce the rate limits per address and session; added first so that it runs inside CORS and
+# metrics, and 429 responses carry CORS headers and are counted per status
+app.add_middleware(
+    RateLimitMiddleware,
+    limiter=get_rate_limiter(),
+    path_prefixes=settings.RATE_LIMIT_PATHS,
+    address_limiter=get_address_rate_limiter()
+)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -30,8 +48,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Cap request bodies before they are parsed and spooled to disk
+app.add_middleware(
+    RequestSizeLimitMiddleware,
+    default_limit=settings.MAX_FILE_SIZE + MULTIPART_OVERHEAD,
+    path_limits={"/api/predict/batch": settings.MAX_BATCH_UPLOAD_SIZE + MULTIPART_OVERHEAD}
+)
+
+# Track in-flight requests and total request time
+app.add_middleware(MetricsMiddleware)
+
 # Include API routes
 app.include_router(api_router, prefix="/api")
+app.include_router(admin_router, prefix="/api/admin", include_in_schema=bool(settings.ADMIN_TOKEN))
 
 # Mount uploads directory for serving uploaded images
 uploads_path = Path(settings.UPLOAD_DIR)
@@ -48,6 +77,37 @@ async def root():
         "health_check": "/api/health"
     }
 
+# Gauges read at scrape time
+registry.gauge(
+    "brain_tumor_model_loaded", "1 when model weights are loaded",
+    callback=lambda: int(get_model_service().is_model_loaded())
+)
+registry.gauge(
+    "brain_tumor_inference_queue_depth", "Preprocessed images waiting for a forward pass",
+    callback=lambda: get_inference_scheduler().queue_depth
+)
+registry.gauge(
+    "brain_tumor_inference_queue_clients", "Clients with requests waiting for a forward pass",
+    callback=lambda: get_inference_scheduler().active_flows
+)
+registry.gauge(
+    "brain_tumor_rate_limit_clients", "Addresses with a partly used rate limit bucket",
+    callback=lambda: get_address_rate_limiter().tracked_clients
+)
+registry.gauge(
+    "brain_tumor_preprocess_pending", "Decode and preprocess tasks queued or running",
+    callback=lambda: get_io_executor().pending
+)
+registry.gauge(
+    "brain_tumor_db_write_pending", "Rows waiting in the write-behind queue",
+    callback=lambda: get_write_queue().pending_count
+)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Metrics in the Prometheus text exposition format"""
+    return Response(content=registry.render(), media_type=CONTENT_TYPE)
+
 @app.on_event("startup")
 async def startup_event():
     logger.info("Starting up Brain Tumor Detection API")
@@ -57,11 +117,60 @@ async def startup_event():
     from app.models.database import init_db
     await init_db()
     
+    from app.models.database import get_worker_id_lease
+    # Lease the worker tag that keeps generated ids unique across processes
+    await get_worker_id_lease().acquire()
+    get_worker_id_lease().start()
+    
     from app.services.model_service import get_model_service
     # Initialize model service (this will load the model)
     model_service = get_model_service()
     logger.info(f"Model loaded successfully: {model_service.is_model_loaded()}")
+    model_service.warmup()
+    
+    from app.services.model_registry import get_model_registry
+    # Serve the version the registry marks active and follow later deploys
+    model_registry = get_model_registry()
+    await model_registry.startup()
+    model_registry.start()
+    
+    from app.services.batch_scheduler import get_inference_scheduler
+    # Start the batching worker that groups requests into forward passes
+    get_inference_scheduler().start()
+    
+    from app.models.database import get_write_queue
+    # Start the write-behind queue that bulk inserts prediction rows
+    get_write_queue().start()
+    
+    from app.services.upload_reaper import get_upload_reaper
+    # Expire old uploads in the background
+    get_upload_reaper().start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    logger.info("Shutting down Brain Tumor Detection API") 
\ No newline at end of file
+    logger.info("Shutting down Brain Tumor Detection API")
+    
+    from app.services.upload_reaper import get_upload_reaper
+    await get_upload_reaper().stop()
+    
+    from app.services.model_registry import get_model_registry
+    await get_model_registry().stop()
+    
+    from app.services.batch_scheduler import get_inference_scheduler
+    await get_inference_scheduler().stop()
+    
+    from app.models.database import get_write_queue
+    # Write out every queued row before exiting
+    await get_write_queue().stop()
+    
+    from app.models.database import get_worker_id_lease
+    await get_worker_id_lease().stop()
+    
+    from app.services.executor import shutdown_executors
+    shutdown_executors()
+    
+    from app.services.prediction_cache import get_prediction_cache
+    get_prediction_cache().close()
+    
+    from app.services.embedding_index import get_embedding_store
+    get_embedding_store().close() 
\ No newline at end of file
@@ -1,17 +1,82 @@
+import os
+import json
+import math
+import asyncio
 import datetime
-from sqlalchemy import Column, Integer, String, Float, DateTime, create_engine
+import logging
+import socket
+import threading
+import time
+import uuid
+from sqlalchemy import BigInteger, Column, Integer, String, Float, Date, DateTime, Index, select, create_engine, event, insert, inspect, text
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError, StatementError
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 
+from app.services.executor import QueueFullError
+from app.services.metrics import observe_stage
 from app.utils.config import settings
 
+logger = logging.getLogger(__name__)
+
+def _is_memory_sqlite(url) -> bool:
+    return url.database in (None, "", ":memory:") or "mode=memory" in str(url)
+
+def engine_options(database_url: str):
+    """URL and create_async_engine keyword arguments for the configured backend"""
+    url = make_url(database_url)
+    
+    if url.get_backend_name() == "sqlite":
+        options = {"connect_args": {"timeout": settings.SQLITE_BUSY_TIMEOUT_MS / 1000.0}}
+        if _is_memory_sqlite(url):
+            # Every connection to :memory: is a new database, so share a single one
+            options["poolclass"] = StaticPool
+            options["connect_args"]["check_same_thread"] = False
+        else:
+            # Keep a few connections open; WAL lets readers run next to the writer
+            options["pool_size"] = settings.SQLITE_POOL_SIZE
+            options["max_overflow"] = 0
+            options["pool_timeout"] = settings.DB_POOL_TIMEOUT
+        return url, options
+    
+    options = {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+    }
+    if url.get_driver_name() == "asyncpg" and "prepared_statement_cache_size" not in url.query:
+        # Reuse prepared statements across executions of the same query
+        # (set to 0 behind PgBouncer in transaction pooling mode)
+        url = url.update_query_dict({"prepared_statement_cache_size": str(settings.DB_STATEMENT_CACHE_SIZE)})
+        options["connect_args"] = {"statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE}
+    return url, options
+
+def _configure_sqlite(dbapi_connection, connection_record):
+    """Per-connection pragmas for the SQLite backend"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # WAL is durable across application crashes with NORMAL; FULL adds an fsync per commit
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
 # Create async engine
+_engine_url, _engine_options = engine_options(settings.DATABASE_URL)
 engine = create_async_engine(
-    settings.DATABASE_URL,
+    _engine_url,
     echo=False,
+    **_engine_options
 )
+if engine.dialect.name == "sqlite":
+    event.listen(engine.sync_engine, "connect", _configure_sqlite)
 
 # Create session factory
 async_session = sessionmaker(
@@ -21,11 +86,14 @@ async_session = sessionmaker(
 # Create base class for models
 Base = declarative_base()
 
+# 64-bit ids on Postgres; SQLite only auto-increments INTEGER primary keys
+IdType = BigInteger().with_variant(Integer, "sqlite")
+
 # Define models
 class Prediction(Base):
     __tablename__ = "predictions"
     
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(IdType, primary_key=True, index=True)
     filename = Column(String, index=True)
     prediction = Column(String)  # "tumor" or "no_tumor"
     confidence = Column(Float)
@@ -33,20 +101,691 @@ class Prediction(Base):
     processing_time = Column(Float)
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
     user_session = Column(String, index=True)
+    image_hash = Column(String(64), index=True, nullable=True)  # StoredImage.sha256 of the upload
+    model_version = Column(String(64), index=True, nullable=True)  # ModelVersion.version that made the prediction
+    
+    __table_args__ = (
+        # Keyset pagination of history, newest first, overall and per session
+        Index("ix_predictions_timestamp_id", "timestamp", "id"),
+        Index("ix_predictions_user_session_timestamp", "user_session", "timestamp", "id"),
+    )
     
 class Feedback(Base):
     __tablename__ = "feedback"
     
-    id = Column(Integer, primary_key=True, index=True)
-    prediction_id = Column(Integer, index=True)
+    id = Column(IdType, primary_key=True, index=True)
+    prediction_id = Column(IdType, index=True)
     is_correct = Column(Integer)  # 1 for correct, 0 for incorrect
     comment = Column(String, nullable=True)
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
 
+class StoredImage(Base):
+    """One stored upload per distinct content, shared by every prediction of it"""
+    __tablename__ = "images"
+    
+    sha256 = Column(String(64), primary_key=True)
+    extension = Column(String(8))
+    size = Column(Integer)
+    ref_count = Column(Integer, default=0)  # Predictions whose image_hash points here
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    last_referenced_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class ModelVersion(Base):
+    """A checkpoint the service has loaded, with its load and warmup measurements"""
+    __tablename__ = "model_versions"
+    
+    version = Column(String(64), primary_key=True)  # Short content hash of the checkpoint
+    path = Column(String)
+    backend = Column(String(32))
+    load_seconds = Column(Float)
+    latency = Column(String)  # JSON: forward pass milliseconds by batch size
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    activated_at = Column(DateTime, nullable=True)
+    is_active = Column(Integer, default=0, index=True)  # 1 for the version every worker should serve
+
+class IdWorker(Base):
+    """Lease on one of the worker tags embedded in generated ids, see WorkerIdLease"""
+    __tablename__ = "id_workers"
+    
+    worker_id = Column(Integer, primary_key=True, autoincrement=False)
+    owner = Column(String(128), nullable=True)  # host:pid:nonce of the holder
+    expires_at = Column(DateTime)
+
+class DailyPredictionStats(Base):
+    """Predictions per day and class, updated as predictions are written"""
+    __tablename__ = "stats_daily_predictions"
+    
+    day = Column(Date, primary_key=True)
+    prediction = Column(String(16), primary_key=True)
+    count = Column(Integer, default=0)
+    confidence_sum = Column(Float, default=0.0)
+    processing_time_sum = Column(Float, default=0.0)
+
+class DailyLatencyHistogram(Base):
+    """Predictions per day and processing time bucket, see latency_bucket()"""
+    __tablename__ = "stats_daily_latency"
+    
+    day = Column(Date, primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    count = Column(Integer, default=0)
+
+class FeedbackStats(Base):
+    """Feedback outcomes per predicted class and confidence bucket, see confidence_bucket()"""
+    __tablename__ = "stats_feedback"
+    
+    prediction = Column(String(16), primary_key=True)
+    confidence_bucket = Column(Integer, primary_key=True)
+    correct = Column(Integer, default=0)
+    incorrect = Column(Integer, default=0)
+    confidence_sum = Column(Float, default=0.0)
+
+# Stats buckets: confidence in 0.05 steps, processing time on a log scale
+# where each bucket is about 9% wider than the previous one
+CONFIDENCE_BUCKET_WIDTH = 0.05
+CONFIDENCE_BUCKETS = 20
+LATENCY_BUCKET_BASE_MS = 0.1
+LATENCY_BUCKET_GROWTH = 2 ** 0.125
+
+def confidence_bucket(confidence: float) -> int:
+    return min(max(int(confidence / CONFIDENCE_BUCKET_WIDTH), 0), CONFIDENCE_BUCKETS - 1)
+
+def latency_bucket(seconds: float) -> int:
+    """0 for at most LATENCY_BUCKET_BASE_MS, else b for (base * growth**(b-1), base * growth**b] ms"""
+    milliseconds = seconds * 1000.0
+    if milliseconds <= LATENCY_BUCKET_BASE_MS:
+        return 0
+    return math.ceil(math.log(milliseconds / LATENCY_BUCKET_BASE_MS, LATENCY_BUCKET_GROWTH))
+
+class StatsDelta:
+    """Increments to the stats tables from a set of predictions and feedback.
+    
+    The write-behind queue applies one per flush, in the flush transaction,
+    so the aggregates always match the rows that were written.
+    """
+    
+    def __init__(self):
+        self.daily = {}  # (day, class) -> [count, confidence_sum, processing_time_sum]
+        self.latency = {}  # (day, bucket) -> count
+        self.feedback = {}  # (class, confidence bucket) -> [correct, incorrect, confidence_sum]
+    
+    def __bool__(self):
+        return bool(self.daily or self.latency or self.feedback)
+    
+    def add_prediction(self, timestamp, prediction, confidence, processing_time):
+        day = timestamp.date()
+        totals = self.daily.setdefault((day, prediction), [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += confidence or 0.0
+        if processing_time is not None:
+            totals[2] += processing_time
+            key = (day, latency_bucket(processing_time))
+            self.latency[key] = self.latency.get(key, 0) + 1
+    
+    def add_feedback(self, prediction, confidence, is_correct):
+        totals = self.feedback.setdefault((prediction, confidence_bucket(confidence or 0.0)), [0, 0, 0.0])
+        totals[0 if is_correct else 1] += 1
+        totals[2] += confidence or 0.0
+    
+    async def apply(self, conn):
+        """Add the increments to the stats tables, creating missing rows"""
+        if self.daily:
+            await _upsert_sums(conn, DailyPredictionStats.__table__, ["day", "prediction"], [
+                {"day": day, "prediction": prediction, "count": count,
+                 "confidence_sum": confidence_sum, "processing_time_sum": processing_time_sum}
+                for (day, prediction), (count, confidence_sum, processing_time_sum) in self.daily.items()
+            ])
+        if self.latency:
+            await _upsert_sums(conn, DailyLatencyHistogram.__table__, ["day", "bucket"], [
+                {"day": day, "bucket": bucket, "count": count}
+                for (day, bucket), count in self.latency.items()
+            ])
+        if self.feedback:
+            await _upsert_sums(conn, FeedbackStats.__table__, ["prediction", "confidence_bucket"], [
+                {"prediction": prediction, "confidence_bucket": bucket, "correct": correct,
+                 "incorrect": incorrect, "confidence_sum": confidence_sum}
+                for (prediction, bucket), (correct, incorrect, confidence_sum) in self.feedback.items()
+            ])
+
+async def _upsert_sums(conn, table, keys, rows):
+    """Insert rows, or add their values to the existing rows with the same keys"""
+    upsert = postgresql_insert if conn.dialect.name == "postgresql" else sqlite_insert
+    statement = upsert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c[key] for key in keys],
+        set_={
+            column.name: column + statement.excluded[column.name]
+            for column in table.columns if column.name not in keys
+        }
+    )
+    await conn.execute(statement, rows)
+
 # Database initialization function
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        # create_all skips existing tables, so add columns and indexes introduced later
+        await conn.run_sync(_add_missing_columns)
+        await conn.run_sync(_create_missing_indexes)
+        await _widen_id_columns(conn)
+
+def _add_missing_columns(sync_conn):
+    inspector = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=sync_conn.dialect)
+            logger.info(f"Adding column {table.name}.{column.name}")
+            sync_conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+def _create_missing_indexes(sync_conn):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+async def _widen_id_columns(conn):
+    """Client-generated ids need 64-bit columns on databases created before they existed"""
+    if conn.dialect.name != "postgresql":
+        return
+    for table, column in (("predictions", "id"), ("feedback", "id"), ("feedback", "prediction_id")):
+        data_type = (await conn.execute(text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_name = :table AND column_name = :column"
+        ), {"table": table, "column": column})).scalar()
+        if data_type == "integer":
+            logger.info(f"Widening {table}.{column} to BIGINT")
+            await conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT"))
+
+# Client-side ids: milliseconds since ID_EPOCH in the high bits, then an 8-bit
+# worker tag leased from the id_workers table and a 4-bit sequence. Ids are
+# time-ordered, unique across every process sharing the database, and stay
+# below 2**53, so JavaScript clients can hold them exactly.
+ID_EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+ID_WORKER_BITS = 8
+ID_SEQUENCE_BITS = 4
+ID_WORKERS = 1 << ID_WORKER_BITS
+_id_lock = threading.Lock()
+_id_state = {"pid": None, "worker": None, "expires": 0.0, "ms": 0, "seq": 0}
+
+def generate_id() -> int:
+    """Generate a unique, time-ordered 53-bit primary key without a database round trip.
+    
+    Needs a worker tag leased by WorkerIdLease in this process; raises
+    RuntimeError rather than risk a duplicate when there is none.
+    """
+    with _id_lock:
+        state = _id_state
+        if state["pid"] != os.getpid() or state["worker"] is None:
+            # Forked workers must lease their own tag
+            raise RuntimeError("No worker id leased in this process, see WorkerIdLease")
+        if time.monotonic() > state["expires"]:
+            raise RuntimeError(f"Worker id {state['worker']} lease expired without renewal")
+        now_ms = int(time.time() * 1000) - ID_EPOCH_MS
+        if now_ms <= state["ms"]:
+            now_ms = state["ms"]
+            state["seq"] += 1
+            if state["seq"] >> ID_SEQUENCE_BITS:
+                # Sequence exhausted for this millisecond, borrow the next one
+                now_ms += 1
+                state["seq"] = 0
+        else:
+            state["seq"] = 0
+        state["ms"] = now_ms
+        return (now_ms << (ID_WORKER_BITS + ID_SEQUENCE_BITS)) | (state["worker"] << ID_SEQUENCE_BITS) | state["seq"]
+
+def _set_worker_id(worker_id, expires: float):
+    with _id_lock:
+        if _id_state["worker"] != worker_id or _id_state["pid"] != os.getpid():
+            _id_state["seq"] = 0
+        _id_state.update(pid=os.getpid(), worker=worker_id, expires=expires)
+
+class WorkerIdLease:
+    """Leases one of the ID_WORKERS tags that generate_id embeds in every id.
+    
+    A tag is claimed with a conditional UPDATE on an expired id_workers row,
+    so two processes can never hold the same one, and renewed every third of
+    ttl seconds. The least recently released tag is claimed first.
+    """
+    
+    def __init__(self, engine, ttl: float):
+        self._engine = engine
+        self._ttl = max(3.0, ttl)
+        self._owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.worker_id = None
+        self._worker = None
+    
+    async def acquire(self) -> int:
+        """Claim a free tag and hand it to generate_id"""
+        claim_start = time.monotonic()
+        now = datetime.datetime.utcnow()
+        async with self._engine.begin() as conn:
+            existing = set((await conn.execute(select(IdWorker.worker_id))).scalars().all())
+            missing = [worker_id for worker_id in range(ID_WORKERS) if worker_id not in existing]
+            if missing:
+                upsert = postgresql_insert if conn.dialect.name == "postgresql" else sqlite_insert
+                await conn.execute(upsert(IdWorker.__table__).on_conflict_do_nothing(), [
+                    {"worker_id": worker_id, "owner": None, "expires_at": datetime.datetime(1970, 1, 1)}
+                    for worker_id in missing
+                ])
+        async with self._engine.begin() as conn:
+            candidates = (await conn.execute(
+                select(IdWorker.worker_id).where(IdWorker.expires_at < now).order_by(IdWorker.expires_at)
+            )).scalars().all()
+            for worker_id in candidates:
+                claimed = await conn.execute(
+                    IdWorker.__table__.update()
+                    .where(IdWorker.worker_id == worker_id, IdWorker.expires_at < now)
+                    .values(owner=self._owner, expires_at=now + datetime.timedelta(seconds=self._ttl))
+                )
+                if claimed.rowcount == 1:
+                    break
+            else:
+                raise RuntimeError(f"All {ID_WORKERS} worker ids are leased, cannot generate ids")
+        self.worker_id = worker_id
+        _set_worker_id(worker_id, claim_start + self._ttl)
+        logger.info(f"Leased worker id {worker_id} as {self._owner}")
+        return worker_id
+    
+    async def renew(self):
+        """Extend the lease, or claim a new tag if another process took this one"""
+        renew_start = time.monotonic()
+        async with self._engine.begin() as conn:
+            renewed = await conn.execute(
+                IdWorker.__table__.update()
+                .where(IdWorker.worker_id == self.worker_id, IdWorker.owner == self._owner)
+                .values(expires_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=self._ttl))
+            )
+        if renewed.rowcount == 1:
+            _set_worker_id(self.worker_id, renew_start + self._ttl)
+            return
+        logger.error(f"Lost the lease on worker id {self.worker_id}, claiming another")
+        await self.acquire()
+    
+    def start(self):
+        """Renew the lease in the background on the running event loop"""
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+    
+    async def stop(self):
+        """Stop renewing and release the tag for other processes"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self.worker_id is None:
+            return
+        _set_worker_id(None, 0.0)
+        try:
+            async with self._engine.begin() as conn:
+                await conn.execute(
+                    IdWorker.__table__.update()
+                    .where(IdWorker.worker_id == self.worker_id, IdWorker.owner == self._owner)
+                    .values(owner=None, expires_at=datetime.datetime.utcnow())
+                )
+        except Exception as e:
+            logger.warning(f"Could not release worker id {self.worker_id}: {str(e)}")
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._ttl / 3)
+            try:
+                await self.renew()
+            except Exception as e:
+                logger.error(f"Error renewing worker id lease: {str(e)}")
+
+_worker_id_lease = None
+
+# Singleton instance getter
+def get_worker_id_lease():
+    global _worker_id_lease
+    if _worker_id_lease is None:
+        _worker_id_lease = WorkerIdLease(engine, settings.ID_LEASE_TTL)
+    return _worker_id_lease
+
+def _is_row_error(error: Exception) -> bool:
+    """True when a write failed because of the row itself, so retrying it cannot succeed"""
+    if isinstance(error, (IntegrityError, DataError)):
+        return True
+    # Raised before the statement reached the database, e.g. a value of the wrong type
+    return isinstance(error, StatementError) and not isinstance(error, DBAPIError)
+
+class WriteBehindQueue:
+    """Buffers Prediction and Feedback inserts and writes them in bulk.
+    
+    Rows are flushed when WRITE_BEHIND_BATCH_SIZE rows are pending or
+    WRITE_BEHIND_MAX_DELAY_MS after the first pending row, whichever comes
+    first, and once more on shutdown. Rows carry client-generated ids, so
+    callers can answer before the commit.
+    
+    When a bulk write fails the rows are retried one at a time: rows the
+    database rejects are set aside in dead_letter_path, the others go back
+    in the queue. Producers call check_capacity() first and are refused
+    once max_pending rows are waiting.
+    """
+    
+    def __init__(self, engine, batch_size: int, max_delay_ms: float, copy_threshold: int = 0,
+                 max_pending: int = 0, dead_letter_path: str = ""):
+        self._engine = engine
+        self._batch_size = max(1, batch_size)
+        self._max_delay = max(0.0, max_delay_ms) / 1000.0
+        self._copy_threshold = copy_threshold
+        self._max_pending = max_pending
+        self._dead_letter_path = dead_letter_path
+        self._pending = {Prediction.__table__: [], Feedback.__table__: []}
+        self._pending_prediction_ids = set()
+        self._pending_image_refs = {}
+        self._oldest_pending = None
+        self._has_rows = None
+        self._full = None
+        self._flush_lock = None
+        self._worker = None
+        self._stats = {"flushes": 0, "rows_written": 0, "rows_rejected": 0, "errors": 0}
+    
+    @property
+    def pending_count(self) -> int:
+        return sum(len(rows) for rows in self._pending.values()) + len(self._pending_image_refs)
+    
+    @property
+    def stats(self) -> dict:
+        return {**self._stats, "pending": self.pending_count}
+    
+    def start(self):
+        """Start the background flush loop on the running event loop"""
+        if self._worker is not None and not self._worker.done():
+            return
+        self._has_rows = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+    
+    async def stop(self):
+        """Stop the flush loop and write everything still pending.
+        
+        Rows that still cannot be written are set aside in dead_letter_path,
+        since their ids have already been returned to clients.
+        """
+        if self._worker is not None:
+            # Cancel the loop between flushes; a flush in progress owns its rows
+            async with self._flush_lock:
+                self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        await self.flush()
+        if self.pending_count:
+            logger.error(f"Write-behind queue stopped with {self.pending_count} unwritten rows")
+            rows = self._rows(self._pending, self._pending_image_refs)
+            for table in self._pending:
+                self._pending[table] = []
+            self._pending_image_refs = {}
+            self._oldest_pending = None
+            self._pending_prediction_ids.clear()
+            for table, row in rows:
+                self._set_aside(table, row, "not written before shutdown")
+    
+    def check_capacity(self):
+        """Raise QueueFullError when max_pending rows are already waiting to be written"""
+        if self._max_pending and self.pending_count >= self._max_pending:
+            raise QueueFullError(f"{self.pending_count} rows are waiting to be written to the database")
+    
+    def _add(self, table, row: dict):
+        if self._worker is None or self._worker.done():
+            self.start()
+        self._pending[table].append(row)
+        if self._oldest_pending is None:
+            self._oldest_pending = time.monotonic()
+        self._has_rows.set()
+        if self.pending_count >= self._batch_size:
+            self._full.set()
+    
+    def add_prediction(self, **values) -> int:
+        """Queue a Prediction insert and return its id"""
+        if "id" not in values:
+            values["id"] = generate_id()
+        values.setdefault("timestamp", datetime.datetime.utcnow())
+        values.setdefault("image_hash", None)
+        values.setdefault("model_version", None)
+        self._pending_prediction_ids.add(values["id"])
+        self._add(Prediction.__table__, values)
+        return values["id"]
+    
+    def add_feedback(self, **values) -> int:
+        """Queue a Feedback insert and return its id"""
+        if "id" not in values:
+            values["id"] = generate_id()
+        values.setdefault("timestamp", datetime.datetime.utcnow())
+        values.setdefault("comment", None)
+        self._add(Feedback.__table__, values)
+        return values["id"]
+    
+    def add_image_reference(self, sha256: str, extension: str, size: int):
+        """Count one more reference to a stored image; references are merged per flush"""
+        reference = self._pending_image_refs.get(sha256)
+        if reference is None:
+            self._pending_image_refs[sha256] = {"extension": extension, "size": size, "count": 1}
+        else:
+            reference["count"] += 1
+        if self._worker is None or self._worker.done():
+            self.start()
+        if self._oldest_pending is None:
+            self._oldest_pending = time.monotonic()
+        self._has_rows.set()
+    
+    def has_pending_prediction(self, prediction_id: int) -> bool:
+        """True if the prediction is queued but not written yet"""
+        return prediction_id in self._pending_prediction_ids
+    
+    async def _run(self):
+        while True:
+            await self._has_rows.wait()
+            # Give a partially filled batch until the deadline to grow
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self._max_delay)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+            if self.pending_count:
+                # Failed flush: back off one interval before retrying
+                await asyncio.sleep(self._max_delay)
+    
+    async def flush(self):
+        """Write all pending rows now, in one transaction"""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            batches = {table: rows for table, rows in self._pending.items() if rows}
+            image_refs = self._pending_image_refs
+            if not batches and not image_refs:
+                return
+            for table in batches:
+                self._pending[table] = []
+            self._pending_image_refs = {}
+            oldest = self._oldest_pending
+            self._oldest_pending = None
+            self._has_rows.clear()
+            self._full.clear()
+            
+            flush_start = time.perf_counter()
+            try:
+                async with self._engine.begin() as conn:
+                    await self._write_batch(conn, batches, image_refs)
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.error(f"Error flushing write-behind queue, writing rows one at a time: {str(e)}")
+                await self._write_separately(batches, image_refs, oldest)
+                return
+            except BaseException:
+                # Cancelled mid-write: the transaction rolls back, so keep the rows
+                self._requeue(self._rows(batches, image_refs), oldest)
+                raise
+            
+            observe_stage("db_write", time.perf_counter() - flush_start)
+            written = sum(len(rows) for rows in batches.values()) + len(image_refs)
+            self._stats["flushes"] += 1
+            self._stats["rows_written"] += written
+            for row in batches.get(Prediction.__table__, []):
+                self._pending_prediction_ids.discard(row["id"])
+    
+    async def flush_if_stale(self):
+        """Flush only if the oldest pending row has waited longer than the max delay.
+        
+        Readers call this rather than flush(): they see every row the flush
+        loop should already have written, without breaking up the batch
+        that is still filling.
+        """
+        if self._oldest_pending is not None and time.monotonic() - self._oldest_pending >= self._max_delay:
+            await self.flush()
+    
+    async def _write_batch(self, conn, batches, image_refs):
+        # Predictions first, feedback may reference them
+        for table in (Prediction.__table__, Feedback.__table__):
+            rows = batches.get(table)
+            if rows:
+                await self._write(conn, table, rows)
+        if image_refs:
+            await self._write_image_refs(conn, image_refs)
+        await self._write_stats(
+            conn, batches.get(Prediction.__table__, []), batches.get(Feedback.__table__, [])
+        )
+    
+    async def _write_separately(self, batches, image_refs, queued_at: float):
+        """Write each row in its own transaction after a bulk write failed.
+        
+        A row the database rejects is set aside. Any other error means the
+        database is unavailable, so that row and everything after it are put
+        back in front of the queue.
+        """
+        rows = self._rows(batches, image_refs)
+        for position, (table, row) in enumerate(rows):
+            try:
+                async with self._engine.begin() as conn:
+                    if table is StoredImage.__table__:
+                        await self._write_image_refs(conn, {row["sha256"]: row})
+                    else:
+                        await self._write_batch(conn, {table: [row]}, {})
+                self._stats["rows_written"] += 1
+            except Exception as e:
+                if not _is_row_error(e):
+                    logger.error(f"Error writing row to {table.name}, will retry: {str(e)}")
+                    self._requeue(rows[position:], queued_at)
+                    return
+                self._set_aside(table, row, e)
+            except BaseException:
+                self._requeue(rows[position:], queued_at)
+                raise
+            if table is Prediction.__table__:
+                self._pending_prediction_ids.discard(row["id"])
+    
+    @staticmethod
+    def _rows(batches, image_refs):
+        """(table, row) pairs of a batch, in write order"""
+        rows = [(table, row) for table in (Prediction.__table__, Feedback.__table__) for row in batches.get(table, [])]
+        rows += [(StoredImage.__table__, {"sha256": sha256, **reference}) for sha256, reference in image_refs.items()]
+        return rows
+    
+    def _requeue(self, rows, queued_at: float):
+        """Put rows back in front of anything queued since"""
+        if queued_at is None:
+            queued_at = time.monotonic()
+        if self._oldest_pending is None or queued_at < self._oldest_pending:
+            self._oldest_pending = queued_at
+        for table in (Prediction.__table__, Feedback.__table__):
+            self._pending[table] = [row for row_table, row in rows if row_table is table] + self._pending[table]
+        for table, row in rows:
+            if table is StoredImage.__table__:
+                merged = self._pending_image_refs.setdefault(row["sha256"], {**row, "count": 0})
+                merged.pop("sha256", None)
+                merged["count"] += row["count"]
+        self._has_rows.set()
+    
+    def _set_aside(self, table, row, error):
+        """Record a row the database rejected so it is not retried forever"""
+        self._stats["rows_rejected"] += 1
+        logger.error(f"Database rejected a {table.name} row, setting it aside: {str(error)}")
+        if not self._dead_letter_path:
+            return
+        try:
+            with open(self._dead_letter_path, "a") as dead_letters:
+                dead_letters.write(json.dumps({"table": table.name, "error": str(error), "row": row}, default=str) + "\n")
+        except OSError as e:
+            logger.error(f"Could not write {self._dead_letter_path}: {str(e)}")
+    
+    async def _write(self, conn, table, rows):
+        if self._copy_threshold and len(rows) >= self._copy_threshold and conn.dialect.driver == "asyncpg":
+            # COPY is the fastest bulk path on Postgres
+            columns = list(rows[0].keys())
+            raw = await conn.get_raw_connection()
+            await raw.driver_connection.copy_records_to_table(
+                table.name,
+                records=[tuple(row.get(column) for column in columns) for row in rows],
+                columns=columns
+            )
+        else:
+            # executemany, which SQLAlchemy sends as multi-row INSERTs
+            await conn.execute(insert(table), rows)
+
+    async def _write_stats(self, conn, predictions, feedback):
+        """Fold the predictions and feedback of this flush into the stats aggregates"""
+        delta = StatsDelta()
+        for row in predictions:
+            delta.add_prediction(row["timestamp"], row["prediction"], row["confidence"], row["processing_time"])
+        if feedback:
+            # The predictions were written earlier or above, in this transaction
+            predicted = dict((row.id, row) for row in (await conn.execute(
+                select(Prediction.id, Prediction.prediction, Prediction.confidence)
+                .where(Prediction.id.in_({row["prediction_id"] for row in feedback}))
+            )).all())
+            for row in feedback:
+                prediction = predicted.get(row["prediction_id"])
+                if prediction is not None:
+                    delta.add_feedback(prediction.prediction, prediction.confidence, row["is_correct"])
+        if delta:
+            await delta.apply(conn)
+
+    async def _write_image_refs(self, conn, image_refs):
+        """Create or bump the reference count of each stored image in one upsert"""
+        upsert = postgresql_insert if conn.dialect.name == "postgresql" else sqlite_insert
+        now = datetime.datetime.utcnow()
+        statement = upsert(StoredImage.__table__)
+        statement = statement.on_conflict_do_update(
+            index_elements=[StoredImage.sha256],
+            set_={
+                "ref_count": StoredImage.__table__.c.ref_count + statement.excluded.ref_count,
+                "last_referenced_at": statement.excluded.last_referenced_at
+            }
+        )
+        await conn.execute(statement, [
+            {
+                "sha256": sha256,
+                "extension": reference["extension"],
+                "size": reference["size"],
+                "ref_count": reference["count"],
+                "created_at": now,
+                "last_referenced_at": now
+            }
+            for sha256, reference in image_refs.items()
+        ])
+
+_write_queue = None
+
+def get_write_queue():
+    global _write_queue
+    if _write_queue is None:
+        _write_queue = WriteBehindQueue(
+            engine,
+            batch_size=settings.WRITE_BEHIND_BATCH_SIZE,
+            max_delay_ms=settings.WRITE_BEHIND_MAX_DELAY_MS,
+            copy_threshold=settings.WRITE_BEHIND_COPY_THRESHOLD,
+            max_pending=settings.WRITE_BEHIND_MAX_PENDING,
+            dead_letter_path=settings.WRITE_BEHIND_DEAD_LETTER_PATH
+        )
+    return _write_queue
 
 # Get database session
 async def get_db():
@@ -0,0 +1,104 @@
+"""Prepare MODEL_PATH for fast, read-only startup.
+
+Converts a checkpoint into a plain state dict that can be memory-mapped,
+writes its SHA-256 sidecar and compiles the inference backend artifacts,
+so that API workers never download, convert or write anything at boot.
+
+Usage (from the backend directory):
+    python -m app.prepare_model --source training_checkpoint.pth
+    python -m app.prepare_model --source old_checkpoint.pth --allow-pickle   # trusted files only
+    python -m app.prepare_model --init-pretrained     # needs network access
+    python -m app.prepare_model --backends torchscript int8_static
+"""
+import os
+import sys
+import argparse
+import logging
+
+import torch
+
+from app.services.model_service import (
+    BrainTumorClassifier,
+    _file_sha256,
+    load_calibration_inputs,
+    read_checkpoint,
+    version_sidecar_path,
+)
+from app.services.inference_backends import BACKENDS, build_backend
+from app.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def write_weights(state_dict, model_path: str):
+    """Save a state dict atomically in the zip format that torch.load can memory-map"""
+    directory = os.path.dirname(model_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = f"{model_path}.tmp{os.getpid()}"
+    torch.save(state_dict, tmp)
+    os.replace(tmp, model_path)
+    logger.info(f"Wrote prepared weights to {model_path}")
+
+
+def write_version(model_path: str) -> str:
+    """Hash the weights file and store the digest next to it"""
+    digest = _file_sha256(model_path)
+    with open(version_sidecar_path(model_path), "w") as f:
+        f.write(f"{digest}  {os.path.basename(model_path)}\n")
+    return digest[:16]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", help="Checkpoint to convert (default: MODEL_PATH itself)")
+    parser.add_argument("--output", default=settings.MODEL_PATH, help="Prepared weights path")
+    parser.add_argument("--init-pretrained", action="store_true",
+                        help="Create an ImageNet-initialized model if the output does not exist")
+    parser.add_argument("--allow-pickle", action="store_true",
+                        help="Fully unpickle a trusted --source that holds more than tensors")
+    parser.add_argument("--backends", nargs="*", default=[settings.INFERENCE_BACKEND], choices=BACKENDS,
+                        help="Backends to compile and cache")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    source = args.source or args.output
+    model = BrainTumorClassifier(pretrained=False)
+    if os.path.exists(source):
+        model.load_state_dict(read_checkpoint(source, allow_pickle=args.allow_pickle or None))
+    elif args.init_pretrained:
+        logger.info("Creating a model from ImageNet-pretrained weights")
+        model = BrainTumorClassifier(pretrained=True)
+    else:
+        logger.error(f"Checkpoint not found at {source}. Pass --source or --init-pretrained.")
+        return 1
+    model.eval()
+
+    # Always rewrite, so legacy pickles and training checkpoints become mmap-able
+    write_weights(model.state_dict(), args.output)
+    model_version = write_version(args.output)
+    logger.info(f"Model version {model_version}")
+
+    calibration = load_calibration_inputs()
+
+    failed = False
+    for name in args.backends:
+        if name == "eager" and not settings.CHANNELS_LAST:
+            continue
+        # Compiled artifacts are loaded back from disk before the parity check
+        backend, parity = build_backend(
+            name, model, args.output, model_version,
+            channels_last=settings.CHANNELS_LAST, calibration=calibration, save_artifacts=True
+        )
+        if backend.name != name:
+            logger.error(
+                f"Backend {name} could not be built or failed its parity check "
+                f"({parity}); workers configured with it would serve eager"
+            )
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
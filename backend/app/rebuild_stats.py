@@ -0,0 +1,47 @@
+"""Recompute the /api/stats aggregates from the predictions and feedback tables.
+
+The aggregates are normally kept up to date as rows are written; rebuild
+them after importing or deleting rows directly in the database, or when
+the stats tables are first added to an existing database.
+
+Usage (from the backend directory):
+    python -m app.rebuild_stats
+"""
+import sys
+import asyncio
+import argparse
+import logging
+
+from app.models.database import engine, init_db
+from app.services.quality_stats import rebuild_stats
+from app.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+async def rebuild(fetch_size: int):
+    await init_db()
+    try:
+        return await rebuild_stats(engine, fetch_size)
+    finally:
+        await engine.dispose()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fetch-size", type=int, default=settings.EXPORT_FETCH_SIZE,
+                        help="Rows read from the database at a time")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    try:
+        asyncio.run(rebuild(args.fetch_size))
+    except Exception as e:
+        logger.error(f"Error rebuilding stats: {str(e)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,268 @@
+import asyncio
+import heapq
+import itertools
+import time
+import logging
+from dataclasses import dataclass, field
+
+import torch
+
+from app.services.model_service import get_model_service
+from app.services.executor import QueueFullError, get_inference_executor
+from app.services.metrics import BATCH_SIZE, observe_stage
+from app.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _PendingRequest:
+    tensor: torch.Tensor  # One row per image or test-time augmentation view
+    future: asyncio.Future
+    ensemble: bool = False
+    explain: bool = False  # Grad-CAM for the first row
+    flow: str = ""  # Client the request is scheduled for, see rate_limit.client_key
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+    @property
+    def rows(self) -> int:
+        return self.tensor.shape[0]
+
+
+class InferenceScheduler:
+    """Groups concurrent inference requests into batched forward passes.
+
+    max_batch_size counts tensor rows, so a request with several
+    test-time augmentation views takes that many places in a batch.
+
+    Waiting requests are served in weighted fair order across clients
+    (self-clocked fair queueing): each request is tagged with the virtual
+    time at which its client's share of the model would have processed it,
+    rows / weight after the client's previous request, and batches are
+    filled by smallest tag. A client flooding the queue only delays its own
+    requests; a client with a single request waits at most about one batch.
+    """
+
+    def __init__(self, model_service, executor, max_batch_size: int, max_wait_ms: float,
+                 max_queue_size: int = 0, max_concurrent_batches: int = 1, weights: dict = None):
+        self._model_service = model_service
+        self._executor = executor
+        self._max_batch_size = max(1, max_batch_size)
+        self._max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._max_queue_size = max(0, max_queue_size)
+        self._max_concurrent_batches = max(1, max_concurrent_batches)
+        self._weights = {flow: weight for flow, weight in (weights or {}).items() if weight > 0}
+        self._heap = []  # (virtual finish time, sequence, request)
+        self._sequence = itertools.count()
+        self._virtual_time = 0.0
+        self._flow_finish = {}  # Virtual finish time of each waiting client's last request
+        self._flow_pending = {}
+        self._not_empty = None
+        self._worker = None
+        self._batch_slots = None
+        self._batch_tasks = set()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._heap)
+
+    @property
+    def active_flows(self) -> int:
+        """Clients with requests waiting"""
+        return len(self._flow_pending)
+
+    def start(self):
+        """Start the batching worker on the running event loop"""
+        if self._worker is not None and not self._worker.done():
+            return
+        self._not_empty = asyncio.Event()
+        if self._heap:
+            self._not_empty.set()
+        self._batch_slots = asyncio.Semaphore(self._max_concurrent_batches)
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+        logger.info(
+            f"Inference scheduler started (max_batch_size={self._max_batch_size}, "
+            f"max_wait_ms={self._max_wait * 1000:.1f})"
+        )
+
+    async def stop(self):
+        """Stop the batching worker and fail any requests still queued"""
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+
+        # Let batches already running finish
+        if self._batch_tasks:
+            await asyncio.gather(*self._batch_tasks, return_exceptions=True)
+
+        self._fail_stopped([self._pop() for _ in range(len(self._heap))])
+        logger.info("Inference scheduler stopped")
+
+    @staticmethod
+    def _fail_stopped(batch):
+        for pending in batch:
+            if not pending.future.done():
+                pending.future.set_exception(RuntimeError("Inference scheduler stopped"))
+
+    async def submit(self, tensor, ensemble: bool = False, explain: bool = False, flow: str = ""):
+        """Queue a preprocessed (N, C, H, W) tensor and wait for its scores.
+
+        The result holds one score per row, or per row and ensemble model
+        when ensemble is set, in "scores", and with explain the Grad-CAM
+        map of the first row in "cam". "model_version" names the model
+        that ran the batch. flow identifies the client for fair scheduling.
+        """
+        if self._worker is None or self._worker.done():
+            self.start()
+
+        if self._max_queue_size and len(self._heap) >= self._max_queue_size:
+            raise QueueFullError(f"Inference queue is full ({self._max_queue_size} pending)")
+        future = asyncio.get_running_loop().create_future()
+        self._push(_PendingRequest(tensor=tensor, future=future, ensemble=ensemble, explain=explain, flow=flow))
+        return await future
+
+    def _push(self, pending):
+        weight = self._weights.get(pending.flow, 1.0)
+        finish = max(self._virtual_time, self._flow_finish.get(pending.flow, 0.0)) + pending.rows / weight
+        self._flow_finish[pending.flow] = finish
+        self._flow_pending[pending.flow] = self._flow_pending.get(pending.flow, 0) + 1
+        heapq.heappush(self._heap, (finish, next(self._sequence), pending))
+        self._not_empty.set()
+
+    def _pop(self):
+        finish, _, pending = heapq.heappop(self._heap)
+        self._virtual_time = finish
+        self._flow_pending[pending.flow] -= 1
+        if not self._flow_pending[pending.flow]:
+            # An idle client restarts from the current virtual time; it earns no credit
+            del self._flow_pending[pending.flow]
+            del self._flow_finish[pending.flow]
+        if not self._heap:
+            self._not_empty.clear()
+        return pending
+
+    async def _collect_batch(self):
+        """Wait for the first request, then fill the batch until it is full or the wait expires"""
+        while not self._heap:
+            await self._not_empty.wait()
+        batch = [self._pop()]
+        rows = batch[0].rows
+        deadline = time.perf_counter() + self._max_wait
+
+        try:
+            # The last request may take the batch past max_batch_size rows
+            while rows < self._max_batch_size:
+                # Take anything already queued without yielding, in fair order
+                while rows < self._max_batch_size and self._heap:
+                    batch.append(self._pop())
+                    rows += batch[-1].rows
+                if rows >= self._max_batch_size:
+                    break
+
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._not_empty.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # Popped requests are no longer in the queue stop() drains
+            self._fail_stopped(batch)
+            raise
+
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+
+            # Skip requests whose callers have gone away
+            batch = [pending for pending in batch if not pending.future.done()]
+            if not batch:
+                continue
+
+            # Wait for a free inference slot, then keep collecting while the batch runs
+            try:
+                await self._batch_slots.acquire()
+            except asyncio.CancelledError:
+                self._fail_stopped(batch)
+                raise
+            task = asyncio.get_running_loop().create_task(self._execute(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _execute(self, batch):
+        batch_start = time.perf_counter()
+        try:
+            tensor = torch.cat([pending.tensor for pending in batch], dim=0)
+            ensemble_rows = []
+            explain_rows = []
+            offset = 0
+            for pending in batch:
+                if pending.ensemble:
+                    ensemble_rows.extend(range(offset, offset + pending.rows))
+                if pending.explain:
+                    explain_rows.append(offset)
+                offset += pending.rows
+            output = await self._executor.run(
+                self._model_service.predict_scores, tensor, ensemble_rows, explain_rows
+            )
+        except Exception as e:
+            logger.error(f"Error during batched inference: {str(e)}")
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+            return
+        finally:
+            self._batch_slots.release()
+
+        inference_time = time.perf_counter() - batch_start
+        observe_stage("forward", inference_time)
+        scores, cams, embeddings = output["scores"], output["cams"], output["embeddings"]
+        BATCH_SIZE.observe(len(scores))
+        offset = 0
+        for pending in batch:
+            rows = scores[offset:offset + pending.rows]
+            cam = cams.get(offset)
+            first_row = offset
+            offset += pending.rows
+            if pending.future.done():
+                continue
+            queue_time = batch_start - pending.enqueued_at
+            observe_stage("queue", queue_time)
+            pending.future.set_result({
+                "scores": [score for row in rows for score in row],
+                "cam": cam,
+                # Features of the request's first row, the unaugmented image
+                "embedding": embeddings[first_row] if embeddings is not None else None,
+                "model_version": output["model_version"],
+                "cache_version": output["cache_version"],
+                "batch_size": len(scores),
+                "queue_time": queue_time,
+                "inference_time": inference_time
+            })
+
+
+_scheduler = None
+
+
+# Singleton instance getter
+def get_inference_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = InferenceScheduler(
+            get_model_service(),
+            get_inference_executor(),
+            max_batch_size=settings.BATCH_MAX_SIZE,
+            max_wait_ms=settings.BATCH_MAX_WAIT_MS,
+            max_queue_size=settings.INFERENCE_QUEUE_SIZE,
+            max_concurrent_batches=settings.INFERENCE_WORKERS,
+            weights=settings.FAIR_QUEUE_WEIGHTS
+        )
+    return _scheduler
@@ -0,0 +1,394 @@
+import os
+import glob
+import time
+import logging
+import threading
+
+import numpy as np
+
+from app.services.metrics import registry
+from app.utils.config import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows: one shard per process instead of per worker slot
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIM = 512
+VECTOR_DTYPE = np.dtype(np.float16)
+ID_DTYPE = np.dtype(np.int64)
+ROW_BYTES = EMBEDDING_DIM * VECTOR_DTYPE.itemsize
+
+# Written by app.build_embedding_index next to the shards of a version
+IVF_FILENAME = "ivf.npz"
+# IVF candidates re-scored exactly per result
+RERANK_FACTOR = 4
+
+SEARCH_SECONDS = registry.histogram(
+    "brain_tumor_similar_search_seconds",
+    "Time spent searching stored embeddings by index kind",
+    labelnames=("index",)
+)
+
+
+def normalize(vectors) -> np.ndarray:
+    """Unit-length float32 rows, so a dot product is the cosine similarity"""
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def shard_paths(directory: str):
+    """(vectors, ids) file pairs of every shard of a version, in name order"""
+    return [
+        (path, path[:-len(".f16")] + ".ids")
+        for path in sorted(glob.glob(os.path.join(directory, "shard-*.f16")))
+    ]
+
+
+def shard_rows(vectors_path: str, ids_path: str) -> int:
+    """Rows present in both files; a crash between the two appends leaves one row short"""
+    try:
+        return min(os.path.getsize(vectors_path) // ROW_BYTES, os.path.getsize(ids_path) // ID_DTYPE.itemsize)
+    except FileNotFoundError:
+        return 0
+
+
+def open_shard(vectors_path: str, ids_path: str, rows: int = None):
+    """Memory-map the first rows of a shard as ((rows, D) float16, (rows,) int64)"""
+    if rows is None:
+        rows = shard_rows(vectors_path, ids_path)
+    if rows == 0:
+        return np.empty((0, EMBEDDING_DIM), dtype=VECTOR_DTYPE), np.empty(0, dtype=ID_DTYPE)
+    vectors = np.memmap(vectors_path, dtype=VECTOR_DTYPE, mode="r", shape=(rows, EMBEDDING_DIM))
+    ids = np.memmap(ids_path, dtype=ID_DTYPE, mode="r", shape=(rows,))
+    return vectors, ids
+
+
+class TopK:
+    """Running top-k of several queries over blocks of candidates"""
+
+    def __init__(self, queries: int, k: int):
+        self.k = k
+        self.scores = np.full((queries, 0), -np.inf, dtype=np.float32)
+        self.ids = np.empty((queries, 0), dtype=ID_DTYPE)
+
+    def add(self, scores: np.ndarray, ids: np.ndarray):
+        """Merge a (queries, n) block of similarities for the candidates ids"""
+        if scores.shape[1] == 0:
+            return
+        scores = np.concatenate([self.scores, scores], axis=1)
+        ids = np.concatenate([self.ids, np.broadcast_to(ids, (scores.shape[0], ids.shape[0]))], axis=1)
+        if scores.shape[1] > self.k:
+            keep = np.argpartition(-scores, self.k - 1, axis=1)[:, :self.k]
+            scores = np.take_along_axis(scores, keep, axis=1)
+            ids = np.take_along_axis(ids, keep, axis=1)
+        self.scores, self.ids = scores, ids
+
+    def results(self):
+        """Per query, a list of (id, similarity) from most to least similar"""
+        order = np.argsort(-self.scores, axis=1)
+        scores = np.take_along_axis(self.scores, order, axis=1)
+        ids = np.take_along_axis(self.ids, order, axis=1)
+        return [
+            [(int(i), float(s)) for i, s in zip(row_ids, row_scores)]
+            for row_ids, row_scores in zip(ids, scores)
+        ]
+
+
+def score_block(top: TopK, queries: np.ndarray, vectors, ids, block_rows: int):
+    """Brute-force cosine similarity of queries against stored rows, block_rows at a time"""
+    for start in range(0, vectors.shape[0], block_rows):
+        block = np.asarray(vectors[start:start + block_rows], dtype=np.float32)
+        top.add((block @ queries.T).T, np.asarray(ids[start:start + block_rows]))
+
+
+class IvfIndex:
+    """Inverted-file index built by app.build_embedding_index.
+
+    Rows are partitioned by their nearest of nlist centroids and copied,
+    list by list, to an int8 matrix with one scale per row, so scanning a
+    list reads one contiguous range and converts a quarter of the bytes.
+    A query scans the `probes` lists with the closest centroids, then
+    re-scores its best candidates exactly against the float16 rows.
+    """
+
+    def __init__(self, directory: str, path: str):
+        with np.load(path) as data:
+            self.centroids = data["centroids"].astype(np.float32)
+            self.shards = [str(name) for name in data["shards"]]
+            self.shard_rows = data["shard_rows"].astype(np.int64)
+            # Rows offsets[l]:offsets[l + 1] of codes belong to list l
+            self.offsets = data["offsets"].astype(np.int64)
+            # Build-time position of each code row in the concatenation of the shards
+            self.positions = data["positions"].astype(np.int64)
+            self.scales = data["scales"].astype(np.float32)
+            codes_file = str(data["codes_file"])
+        self.codes = np.load(os.path.join(directory, codes_file), mmap_mode="r")
+        self.shard_starts = np.concatenate([[0], np.cumsum(self.shard_rows)])
+
+    @property
+    def lists(self) -> int:
+        return self.centroids.shape[0]
+
+    def probe(self, queries: np.ndarray, probes: int) -> np.ndarray:
+        """Lists with the closest centroids to any of the queries, in order"""
+        probes = max(1, min(probes, self.lists))
+        nearest = np.argpartition(-(queries @ self.centroids.T), probes - 1, axis=1)[:, :probes]
+        return np.unique(nearest)
+
+    def score_lists(self, top: TopK, queries: np.ndarray, lists, block_rows: int) -> int:
+        """Approximate similarities of the rows of lists, keyed by code row; returns rows scanned"""
+        scanned = 0
+        for list_index in lists:
+            lo, hi = int(self.offsets[list_index]), int(self.offsets[list_index + 1])
+            for start in range(lo, hi, block_rows):
+                stop = min(hi, start + block_rows)
+                block = np.asarray(self.codes[start:stop], dtype=np.float32)
+                top.add((block @ queries.T).T * self.scales[start:stop], np.arange(start, stop, dtype=ID_DTYPE))
+            scanned += hi - lo
+        return scanned
+
+    def locate(self, code_rows: np.ndarray):
+        """(shard name, row in shard) of code rows"""
+        positions = self.positions[code_rows]
+        shard_indexes = np.searchsorted(self.shard_starts, positions, side="right") - 1
+        return [
+            (self.shards[shard_index], int(position - self.shard_starts[shard_index]))
+            for shard_index, position in zip(shard_indexes, positions)
+        ]
+
+
+class _Shard:
+    """Read-only view of one shard, remapped when it grows.
+
+    Ids are appended in generation order, so a shard is normally sorted by
+    id and can be looked up by binary search; sorted is checked on the new
+    rows only as the shard grows.
+    """
+
+    def __init__(self, vectors_path: str, ids_path: str):
+        self.name = os.path.basename(vectors_path)[:-len(".f16")]
+        self.vectors_path = vectors_path
+        self.ids_path = ids_path
+        self.rows = -1
+        self.sorted = True
+        self.vectors = self.ids = None
+
+    def refresh(self):
+        rows = shard_rows(self.vectors_path, self.ids_path)
+        if rows != self.rows:
+            self.vectors, self.ids = open_shard(self.vectors_path, self.ids_path, rows)
+            # Truncated after a crash: check the whole shard again
+            checked = self.rows if 0 < self.rows <= rows else 0
+            tail = np.asarray(self.ids[max(checked - 1, 0):])
+            self.sorted = (self.sorted or checked == 0) and bool(np.all(tail[1:] >= tail[:-1]))
+            self.rows = rows
+        return self
+
+    def find(self, wanted: np.ndarray) -> np.ndarray:
+        """Row of the last occurrence of each wanted id, -1 where absent"""
+        if self.rows == 0:
+            return np.full(wanted.shape, -1, dtype=np.int64)
+        ids = np.asarray(self.ids)
+        if self.sorted:
+            rows = np.searchsorted(ids, wanted, side="right") - 1
+            return np.where((rows >= 0) & (ids[np.maximum(rows, 0)] == wanted), rows, -1)
+        rows = np.full(wanted.shape, -1, dtype=np.int64)
+        matches = np.flatnonzero(np.isin(ids, wanted))
+        positions = {int(prediction_id): index for index, prediction_id in enumerate(wanted)}
+        for row in matches:
+            rows[positions[int(ids[row])]] = row
+        return rows
+
+
+class _Writer:
+    """Appends to the shard this process holds the lock of"""
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self._lock_fd = None
+        name = self._claim(directory)
+        vectors_path = os.path.join(directory, f"{name}.f16")
+        ids_path = os.path.join(directory, f"{name}.ids")
+        self._vectors_fd = os.open(vectors_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._ids_fd = os.open(ids_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        # Drop a half-written row left by a crash, so both files line up again
+        rows = shard_rows(vectors_path, ids_path)
+        os.truncate(vectors_path, rows * ROW_BYTES)
+        os.truncate(ids_path, rows * ID_DTYPE.itemsize)
+        self.path = vectors_path
+
+    def _claim(self, directory: str) -> str:
+        if fcntl is None:
+            return f"shard-{os.getpid()}"
+        slot = 0
+        while True:
+            fd = os.open(os.path.join(directory, f"shard-{slot}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                slot += 1
+                continue
+            # Held until the process exits, so no other worker appends here
+            self._lock_fd = fd
+            return f"shard-{slot}"
+
+    def append(self, prediction_id: int, vector: np.ndarray):
+        # Vector first: a row only becomes visible to readers once its id is written
+        os.write(self._vectors_fd, vector.astype(VECTOR_DTYPE).tobytes())
+        os.write(self._ids_fd, np.array([prediction_id], dtype=ID_DTYPE).tobytes())
+
+    def close(self):
+        for fd in (self._vectors_fd, self._ids_fd, self._lock_fd):
+            if fd is not None:
+                os.close(fd)
+
+
+class EmbeddingStore:
+    """Head embeddings of past predictions, searchable by cosine similarity.
+
+    Each model version has a directory of float16 shards, one per worker
+    process, holding unit-length rows and the Prediction.id of each row.
+    Readers memory-map every shard of a version, so workers see each
+    other's rows without any coordination. Searches scan the shards in
+    blocks with one matrix product per block, or only the probed lists if
+    an IVF index has been built for the version.
+    """
+
+    def __init__(self, directory: str, block_rows: int = 16384, probes: int = 16):
+        self.directory = directory
+        self.block_rows = max(1, block_rows)
+        self.probes = probes
+        self._writers = {}
+        self._shards = {}  # version -> {vectors_path: _Shard}
+        self._ivf = {}  # version -> (mtime, IvfIndex)
+        self._lock = threading.Lock()
+
+    def version_directory(self, version: str) -> str:
+        return os.path.join(self.directory, version)
+
+    @staticmethod
+    def indexable(version: str) -> bool:
+        # Random weights differ per process, so their embeddings are not comparable
+        return bool(version) and not version.startswith("untrained-")
+
+    def add(self, version: str, prediction_id: int, embedding):
+        """Store the embedding of a prediction made by version"""
+        if not self.indexable(version) or embedding is None:
+            return
+        vector = normalize(embedding)[0]
+        with self._lock:
+            writer = self._writers.get(version)
+            if writer is None:
+                writer = self._writers[version] = _Writer(self.version_directory(version))
+            writer.append(prediction_id, vector)
+
+    def close(self):
+        with self._lock:
+            for writer in self._writers.values():
+                writer.close()
+            self._writers.clear()
+
+    def _open_shards(self, version: str):
+        with self._lock:
+            shards = self._shards.setdefault(version, {})
+            for vectors_path, ids_path in shard_paths(self.version_directory(version)):
+                if vectors_path not in shards:
+                    shards[vectors_path] = _Shard(vectors_path, ids_path)
+            return [shard.refresh() for shard in shards.values()]
+
+    def _load_ivf(self, version: str):
+        """The version's IVF index, reloaded when the build command replaces it"""
+        path = os.path.join(self.version_directory(version), IVF_FILENAME)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self._ivf.pop(version, None)
+            return None
+        cached = self._ivf.get(version)
+        if cached is None or cached[0] != mtime:
+            cached = self._ivf[version] = (mtime, IvfIndex(self.version_directory(version), path))
+            logger.info(f"Loaded IVF index for {version} with {cached[1].lists} lists")
+        return cached[1]
+
+    def count(self, version: str) -> int:
+        return sum(shard.rows for shard in self._open_shards(version))
+
+    def get(self, version: str, prediction_ids):
+        """Stored embedding of the first of prediction_ids that has one, or None.
+
+        All candidates are resolved in one pass per shard, by binary search
+        when the shard's ids are sorted.
+        """
+        wanted = np.asarray(list(prediction_ids), dtype=ID_DTYPE)
+        best = None  # (position in prediction_ids, shard, row)
+        for shard in self._open_shards(version):
+            rows = shard.find(wanted)
+            found = np.flatnonzero(rows >= 0)
+            if found.size and (best is None or found[0] < best[0]):
+                best = (found[0], shard, int(rows[found[0]]))
+        if best is None:
+            return None
+        return np.asarray(best[1].vectors[best[2]], dtype=np.float32)
+
+    def search(self, version: str, queries, k: int, probes: int = None) -> dict:
+        """Top-k most similar stored rows for each query.
+
+        Returns {"results": [[(prediction_id, similarity), ...] per query],
+        "index": "flat" or "ivf", "scanned": rows scored}.
+        """
+        start = time.perf_counter()
+        queries = normalize(queries)
+        top = TopK(queries.shape[0], k)
+        shards = self._open_shards(version)
+        ivf = self._load_ivf(version)
+        scanned = 0
+
+        if ivf is not None:
+            # Over-fetch on the int8 codes, then keep the exact best
+            approximate = TopK(queries.shape[0], k * RERANK_FACTOR)
+            scanned += ivf.score_lists(approximate, queries, ivf.probe(queries, probes or self.probes), self.block_rows)
+            by_name = {shard.name: shard for shard in shards}
+            located = {}
+            for shard_name, row in ivf.locate(np.unique(approximate.ids)):
+                shard = by_name.get(shard_name)
+                # A shard truncated after a crash may have lost rows the index lists
+                if shard is not None and row < shard.rows:
+                    located.setdefault(shard_name, []).append(row)
+            for shard_name, rows in located.items():
+                shard = by_name[shard_name]
+                block = np.asarray(shard.vectors[rows], dtype=np.float32)
+                top.add((block @ queries.T).T, np.asarray(shard.ids[rows]))
+            # Rows appended since the index was built are scanned in full
+            covered_rows = dict(zip(ivf.shards, ivf.shard_rows.tolist()))
+            for shard in shards:
+                covered = min(covered_rows.get(shard.name, 0), shard.rows)
+                score_block(top, queries, shard.vectors[covered:], shard.ids[covered:], self.block_rows)
+                scanned += shard.rows - covered
+        else:
+            for shard in shards:
+                score_block(top, queries, shard.vectors, shard.ids, self.block_rows)
+                scanned += shard.rows
+
+        kind = "ivf" if ivf is not None else "flat"
+        SEARCH_SECONDS.observe(time.perf_counter() - start, kind)
+        return {"results": top.results(), "index": kind, "scanned": scanned}
+
+
+_store = None
+
+
+# Singleton instance getter
+def get_embedding_store():
+    global _store
+    if _store is None:
+        _store = EmbeddingStore(
+            settings.EMBEDDING_INDEX_DIR,
+            block_rows=settings.EMBEDDING_SEARCH_BLOCK_ROWS,
+            probes=settings.EMBEDDING_INDEX_PROBES
+        )
+    return _store
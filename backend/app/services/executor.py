@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from app.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when a bounded executor or queue cannot accept more work"""
+
+    def __init__(self, message: str, retry_after: int = None):
+        super().__init__(message)
+        self.retry_after = retry_after if retry_after is not None else settings.RETRY_AFTER_SECONDS
+
+
+class BoundedExecutor:
+    """Thread pool that rejects new work once max_pending tasks are queued or running"""
+
+    def __init__(self, name: str, max_workers: int, max_pending: int):
+        self._name = name
+        self._max_workers = max(1, max_workers)
+        self._max_pending = max(self._max_workers, max_pending)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._pool = None
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self._max_workers,
+                thread_name_prefix=self._name
+            )
+        return self._pool
+
+    def _acquire(self):
+        with self._lock:
+            if self._pending >= self._max_pending:
+                raise QueueFullError(f"{self._name} queue is full ({self._max_pending} pending)")
+            self._pending += 1
+
+    def _release(self, _future=None):
+        with self._lock:
+            self._pending -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        """Run a blocking callable in the pool without blocking the event loop"""
+        self._acquire()
+        try:
+            future = self._get_pool().submit(partial(fn, *args, **kwargs))
+        except Exception:
+            self._release()
+            raise
+        # Release the slot when the work finishes, even if the caller is cancelled
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self, wait: bool = True):
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
+            logger.info(f"Executor {self._name} shut down")
+
+
+_io_executor = None
+_inference_executor = None
+
+
+# Executor for file I/O, decoding and preprocessing
+def get_io_executor():
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = BoundedExecutor(
+            "preprocess",
+            max_workers=settings.PREPROCESS_WORKERS,
+            max_pending=settings.PREPROCESS_QUEUE_SIZE
+        )
+    return _io_executor
+
+
+# Executor for model forward passes
+def get_inference_executor():
+    global _inference_executor
+    if _inference_executor is None:
+        _inference_executor = BoundedExecutor(
+            "inference",
+            max_workers=settings.INFERENCE_WORKERS,
+            max_pending=settings.INFERENCE_WORKERS
+        )
+    return _inference_executor
+
+
+def shutdown_executors():
+    """Shut down all executors created by this module"""
+    global _io_executor, _inference_executor
+    for executor in (_io_executor, _inference_executor):
+        if executor is not None:
+            executor.shutdown()
+    _io_executor = None
+    _inference_executor = None
@@ -0,0 +1,38 @@
+import logging
+
+import numpy as np
+
+from app.services.preprocessing import _get_cv2, decode_image
+from app.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def render_overlay(data, cam, max_size: int = None, alpha: float = None, quality: int = None) -> bytes:
+    """Blend a Grad-CAM map over the original image and encode it as JPEG.
+
+    The image is shrunk so its longest side is at most max_size; the map
+    is upsampled to that size and colored with the JET colormap.
+    """
+    max_size = settings.EXPLAIN_MAX_SIZE if max_size is None else max_size
+    alpha = settings.EXPLAIN_OVERLAY_ALPHA if alpha is None else alpha
+    quality = settings.EXPLAIN_QUALITY if quality is None else quality
+    cv2 = _get_cv2()
+
+    image, _ = decode_image(data)
+    height, width = image.shape[:2]
+    scale = min(1.0, max_size / max(height, width)) if max_size > 0 else 1.0
+    if scale < 1.0:
+        width, height = max(1, round(width * scale)), max(1, round(height * scale))
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    # decode_image returns RGB, OpenCV draws and encodes BGR
+    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+
+    heat = cv2.resize(np.asarray(cam, dtype=np.float32), (width, height), interpolation=cv2.INTER_LINEAR)
+    heat = cv2.applyColorMap(np.clip(heat * 255, 0, 255).astype(np.uint8), cv2.COLORMAP_JET)
+    overlay = cv2.addWeighted(image, 1.0 - alpha, heat, alpha, 0)
+
+    ok, encoded = cv2.imencode(".jpg", overlay, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("Could not encode explanation overlay")
+    return encoded.tobytes()
@@ -0,0 +1,151 @@
+import os
+import io
+import time
+import hashlib
+import logging
+
+from PIL import Image, features
+
+from app.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Stored originals and thumbnails live under these UPLOAD_DIR subdirectories
+OBJECTS_DIR = "objects"
+THUMBNAILS_DIR = "thumbs"
+EXPLANATIONS_DIR = "explanations"
+
+
+def content_hash(data) -> str:
+    """SHA-256 hex digest that addresses an image in the store"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def _fan_out(sha256: str) -> str:
+    # Two levels of 256 directories keep each directory small
+    return f"{sha256[:2]}/{sha256[2:4]}"
+
+
+def _thumbnail_format() -> str:
+    return "webp" if settings.THUMBNAIL_FORMAT == "webp" and features.check("webp") else "jpeg"
+
+
+class ImageStore:
+    """Content-addressed storage for uploaded images and their thumbnails.
+
+    An image is stored once under objects/ab/cd/<sha256>.<ext> however many
+    times it is uploaded; the images table counts the predictions that
+    reference it. Files are written atomically (temporary file + rename),
+    so readers never see a partial image.
+    """
+
+    def __init__(self, root: str, thumbnail_size: int, thumbnail_quality: int):
+        self.root = root
+        self.thumbnail_size = thumbnail_size
+        self.thumbnail_quality = thumbnail_quality
+        self.thumbnail_format = _thumbnail_format()
+
+    def object_path(self, sha256: str, extension: str) -> str:
+        """Path of an original relative to the upload directory, '/'-separated"""
+        return f"{OBJECTS_DIR}/{_fan_out(sha256)}/{sha256}.{extension}"
+
+    def thumbnail_path(self, sha256: str) -> str:
+        extension = "webp" if self.thumbnail_format == "webp" else "jpg"
+        return f"{THUMBNAILS_DIR}/{_fan_out(sha256)}/{sha256}.{extension}"
+
+    def explanation_path(self, sha256: str, model_version: str) -> str:
+        """Grad-CAM overlay of an image for one model version"""
+        return f"{EXPLANATIONS_DIR}/{_fan_out(sha256)}/{sha256}.{model_version}.jpg"
+
+    def absolute(self, relative_path: str) -> str:
+        return os.path.join(self.root, *relative_path.split("/"))
+
+    def _write_atomic(self, path: str, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp{os.getpid()}.{time.monotonic_ns()}"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def put(self, data, sha256: str, extension: str) -> bool:
+        """Store an original unless it is already present; True if it was written"""
+        path = self.absolute(self.object_path(sha256, extension))
+        try:
+            # Refresh the mtime so the reaper's grace period covers this reference
+            os.utime(path)
+            return False
+        except FileNotFoundError:
+            pass
+        self._write_atomic(path, data)
+        return True
+
+    def ensure_thumbnail(self, sha256: str, extension: str, data=None) -> str:
+        """Create the thumbnail for a stored image if it does not exist; returns its absolute path"""
+        path = self.absolute(self.thumbnail_path(sha256))
+        if os.path.exists(path):
+            return path
+
+        source = io.BytesIO(data) if data is not None else self.absolute(self.object_path(sha256, extension))
+        with Image.open(source) as image:
+            # Let the JPEG decoder downscale while decoding
+            image.draft("RGB", (self.thumbnail_size, self.thumbnail_size))
+            image = image.convert("RGB")
+            image.thumbnail((self.thumbnail_size, self.thumbnail_size), Image.BILINEAR)
+            buffer = io.BytesIO()
+            image.save(buffer, self.thumbnail_format.upper(), quality=self.thumbnail_quality)
+        self._write_atomic(path, buffer.getvalue())
+        return path
+
+    def put_explanation(self, sha256: str, model_version: str, overlay: bytes) -> str:
+        """Store a rendered Grad-CAM overlay; returns its absolute path"""
+        path = self.absolute(self.explanation_path(sha256, model_version))
+        self._write_atomic(path, overlay)
+        return path
+
+    def store_upload(self, data, sha256: str, extension: str):
+        """Background task body: store the original, then its thumbnail"""
+        try:
+            self.put(data, sha256, extension)
+            if settings.THUMBNAIL_SIZE > 0:
+                self.ensure_thumbnail(sha256, extension, data)
+        except Exception as e:
+            logger.error(f"Error storing upload {sha256}: {str(e)}")
+
+    def delete(self, sha256: str, extension: str, grace_period: float = 0) -> bool:
+        """Remove an original and its thumbnail unless the original was touched within grace_period seconds"""
+        path = self.absolute(self.object_path(sha256, extension))
+        try:
+            if grace_period and time.time() - os.stat(path).st_mtime < grace_period:
+                return False
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        try:
+            os.remove(self.absolute(self.thumbnail_path(sha256)))
+        except FileNotFoundError:
+            pass
+        # Overlays of every model version
+        explanations = self.absolute(f"{EXPLANATIONS_DIR}/{_fan_out(sha256)}")
+        try:
+            with os.scandir(explanations) as entries:
+                for entry in entries:
+                    if entry.name.startswith(f"{sha256}."):
+                        os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+        return True
+
+
+_image_store = None
+
+
+# Singleton instance getter
+def get_image_store():
+    global _image_store
+    if _image_store is None:
+        _image_store = ImageStore(
+            settings.UPLOAD_DIR,
+            thumbnail_size=settings.THUMBNAIL_SIZE,
+            thumbnail_quality=settings.THUMBNAIL_QUALITY
+        )
+    return _image_store
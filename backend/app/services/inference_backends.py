@@ -0,0 +1,292 @@
+import io
+import os
+import copy
+import time
+import logging
+import warnings
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("eager", "torchscript", "int8_dynamic", "int8_static", "onnx")
+
+# Default allowed probability difference against eager, per backend
+PARITY_TOLERANCES = {
+    "eager": 1e-6,
+    "torchscript": 1e-4,
+    "onnx": 1e-4,
+    "int8_dynamic": 0.02,
+    "int8_static": 0.05,
+}
+
+
+class WithEmbedding(nn.Module):
+    """Makes forward() return a model's logits and embeddings, so backends compile both outputs"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.training = model.training
+
+    def forward(self, x):
+        return self.model.forward_with_embedding(x)
+
+
+def split_outputs(output):
+    """(logits, embeddings) from a backend output; embeddings is None for a logits-only module"""
+    if isinstance(output, (tuple, list)):
+        return output[0], output[1]
+    return output, None
+
+
+class InferenceBackend:
+    """Callable that maps a (N, 3, 224, 224) float tensor to (N, 1) logits and (N, D) embeddings"""
+
+    def __init__(self, name: str, channels_last: bool = False):
+        self.name = name
+        self.channels_last = channels_last
+
+    def __call__(self, tensor):
+        raise NotImplementedError
+
+
+class TorchBackend(InferenceBackend):
+    """Eager, TorchScript or quantized PyTorch module"""
+
+    def __init__(self, name: str, module, channels_last: bool = False):
+        super().__init__(name, channels_last)
+        self.module = module
+
+    def __call__(self, tensor):
+        if self.channels_last:
+            tensor = tensor.contiguous(memory_format=torch.channels_last)
+        with torch.inference_mode():
+            return self.module(tensor)
+
+
+class OnnxBackend(InferenceBackend):
+    """ONNX Runtime session on the CPU execution provider"""
+
+    def __init__(self, session):
+        super().__init__("onnx")
+        self.session = session
+        self._input_name = session.get_inputs()[0].name
+
+    def __call__(self, tensor):
+        inputs = np.ascontiguousarray(tensor.detach().cpu().numpy(), dtype=np.float32)
+        return tuple(torch.from_numpy(output) for output in self.session.run(None, {self._input_name: inputs}))
+
+
+# Part of artifact names; artifacts from before embeddings were an output are not reused
+ARTIFACT_OUTPUTS = "emb"
+
+
+def artifact_path(model_path: str, model_version: str, backend: str, channels_last: bool = False) -> str:
+    """Location of a compiled artifact, next to the checkpoint and tied to its version"""
+    if backend == "onnx":
+        return f"{model_path}.{model_version}.{ARTIFACT_OUTPUTS}.onnx"
+    layout = ".cl" if channels_last else ""
+    return f"{model_path}.{model_version}.{backend}{layout}.{ARTIFACT_OUTPUTS}.pt"
+
+
+def parity_inputs(count: int = 8, seed: int = 0):
+    """Fixed input set used for calibration and parity checks"""
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(count, 3, 224, 224, generator=generator)
+
+
+def _trace(module, example, channels_last: bool):
+    """Trace and freeze a module; the result can be saved and loaded back"""
+    if channels_last:
+        example = example.contiguous(memory_format=torch.channels_last)
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        traced = torch.jit.trace(module, example)
+        return torch.jit.freeze(traced)
+
+
+def _optimize(module):
+    """Apply inference-only graph rewrites to a frozen module.
+
+    Their output cannot be serialized (torch.jit.load rejects it), so this
+    runs after loading an artifact rather than before saving one.
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return torch.jit.optimize_for_inference(module)
+    except Exception as e:
+        logger.warning(f"Could not optimize TorchScript module, using it as frozen: {str(e)}")
+        return module
+
+
+def _quantize_dynamic(model):
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8)
+
+
+def _quantize_static(model, calibration):
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    engine = torch.backends.quantized.engine
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        prepared = prepare_fx(copy.deepcopy(model), get_default_qconfig_mapping(engine), (calibration[:1],))
+        with torch.no_grad():
+            for chunk in calibration.split(8):
+                prepared(chunk)
+        return convert_fx(prepared)
+
+
+def _build_torch(name, model, path, example, calibration, channels_last, save_artifacts):
+    if os.path.exists(path):
+        logger.info(f"Loading cached {name} artifact from {path}")
+        return TorchBackend(name, _optimize(torch.jit.load(path, map_location="cpu")), channels_last)
+
+    if name == "torchscript":
+        source = copy.deepcopy(model)
+        if channels_last:
+            source = source.to(memory_format=torch.channels_last)
+    elif name == "int8_dynamic":
+        source = _quantize_dynamic(model)
+    else:
+        source = _quantize_static(model, calibration)
+
+    module = _trace(source, example, channels_last)
+    if save_artifacts and _save_artifact(path, lambda tmp: torch.jit.save(module, tmp)):
+        # Serve, and so parity check, what later loads will read
+        module = torch.jit.load(path, map_location="cpu")
+    elif not save_artifacts:
+        logger.info(f"No cached {name} artifact at {path}, compiled in memory")
+    return TorchBackend(name, _optimize(module), channels_last)
+
+
+def _export_onnx(model, example, target):
+    kwargs = dict(
+        input_names=["input"],
+        output_names=["logits", "embeddings"],
+        dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}, "embeddings": {0: "batch"}},
+        opset_version=17,
+    )
+    try:
+        torch.onnx.export(model, (example,), target, dynamo=False, **kwargs)
+    except TypeError:
+        # Older releases have no dynamo switch
+        torch.onnx.export(model, (example,), target, **kwargs)
+
+
+def _build_onnx(model, path, example, save_artifacts):
+    import onnxruntime as ort
+
+    if os.path.exists(path):
+        logger.info(f"Loading cached onnx artifact from {path}")
+        source = path
+    elif save_artifacts and _save_artifact(path, lambda tmp: _export_onnx(model, example, tmp)):
+        source = path
+    else:
+        logger.info(f"No cached onnx artifact at {path}, exported in memory")
+        buffer = io.BytesIO()
+        _export_onnx(model, example, buffer)
+        source = buffer.getvalue()
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = torch.get_num_threads()
+    session = ort.InferenceSession(source, sess_options=options, providers=["CPUExecutionProvider"])
+    return OnnxBackend(session)
+
+
+def _save_artifact(path: str, save) -> bool:
+    """Write an artifact atomically; a read-only model directory only costs a recompile"""
+    tmp = f"{path}.tmp{os.getpid()}"
+    try:
+        save(tmp)
+        os.replace(tmp, path)
+        logger.info(f"Saved compiled artifact to {path}")
+        return True
+    except OSError as e:
+        logger.warning(f"Could not cache compiled artifact at {path}: {str(e)}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+
+
+def check_parity(backend, reference_model, inputs, tolerance: float) -> dict:
+    """Compare backend probabilities with the eager reference on a fixed input set"""
+    with torch.no_grad():
+        expected = torch.sigmoid(reference_model(inputs)).view(-1)
+    actual = torch.sigmoid(split_outputs(backend(inputs))[0]).view(-1)
+    max_abs_diff = float((expected - actual).abs().max())
+    class_agreement = float(((expected >= 0.5) == (actual >= 0.5)).float().mean())
+    return {
+        "backend": backend.name,
+        "max_abs_diff": max_abs_diff,
+        "class_agreement": class_agreement,
+        "tolerance": tolerance,
+        "passed": max_abs_diff <= tolerance,
+    }
+
+
+def build_backend(name: str, model, model_path: str, model_version: str,
+                  channels_last: bool = False, calibration=None, tolerance: float = None,
+                  save_artifacts: bool = True, verify_cached: bool = True):
+    """Build the requested backend for an eager model in eval mode.
+
+    The backend returns the model's logits and its forward_with_embedding()
+    embeddings from one pass. Compiled artifacts are read from next to
+    model_path when present, and written there when save_artifacts is set.
+    The backend is checked against eager on a fixed input set and eager is
+    returned if the build or the parity check fails. Artifacts loaded from
+    the cache were checked when they were written, so verify_cached=False
+    skips the check for them.
+    """
+    reference = model
+    model = WithEmbedding(model)
+    eager = TorchBackend("eager", model, channels_last=False)
+    if name not in BACKENDS:
+        logger.error(f"Unknown inference backend '{name}', using eager. Choose one of {', '.join(BACKENDS)}")
+        return eager, None
+    if name == "eager" and not channels_last:
+        return eager, None
+
+    inputs = calibration if calibration is not None else parity_inputs()
+    example = inputs[:1]
+    tolerance = tolerance if tolerance is not None else PARITY_TOLERANCES[name]
+
+    path = artifact_path(model_path, model_version, name, channels_last)
+    cached = name != "eager" and os.path.exists(path)
+
+    try:
+        start_time = time.perf_counter()
+        if name == "eager":
+            backend = TorchBackend("eager", copy.deepcopy(model).to(memory_format=torch.channels_last), True)
+        elif name == "onnx":
+            backend = _build_onnx(model, path, example, save_artifacts)
+        else:
+            backend = _build_torch(name, model, path, example, inputs, channels_last, save_artifacts)
+        build_time = time.perf_counter() - start_time
+    except Exception as e:
+        logger.error(f"Error building {name} backend, using eager: {str(e)}")
+        return eager, None
+
+    if cached and not verify_cached:
+        logger.info(f"Using cached {name} backend (build_time={build_time:.2f}s)")
+        return backend, {"backend": name, "passed": None, "build_time": build_time}
+
+    parity = check_parity(backend, reference, inputs, tolerance)
+    parity["build_time"] = build_time
+    if not parity["passed"]:
+        logger.error(
+            f"Backend {name} failed parity check (max_abs_diff={parity['max_abs_diff']:.6f} "
+            f"> {tolerance}), using eager"
+        )
+        return eager, parity
+
+    logger.info(
+        f"Using {name} backend (channels_last={channels_last}, build_time={build_time:.2f}s, "
+        f"max_abs_diff={parity['max_abs_diff']:.6f})"
+    )
+    return backend, parity
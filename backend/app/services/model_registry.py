@@ -0,0 +1,227 @@
+import json
+import time
+import asyncio
+import datetime
+import logging
+
+from sqlalchemy import case, func, select, update
+
+from app.models.database import Feedback, ModelVersion, Prediction, async_session
+from app.services.executor import BoundedExecutor
+from app.services.model_service import get_model_service
+from app.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    """Model versions shared by all workers through the model_versions table.
+
+    Deploying a checkpoint loads and warms it up in a background thread of
+    the worker that received the request, then swaps it in atomically and
+    marks it active. The other workers notice the new active version on
+    their next poll and do the same, so no worker has to restart. Batches
+    already running finish on the model they started with.
+    """
+
+    def __init__(self, model_service, poll_interval: float, session_factory=async_session):
+        self._model_service = model_service
+        self._poll_interval = poll_interval
+        self._session_factory = session_factory
+        # One load at a time; a second deploy is rejected while one is running
+        self._executor = BoundedExecutor("model-load", max_workers=1, max_pending=1)
+        self._lock = None
+        self._worker = None
+
+    def start(self):
+        """Poll for versions activated by other workers"""
+        if self._poll_interval <= 0:
+            return
+        if self._worker is not None and not self._worker.done():
+            return
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self._executor.shutdown(wait=False)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._poll_interval)
+            try:
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error syncing model registry: {str(e)}")
+
+    def _get_lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def _active_row(self, session):
+        result = await session.execute(select(ModelVersion).where(ModelVersion.is_active == 1).limit(1))
+        return result.scalar_one_or_none()
+
+    async def _record(self, loaded, active: bool):
+        """Insert or refresh a version's row, and make it the only active one if requested"""
+        now = datetime.datetime.utcnow()
+        async with self._session_factory() as session:
+            row = await session.get(ModelVersion, loaded.version)
+            if row is None:
+                row = ModelVersion(version=loaded.version, created_at=now, is_active=0)
+                session.add(row)
+            row.path = loaded.path
+            row.backend = loaded.backend.name
+            row.load_seconds = sum(loaded.load_report.values())
+            row.latency = json.dumps(loaded.latency)
+            if active:
+                await session.execute(
+                    update(ModelVersion)
+                    .where(ModelVersion.is_active == 1, ModelVersion.version != loaded.version)
+                    .values(is_active=0)
+                )
+                row.is_active = 1
+                row.activated_at = now
+            await session.commit()
+
+    async def _swap(self, path: str, expected_version: str = None):
+        """Load and warm up a checkpoint off the event loop, then make it serve new batches"""
+        load_start = time.perf_counter()
+        loaded = await self._executor.run(self._model_service.load_and_warm, path)
+        if expected_version is not None and loaded.version != expected_version:
+            raise ValueError(
+                f"Checkpoint at {path} is version {loaded.version}, expected {expected_version}"
+            )
+        self._model_service.activate(loaded)
+        logger.info(f"Model {loaded.version} swapped in after {time.perf_counter() - load_start:.1f}s")
+        return loaded
+
+    async def startup(self):
+        """Register the model loaded from MODEL_PATH, or switch to the version the registry marks active"""
+        async with self._get_lock():
+            async with self._session_factory() as session:
+                active = await self._active_row(session)
+            current = self._model_service.active_model
+            if current is not None and current.version.startswith("untrained-"):
+                # Random weights differ per process and must never become the shared version
+                current = None
+
+            if active is None or (current is not None and active.version == current.version):
+                if current is not None:
+                    await self._record(current, active=True)
+                return
+
+            if current is not None:
+                await self._record(current, active=False)
+            try:
+                await self._swap(active.path, active.version)
+            except Exception as e:
+                logger.error(f"Error loading active model {active.version} from {active.path}: {str(e)}")
+
+    async def sync(self):
+        """Follow the active version if another worker changed it"""
+        async with self._session_factory() as session:
+            active = await self._active_row(session)
+        if active is None or active.version == self._model_service.model_version:
+            return
+        async with self._get_lock():
+            if active.version == self._model_service.model_version:
+                return
+            logger.info(f"Model registry: switching to {active.version}")
+            await self._swap(active.path, active.version)
+
+    async def deploy(self, path: str, activate: bool = True) -> dict:
+        """Load a new checkpoint in the background and, if activate, swap it in everywhere"""
+        async with self._get_lock():
+            if activate:
+                loaded = await self._swap(path)
+            else:
+                # Loaded only to validate and profile it; it is not kept in memory
+                loaded = await self._executor.run(self._model_service.load_and_warm, path)
+            await self._record(loaded, active=activate)
+            return loaded.describe()
+
+    async def activate(self, version: str) -> dict:
+        """Switch to a registered version, e.g. to roll back"""
+        async with self._session_factory() as session:
+            row = await session.get(ModelVersion, version)
+        if row is None:
+            raise KeyError(version)
+        async with self._get_lock():
+            current = self._model_service.active_model
+            if current is not None and current.version == version:
+                loaded = current
+            else:
+                loaded = await self._swap(row.path, version)
+            await self._record(loaded, active=True)
+            return loaded.describe()
+
+    async def versions(self) -> list:
+        """Registered versions with prediction and feedback counts for comparing them"""
+        async with self._session_factory() as session:
+            rows = (await session.execute(
+                select(ModelVersion).order_by(ModelVersion.created_at.desc())
+            )).scalars().all()
+            usage = (await session.execute(
+                select(
+                    Prediction.model_version,
+                    func.count(Prediction.id),
+                    func.avg(case((Prediction.prediction == "tumor", 1), else_=0)),
+                    func.avg(Prediction.processing_time)
+                )
+                .where(Prediction.model_version.is_not(None))
+                .group_by(Prediction.model_version)
+            )).all()
+            feedback = dict((version, (count, correct)) for version, count, correct in (await session.execute(
+                select(Prediction.model_version, func.count(Feedback.id), func.sum(Feedback.is_correct))
+                .join(Prediction, Feedback.prediction_id == Prediction.id)
+                .where(Prediction.model_version.is_not(None))
+                .group_by(Prediction.model_version)
+            )).all())
+
+        stats = {}
+        for version, predictions, tumor_fraction, processing_time in usage:
+            feedback_count, correct = feedback.get(version, (0, 0))
+            stats[version] = {
+                "predictions": predictions,
+                "tumor_fraction": tumor_fraction,
+                "mean_processing_time": processing_time,
+                "feedback": feedback_count,
+                "feedback_accuracy": (correct or 0) / feedback_count if feedback_count else None
+            }
+        return [
+            {
+                "version": row.version,
+                "path": row.path,
+                "backend": row.backend,
+                "active": bool(row.is_active),
+                "load_seconds": row.load_seconds,
+                "latency_ms": json.loads(row.latency) if row.latency else {},
+                "created_at": row.created_at.isoformat() if row.created_at else None,
+                "activated_at": row.activated_at.isoformat() if row.activated_at else None,
+                **stats.get(row.version, {"predictions": 0, "feedback": 0})
+            }
+            for row in rows
+        ]
+
+
+_registry = None
+
+
+# Singleton instance getter
+def get_model_registry():
+    global _registry
+    if _registry is None:
+        _registry = ModelRegistry(
+            get_model_service(),
+            poll_interval=settings.MODEL_REGISTRY_POLL_INTERVAL
+        )
+    return _registry
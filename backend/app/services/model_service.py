@@ -1,20 +1,144 @@
+import io
 import os
 import time
+import uuid
+import hashlib
 import logging
+import threading
+
+_import_start = time.perf_counter()
+
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
 from torchvision import models, transforms
 from torchvision.models import ResNet18_Weights
 from PIL import Image
-import numpy as np
-import cv2
 from pathlib import Path
 
+from app.services.preprocessing import OpenCVPreprocessor, build_tta_views, decode_image
+from app.services.inference_backends import build_backend, split_outputs
 from app.utils.config import settings
 
+# Time spent importing torch, torchvision and the service modules
+IMPORT_TIME = time.perf_counter() - _import_start
+
 logger = logging.getLogger(__name__)
 
+def _open_image(source):
+    """Open an image from a path, raw bytes/memoryview or a binary file object.
+    
+    Returns the PIL image and the size of the encoded image in bytes.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return Image.open(io.BytesIO(source)), memoryview(source).nbytes
+    
+    if isinstance(source, (str, os.PathLike)):
+        return Image.open(source), os.path.getsize(source)
+    
+    # Binary file object, e.g. the spooled file behind an UploadFile
+    source.seek(0, os.SEEK_END)
+    file_size = source.tell()
+    source.seek(0)
+    return Image.open(source), file_size
+
+
+def _file_sha256(path, chunk_size=1024 * 1024):
+    """Return the hex SHA-256 digest of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def version_sidecar_path(model_path):
+    """File holding the precomputed SHA-256 of a prepared checkpoint"""
+    return f"{model_path}.sha256"
+
+
+def read_model_version(model_path):
+    """Short content hash of a checkpoint, read from its sidecar when it is up to date"""
+    sidecar = version_sidecar_path(model_path)
+    try:
+        if os.path.getmtime(sidecar) >= os.path.getmtime(model_path):
+            with open(sidecar) as f:
+                return f.read().split()[0][:16]
+    except (OSError, IndexError):
+        pass
+    return _file_sha256(model_path)[:16]
+
+
+def extract_state_dict(checkpoint):
+    """Return the BrainTumorClassifier state dict from a supported checkpoint format"""
+    if isinstance(checkpoint, dict) and "model_state_dict" in checkpoint:
+        # This is a training checkpoint with model_state_dict
+        logger.info("Loading model from training checkpoint format")
+        return checkpoint["model_state_dict"]
+    if isinstance(checkpoint, dict) and all(k.startswith("backbone.") for k in checkpoint.keys() if not k.startswith("_")):
+        # This is a direct state dict for our model
+        logger.info("Loading model from direct state dict format")
+        return checkpoint
+    raise ValueError("Unrecognized checkpoint format")
+
+
+def read_checkpoint(model_path, allow_pickle=None):
+    """Memory-map a checkpoint and return its state dict without copying the weights.
+    
+    Only tensors and plain containers are unpickled unless allow_pickle
+    (default ALLOW_PICKLED_CHECKPOINTS) is set, since a full unpickle can
+    run arbitrary code from the file.
+    """
+    if model_path.endswith(".safetensors"):
+        from safetensors.torch import load_file
+        return extract_state_dict(load_file(model_path, device="cpu"))
+    if allow_pickle is None:
+        allow_pickle = settings.ALLOW_PICKLED_CHECKPOINTS
+    
+    try:
+        checkpoint = torch.load(model_path, map_location="cpu", mmap=True, weights_only=True)
+    except Exception as e:
+        # Legacy (non-zip) files cannot be memory-mapped
+        logger.warning(f"Could not memory-map {model_path}, falling back to a full load: {str(e)}")
+        try:
+            checkpoint = torch.load(model_path, map_location="cpu", weights_only=True)
+        except Exception as e:
+            if not allow_pickle:
+                raise ValueError(
+                    f"{model_path} holds more than tensors and was not unpickled; convert it with "
+                    f"python -m app.prepare_model --source {model_path} --allow-pickle if it is trusted"
+                ) from e
+            # Training checkpoints may pickle optimizer or config objects
+            logger.warning(f"Unpickling {model_path} without restrictions (ALLOW_PICKLED_CHECKPOINTS)")
+            checkpoint = torch.load(model_path, map_location="cpu", weights_only=False)
+    return extract_state_dict(checkpoint)
+
+
+def load_calibration_inputs(directory=None, limit=None):
+    """Preprocessed images from QUANT_CALIBRATION_DIR, or None to use synthetic inputs"""
+    directory = directory or settings.QUANT_CALIBRATION_DIR
+    limit = limit or settings.QUANT_CALIBRATION_SIZE
+    if not directory or not os.path.isdir(directory):
+        return None
+    paths = sorted(
+        p for p in Path(directory).iterdir()
+        if p.suffix.lower().lstrip(".") in settings.ALLOWED_EXTENSIONS
+    )[:limit]
+    if not paths:
+        return None
+    images = [decode_image(path)[0] for path in paths]
+    return OpenCVPreprocessor().preprocess_batch(images)
+
+
+def build_pil_transform():
+    """Reference PIL/torchvision preprocessing pipeline"""
+    return transforms.Compose([
+        transforms.Resize((224, 224)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    ])
+
+
 class BrainTumorClassifier(nn.Module):
     def __init__(self, pretrained=True):
         super(BrainTumorClassifier, self).__init__()
@@ -30,6 +154,46 @@ class BrainTumorClassifier(nn.Module):
     
     def forward(self, x):
         return self.backbone(x)
+    
+    def forward_with_embedding(self, x):
+        """Logits and the 512-d features the head computes before its final Linear, from one pass"""
+        backbone = self.backbone
+        x = backbone.maxpool(backbone.relu(backbone.bn1(backbone.conv1(x))))
+        x = backbone.layer4(backbone.layer3(backbone.layer2(backbone.layer1(x))))
+        x = torch.flatten(backbone.avgpool(x), 1)
+        # Indexed one by one, so FX quantization sees the registered submodules
+        head = backbone.fc
+        embeddings = head[2](head[1](head[0](x)))
+        return head[4](head[3](embeddings)), embeddings
+
+
+class LoadedModel:
+    """One checkpoint ready for inference: its eager module, inference backend and load measurements"""
+    
+    def __init__(self, path, version, model, backend, backend_parity, load_report):
+        self.path = path
+        self.version = version
+        self.model = model
+        self.backend = backend
+        self.backend_parity = backend_parity
+        self.load_report = load_report
+        self.loaded_at = time.time()
+        self.latency = {}  # Milliseconds per forward pass by batch size, measured at warmup
+    
+    @property
+    def cache_version(self):
+        """Model version plus backend, since quantized backends give slightly different scores"""
+        return f"{self.version}.{self.backend.name}"
+    
+    def describe(self):
+        return {
+            "version": self.version,
+            "path": self.path,
+            "backend": self.backend.name,
+            "loaded_at": self.loaded_at,
+            "load_report": dict(self.load_report),
+            "latency_ms": dict(self.latency)
+        }
 
 
 class ModelService:
@@ -38,136 +202,478 @@ class ModelService:
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(ModelService, cls).__new__(cls)
-            cls._instance._model = None
+            cls._instance._active = None
+            cls._instance._swap_lock = threading.Lock()
+            cls._instance._ensemble = []
+            cls._instance._explain_state = threading.local()
+            cls._instance._startup_report = {"import": IMPORT_TIME}
             cls._instance._device = torch.device("cpu")
-            cls._instance._transform = transforms.Compose([
-                transforms.Resize((224, 224)),
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-            ])
-            cls._instance._load_model()
+            cls._instance._transform = build_pil_transform()
+            cls._instance._preprocessor = OpenCVPreprocessor()
+            load_start = time.perf_counter()
+            cls._instance._load_startup_model()
+            cls._instance._load_ensemble()
+            cls._instance._startup_report["total"] = time.perf_counter() - load_start
+            logger.info(
+                "Model startup phases: " + ", ".join(
+                    f"{phase}={seconds * 1000:.1f}ms" for phase, seconds in cls._instance.load_report.items()
+                )
+            )
         return cls._instance
     
-    def _load_model(self):
-        """Load the PyTorch model from the specified path"""
+    def _load_startup_model(self):
+        """Load MODEL_PATH; without it the service reports the model as not loaded"""
         try:
-            logger.info(f"Loading model from {settings.MODEL_PATH}")
-            
-            # Check if model file exists
-            if not os.path.exists(settings.MODEL_PATH):
-                logger.warning(f"Model file not found at {settings.MODEL_PATH}. Creating a new model.")
-                self._model = BrainTumorClassifier(pretrained=True)
-                self._model.to(self._device)
-                
-                # Create directory if it doesn't exist
-                os.makedirs(os.path.dirname(settings.MODEL_PATH), exist_ok=True)
-                
-                # Save the model
-                torch.save(self._model.state_dict(), settings.MODEL_PATH)
-                logger.info(f"Created and saved new model to {settings.MODEL_PATH}")
-            else:
-                # Load the model
-                self._model = BrainTumorClassifier(pretrained=False)
-                
-                # Load checkpoint
-                checkpoint = torch.load(settings.MODEL_PATH, map_location=self._device)
-                
-                # Handle different model file formats
-                if isinstance(checkpoint, dict) and "model_state_dict" in checkpoint:
-                    # This is a training checkpoint with model_state_dict
-                    logger.info("Loading model from training checkpoint format")
-                    self._model.load_state_dict(checkpoint["model_state_dict"])
-                elif isinstance(checkpoint, dict) and all(k.startswith("backbone.") for k in checkpoint.keys() if not k.startswith("_")):
-                    # This is a direct state dict for our model
-                    logger.info("Loading model from direct state dict format")
-                    self._model.load_state_dict(checkpoint)
-                else:
-                    # Try to create a new model
-                    logger.warning("Could not load model from file. Creating a new model.")
-                    self._model = BrainTumorClassifier(pretrained=True)
-                    
-                    # Save the new model
-                    torch.save(self._model.state_dict(), settings.MODEL_PATH + ".new")
-                    logger.info(f"Created and saved new model to {settings.MODEL_PATH}.new")
-                
-                self._model.to(self._device)
-                logger.info("Model loaded successfully")
-            
-            # Set model to evaluation mode
-            self._model.eval()
-            
+            self._active = self.load(settings.MODEL_PATH)
         except Exception as e:
             logger.error(f"Error loading model: {str(e)}")
-            # Create a new model as fallback
-            logger.info("Creating a new model as fallback")
-            self._model = BrainTumorClassifier(pretrained=True)
-            self._model.to(self._device)
-            self._model.eval()
+            if settings.ALLOW_UNTRAINED_MODEL:
+                # Explicitly allowed, e.g. for benchmarks: same cost, meaningless scores
+                logger.warning("ALLOW_UNTRAINED_MODEL is set, serving an untrained model")
+                self._active = self._untrained_model()
+            else:
+                logger.error("No model is loaded; predictions fail until a model is deployed")
+    
+    def load(self, path):
+        """Load a checkpoint and wrap it in the configured backend, without network access or file writes.
+        
+        Raises if the checkpoint is missing or unreadable; the active model
+        is not touched, see activate().
+        """
+        logger.info(f"Loading model from {path}")
+        load_report = {}
+        
+        # Check if model file exists
+        if not os.path.exists(path):
+            raise FileNotFoundError(
+                f"Model file not found at {path}. "
+                f"Run `python -m app.prepare_model` to create it."
+            )
+        
+        # Build the module on the meta device to skip weight initialization
+        phase_start = time.perf_counter()
+        with torch.device("meta"):
+            model = BrainTumorClassifier(pretrained=False)
+        load_report["construct"] = time.perf_counter() - phase_start
+        
+        # Memory-map the weights and use them in place
+        phase_start = time.perf_counter()
+        model.load_state_dict(read_checkpoint(path), assign=True)
+        load_report["load_weights"] = time.perf_counter() - phase_start
+        
+        phase_start = time.perf_counter()
+        version = read_model_version(path)
+        load_report["version"] = time.perf_counter() - phase_start
+        
+        # Set model to evaluation mode
+        model.eval()
+        
+        phase_start = time.perf_counter()
+        backend, backend_parity = self._build_backend(model, path, version)
+        load_report["backend"] = time.perf_counter() - phase_start
+        # After compiling: backends copy the model, and the hook cannot be copied
+        self._install_explain_hook(model)
+        
+        logger.info(f"Model {version} loaded successfully")
+        return LoadedModel(path, version, model, backend, backend_parity, load_report)
+    
+    def _untrained_model(self):
+        model = BrainTumorClassifier(pretrained=False).eval()
+        self._install_explain_hook(model)
+        version = f"untrained-{uuid.uuid4().hex[:12]}"
+        backend, _ = build_backend("eager", model, settings.MODEL_PATH, version)
+        return LoadedModel(settings.MODEL_PATH, version, model, backend, None, {})
+    
+    def _build_backend(self, model, path, version):
+        """Wrap an eager model in the configured inference backend"""
+        try:
+            # Only read cached artifacts; they are written by app.prepare_model
+            return build_backend(
+                settings.INFERENCE_BACKEND,
+                model,
+                path,
+                version,
+                channels_last=settings.CHANNELS_LAST,
+                calibration=load_calibration_inputs(),
+                save_artifacts=False,
+                verify_cached=False
+            )
+        except Exception as e:
+            logger.error(f"Error building inference backend: {str(e)}")
+            return build_backend("eager", model, path, version)
+    
+    def _install_explain_hook(self, model):
+        """Hook layer4 of an eager model so explain passes can capture its activations"""
+        # Inference never needs parameter gradients; Grad-CAM only needs
+        # them for the layer4 activations, from the hook onwards
+        model.requires_grad_(False)
+        model.backbone.layer4.register_forward_hook(self._capture_activations)
+    
+    def _capture_activations(self, module, inputs, output):
+        # Only explain passes, which flag their own thread, are affected
+        state = self._explain_state
+        if not getattr(state, "active", False):
+            return None
+        activations = output.detach().requires_grad_()
+        state.activations = activations
+        return activations
+    
+    def _load_ensemble(self):
+        """Load the extra checkpoints in ENSEMBLE_MODEL_PATHS with the configured backend"""
+        if not settings.ENSEMBLE_MODEL_PATHS or self._active is None:
+            return
+        phase_start = time.perf_counter()
+        for path in settings.ENSEMBLE_MODEL_PATHS:
+            try:
+                with torch.device("meta"):
+                    model = BrainTumorClassifier(pretrained=False)
+                model.load_state_dict(read_checkpoint(path), assign=True)
+                model.eval()
+                version = read_model_version(path)
+                backend, _ = build_backend(
+                    settings.INFERENCE_BACKEND,
+                    model,
+                    path,
+                    version,
+                    channels_last=settings.CHANNELS_LAST,
+                    save_artifacts=False,
+                    verify_cached=False
+                )
+                self._ensemble.append((version, backend))
+                logger.info(f"Loaded ensemble member {path} ({version}, {backend.name})")
+            except Exception as e:
+                # A missing member would silently change ensemble scores, so skip it loudly
+                logger.error(f"Error loading ensemble member {path}: {str(e)}")
+        self._startup_report["ensemble"] = time.perf_counter() - phase_start
+    
+    def warmup(self, batches=None):
+        """Run dummy batches so the first request does not pay one-off allocation costs"""
+        if self._active is not None:
+            self.warmup_model(self._active, batches)
+            # Ensemble members are shared by every primary model
+            if self._ensemble:
+                self.predict_scores(torch.zeros(1, 3, 224, 224), ensemble_rows=[0])
+    
+    def warmup_model(self, loaded, batches=None):
+        """Warm up a loaded model and measure its forward pass latency by batch size"""
+        batches = settings.MODEL_WARMUP_BATCHES if batches is None else batches
+        phase_start = time.perf_counter()
+        dummy = torch.zeros(1, 3, 224, 224)
+        for _ in range(batches):
+            self._forward(loaded, dummy)
+            self._explain(loaded, dummy)
+        loaded.load_report["warmup"] = time.perf_counter() - phase_start
+        logger.info(f"Model {loaded.version} warmup: {batches} batches in {loaded.load_report['warmup'] * 1000:.1f}ms")
+        
+        # Latency profile, recorded in the model registry
+        for batch_size in sorted({1, max(1, settings.BATCH_MAX_SIZE)}):
+            batch = torch.zeros(batch_size, 3, 224, 224)
+            forward_start = time.perf_counter()
+            self._forward(loaded, batch)
+            loaded.latency[str(batch_size)] = (time.perf_counter() - forward_start) * 1000
+        return loaded
+    
+    def load_and_warm(self, path):
+        """Load a checkpoint and warm it up, ready for activate()"""
+        return self.warmup_model(self.load(path))
+    
+    def activate(self, loaded):
+        """Atomically make loaded the model for new batches; returns the previous one.
+        
+        Batches already running keep the model they started with, so
+        in-flight requests finish on the old model.
+        """
+        with self._swap_lock:
+            previous, self._active = self._active, loaded
+        logger.info(
+            f"Activated model {loaded.version} ({loaded.backend.name}) from {loaded.path}"
+            + (f", replacing {previous.version}" if previous is not None else "")
+        )
+        return previous
+    
+    @property
+    def active_model(self):
+        """The LoadedModel serving new batches, or None"""
+        return self._active
+    
+    @property
+    def eager_model(self):
+        """Eager module of the active model"""
+        return self._active.model if self._active is not None else None
+    
+    @property
+    def load_report(self):
+        """Seconds spent in each startup phase"""
+        report = dict(self._startup_report)
+        if self._active is not None:
+            report.update(self._active.load_report)
+        return report
+    
+    @property
+    def cache_version(self):
+        """Model version plus backend, since quantized backends give slightly different scores"""
+        return self._active.cache_version if self._active is not None else "none"
+    
+    @property
+    def ensemble_size(self):
+        """Models averaged in ensemble mode, the primary model included"""
+        return 1 + len(self._ensemble)
+    
+    def prediction_version(self, views=1, ensemble=False, cache_version=None):
+        """Cache version of a prediction made with the given TTA views and ensemble mode.
+        
+        cache_version defaults to the active model's.
+        """
+        version = cache_version or self.cache_version
+        if views > 1:
+            version += f".tta{views}-{settings.TTA_CROP_SCALE:g}"
+        if ensemble and self._ensemble:
+            version += ".ens-" + "-".join(member_version for member_version, _ in self._ensemble)
+        return version
+    
+    @property
+    def backend_info(self):
+        """Name of the active inference backend and its parity check result"""
+        active = self._active
+        return {
+            "name": active.backend.name if active is not None else None,
+            "channels_last": active.backend.channels_last if active is not None else False,
+            "parity": active.backend_parity if active is not None else None
+        }
     
     def is_model_loaded(self):
         """Check if the model is loaded"""
-        return self._model is not None
+        return self._active is not None
+    
+    @property
+    def model_version(self):
+        """Short content hash of the active checkpoint, or a per-process id for untrained models"""
+        return self._active.version if self._active is not None else None
     
-    def preprocess_image(self, image_path):
-        """Preprocess the image for model input"""
+    def preprocess_image(self, source):
+        """Preprocess an image path, bytes buffer or file object for model input"""
+        if settings.PREPROCESS_BACKEND == "pil":
+            return self.preprocess_image_pil(source)
+        
         try:
-            # Load image
-            image = Image.open(image_path).convert('RGB')
+            # Decode with OpenCV and write straight into a float32 buffer
+            decode_start = time.perf_counter()
+            image, file_size = decode_image(source)
+            preprocess_start = time.perf_counter()
+            tensor = self._preprocessor.preprocess(image)
+            
+            return {
+                "tensor": tensor,  # Already has a batch dimension
+                "original_size": (image.shape[1], image.shape[0]),
+                "processed_size": (224, 224),
+                "file_size": file_size,
+                "timings": {
+                    "decode": preprocess_start - decode_start,
+                    "preprocess": time.perf_counter() - preprocess_start
+                }
+            }
+        except Exception as e:
+            logger.error(f"Error preprocessing image: {str(e)}")
+            raise
+    
+    def preprocess_image_pil(self, source):
+        """Preprocess an image with the PIL/torchvision reference pipeline"""
+        try:
+            # Load image, decoding in memory when given a buffer
+            decode_start = time.perf_counter()
+            image, file_size = _open_image(source)
+            image = image.convert('RGB')
             
             # Get original image size
             original_size = image.size
             
             # Apply transformations
+            preprocess_start = time.perf_counter()
             tensor = self._transform(image)
             
             return {
                 "tensor": tensor.unsqueeze(0),  # Add batch dimension
                 "original_size": original_size,
-                "processed_size": (224, 224)
+                "processed_size": (224, 224),
+                "file_size": file_size,
+                "timings": {
+                    "decode": preprocess_start - decode_start,
+                    "preprocess": time.perf_counter() - preprocess_start
+                }
             }
         except Exception as e:
             logger.error(f"Error preprocessing image: {str(e)}")
             raise
     
-    def predict(self, image_path):
-        """Perform prediction on an image"""
+    def preprocess_batch(self, sources):
+        """Decode and preprocess several images into one contiguous (N, 3, 224, 224) tensor"""
+        images = [decode_image(source)[0] for source in sources]
+        return self._preprocessor.preprocess_batch(images)
+    
+    def _require_active(self):
+        # One read of the active model per batch, so a swap never splits a batch
+        active = self._active
+        if active is None:
+            raise RuntimeError("Model is not loaded")
+        return active
+    
+    def _score(self, loaded, tensor):
+        # Move tensor to device
+        tensor = tensor.to(self._device)
+        
+        # Perform inference with the configured backend
+        logits, embeddings = split_outputs(loaded.backend(tensor))
+        probabilities = torch.sigmoid(logits).view(-1)
+        
+        return probabilities.tolist(), embeddings
+    
+    def _forward(self, loaded, tensor):
+        return self._score(loaded, tensor)[0]
+    
+    def predict_batch(self, tensor):
+        """Run one forward pass over a batch tensor and return per-image probabilities"""
+        return self._forward(self._require_active(), tensor)
+    
+    def build_views(self, tensor, views):
+        """Test-time augmentation views of one preprocessed image, as one batch"""
+        return build_tta_views(tensor, views, settings.TTA_CROP_SCALE)
+    
+    def _explain(self, loaded, tensor):
+        state = self._explain_state
+        state.active = True
+        try:
+            with torch.enable_grad():
+                logits, embeddings = loaded.model.forward_with_embedding(tensor.to(self._device))
+                activations = state.activations
+                # Samples are independent in eval mode, so the gradient of the
+                # sum holds each sample's own gradient
+                (gradients,) = torch.autograd.grad(logits.sum(), activations)
+        finally:
+            state.active = False
+            state.activations = None
+        
+        # Channel weights are the spatially averaged gradients
+        weights = gradients.mean(dim=(2, 3), keepdim=True)
+        cams = torch.relu((weights * activations.detach()).sum(dim=1))
+        cams = cams / cams.flatten(1).max(dim=1).values.clamp_min(1e-8)[:, None, None]
+        return torch.sigmoid(logits.detach()).view(-1).tolist(), cams.cpu().numpy(), embeddings.detach()
+    
+    def explain_batch(self, tensor):
+        """Probabilities and Grad-CAM maps for a batch, from one eager forward pass.
+        
+        The layer4 hook makes its activations the start of the autograd
+        graph, so only the pooling and classifier head are differentiated.
+        Returns the probabilities and an (N, 7, 7) float32 array of maps
+        scaled to [0, 1].
+        """
+        return self._explain(self._require_active(), tensor)[:2]
+    
+    def predict_scores(self, tensor, ensemble_rows=None, explain_rows=None):
+        """Scores for every row of a batch: [primary] or, for ensemble_rows, [primary, member, ...].
+        
+        The primary model runs once over the whole batch and each ensemble
+        member once over the ensemble rows only. explain_rows go through the
+        eager model with Grad-CAM instead of the primary backend. Returns
+        {"scores", "cams": {row: Grad-CAM map}, "embeddings", "model_version",
+        "cache_version"} for the model that produced them; "embeddings" is an
+        (N, 512) float32 array of the primary model's head features, or None.
+        """
+        active = self._require_active()
+        cams = {}
+        if explain_rows:
+            probabilities, maps, explained_embeddings = self._explain(active, tensor[explain_rows])
+            explained = dict(zip(explain_rows, probabilities))
+            cams = dict(zip(explain_rows, maps))
+            other_rows = [row for row in range(tensor.shape[0]) if row not in explained]
+            other_probabilities, other_embeddings = (
+                self._score(active, tensor[other_rows]) if other_rows else ([], None)
+            )
+            other = dict(zip(other_rows, other_probabilities))
+            scores = [[explained[row] if row in explained else other[row]] for row in range(tensor.shape[0])]
+            embeddings = torch.empty(tensor.shape[0], explained_embeddings.shape[1])
+            embeddings[explain_rows] = explained_embeddings.float().cpu()
+            if other_rows:
+                embeddings[other_rows] = other_embeddings.float().cpu()
+        else:
+            probabilities, embeddings = self._score(active, tensor)
+            scores = [[probability] for probability in probabilities]
+        if ensemble_rows and self._ensemble:
+            rows = tensor.to(self._device)
+            if len(ensemble_rows) != len(scores):
+                rows = rows[ensemble_rows]
+            for _, backend in self._ensemble:
+                probabilities = torch.sigmoid(split_outputs(backend(rows))[0]).view(-1).tolist()
+                for row, probability in zip(ensemble_rows, probabilities):
+                    scores[row].append(probability)
+        return {
+            "scores": scores,
+            "cams": cams,
+            "embeddings": embeddings.float().cpu().numpy() if embeddings is not None else None,
+            "model_version": active.version,
+            "cache_version": active.cache_version
+        }
+    
+    @staticmethod
+    def summarize_scores(scores):
+        """Mean probability and population variance over views and models"""
+        mean = sum(scores) / len(scores)
+        variance = sum((score - mean) ** 2 for score in scores) / len(scores)
+        return mean, variance
+    
+    def format_prediction(self, probability, processing_time, uncertainty=None):
+        """Build the prediction payload for a single probability.
+        
+        uncertainty, when given, describes the spread of a TTA/ensemble
+        prediction: {"variance", "views", "models"}.
+        """
+        # Determine class and confidence
+        prediction = "tumor" if probability >= 0.5 else "no_tumor"
+        confidence = probability if prediction == "tumor" else 1 - probability
+        
+        result = {
+            "class": prediction,
+            "confidence": float(confidence),
+            "probability": float(probability),
+            "processing_time": processing_time
+        }
+        if uncertainty is not None:
+            result["uncertainty"] = uncertainty
+        return result
+    
+    def predict(self, source, views=1, ensemble=False):
+        """Perform prediction on an image path, bytes buffer or file object.
+        
+        views > 1 averages that many test-time augmentation views and
+        ensemble=True also averages the ENSEMBLE_MODEL_PATHS models.
+        """
         if not self.is_model_loaded():
             raise RuntimeError("Model is not loaded")
         
         try:
-            start_time = time.time()
+            start_time = time.perf_counter()
             
             # Preprocess image
-            preprocessed = self.preprocess_image(image_path)
-            tensor = preprocessed["tensor"]
-            
-            # Move tensor to device
-            tensor = tensor.to(self._device)
-            
-            # Perform inference
-            with torch.no_grad():
-                output = self._model(tensor)
-                probability = torch.sigmoid(output).item()
+            preprocessed = self.preprocess_image(source)
             
-            # Determine class and confidence
-            prediction = "tumor" if probability >= 0.5 else "no_tumor"
-            confidence = probability if prediction == "tumor" else 1 - probability
+            # Perform inference on one batch holding every view
+            tensor = self.build_views(preprocessed["tensor"], views)
+            rows = list(range(tensor.shape[0])) if ensemble else None
+            scores = [score for row in self.predict_scores(tensor, rows)["scores"] for score in row]
+            probability, variance = self.summarize_scores(scores)
+            uncertainty = None
+            if len(scores) > 1:
+                uncertainty = {"variance": variance, "views": tensor.shape[0], "models": len(scores) // tensor.shape[0]}
             
             # Calculate processing time
-            processing_time = time.time() - start_time
+            processing_time = time.perf_counter() - start_time
             
             return {
                 "success": True,
-                "prediction": {
-                    "class": prediction,
-                    "confidence": float(confidence),
-                    "probability": float(probability),
-                    "processing_time": processing_time
-                },
+                "prediction": self.format_prediction(probability, processing_time, uncertainty),
                 "image_info": {
                     "original_size": preprocessed["original_size"],
                     "processed_size": preprocessed["processed_size"],
-                    "file_size": os.path.getsize(image_path)
+                    "file_size": preprocessed["file_size"]
                 }
             }
         except Exception as e:
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from app.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Run disk-tier eviction once per this many writes
+DISK_EVICT_EVERY = 64
+
+
+class PredictionCache:
+    """Two-tier prediction cache keyed by image content hash and model version.
+
+    The memory tier is an LRU bounded by max_entries. The optional disk tier is a
+    SQLite file bounded by disk_max_entries. Entries in both tiers expire after
+    ttl seconds.
+    """
+
+    def __init__(self, max_entries: int, ttl: int, disk_path: str = None, disk_max_entries: int = 0):
+        self._max_entries = max(0, max_entries)
+        self._ttl = ttl
+        self._disk_max_entries = max(0, disk_max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+        self._disk_lock = threading.Lock()
+        self._disk_writes = 0
+        self._stats = {
+            "hits": 0,
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0
+        }
+
+        if disk_path:
+            self._open_disk(disk_path)
+
+    def _open_disk(self, disk_path: str):
+        try:
+            directory = os.path.dirname(disk_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False, isolation_level=None)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute("PRAGMA synchronous=NORMAL")
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS prediction_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._disk.execute(
+                "CREATE INDEX IF NOT EXISTS ix_prediction_cache_accessed_at "
+                "ON prediction_cache (accessed_at)"
+            )
+            logger.info(f"Prediction cache disk tier at {disk_path}")
+        except Exception as e:
+            logger.error(f"Error opening prediction cache at {disk_path}: {str(e)}")
+            self._disk = None
+
+    @staticmethod
+    def make_key(data, model_version: str) -> str:
+        """Build a cache key from the raw image bytes and the model version"""
+        return PredictionCache.key_for_hash(hashlib.sha256(data).hexdigest(), model_version)
+
+    @staticmethod
+    def key_for_hash(content_hash: str, model_version: str) -> str:
+        """Build a cache key from an already computed SHA-256 of the image bytes"""
+        return f"{content_hash}:{model_version}"
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, key: str):
+        """Return the cached value for key, or None on a miss"""
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created_at, value = entry
+                if now - created_at <= self._ttl:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    self._stats["memory_hits"] += 1
+                    return value
+                del self._entries[key]
+                self._stats["expirations"] += 1
+
+        if self._disk is not None:
+            value = self._disk_get(key, now)
+            if value is not None:
+                self._count("hits")
+                self._count("disk_hits")
+                self._memory_set(key, value, now)
+                return value
+
+        self._count("misses")
+        return None
+
+    def set(self, key: str, value: dict):
+        """Store value under key in every enabled tier"""
+        now = time.time()
+        self._memory_set(key, value, now)
+        if self._disk is not None:
+            self._disk_set(key, value, now)
+
+    def _memory_set(self, key: str, value: dict, created_at: float):
+        if self._max_entries == 0:
+            return
+        with self._lock:
+            self._entries[key] = (created_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def _disk_get(self, key: str, now: float):
+        try:
+            with self._disk_lock:
+                row = self._disk.execute(
+                    "SELECT value, created_at FROM prediction_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                if now - row[1] > self._ttl:
+                    self._disk.execute("DELETE FROM prediction_cache WHERE key = ?", (key,))
+                    self._count("expirations")
+                    return None
+                self._disk.execute(
+                    "UPDATE prediction_cache SET accessed_at = ? WHERE key = ?", (now, key)
+                )
+            return json.loads(row[0])
+        except Exception as e:
+            logger.error(f"Error reading prediction cache: {str(e)}")
+            return None
+
+    def _disk_set(self, key: str, value: dict, now: float):
+        try:
+            with self._disk_lock:
+                self._disk.execute(
+                    "INSERT OR REPLACE INTO prediction_cache (key, value, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value), now, now)
+                )
+                # Amortize eviction, which has to count the table
+                self._disk_writes += 1
+                if self._disk_writes % DISK_EVICT_EVERY == 0:
+                    self._disk_evict(now)
+        except Exception as e:
+            logger.error(f"Error writing prediction cache: {str(e)}")
+
+    def _disk_evict(self, now: float):
+        """Drop expired rows, then the least recently used rows above the size limit"""
+        expired = self._disk.execute(
+            "DELETE FROM prediction_cache WHERE created_at < ?", (now - self._ttl,)
+        ).rowcount
+        overflow = self._disk.execute("SELECT COUNT(*) FROM prediction_cache").fetchone()[0] - self._disk_max_entries
+        if overflow > 0:
+            self._disk.execute(
+                "DELETE FROM prediction_cache WHERE key IN ("
+                "SELECT key FROM prediction_cache ORDER BY accessed_at LIMIT ?)",
+                (overflow,)
+            )
+        with self._lock:
+            self._stats["expirations"] += max(expired, 0)
+            self._stats["evictions"] += max(overflow, 0)
+
+    def clear(self):
+        """Remove every entry from both tiers"""
+        with self._lock:
+            self._entries.clear()
+        if self._disk is not None:
+            with self._disk_lock:
+                self._disk.execute("DELETE FROM prediction_cache")
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and current tier sizes"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        if self._disk is not None:
+            with self._disk_lock:
+                stats["disk_entries"] = self._disk.execute(
+                    "SELECT COUNT(*) FROM prediction_cache"
+                ).fetchone()[0]
+        return stats
+
+    def close(self):
+        if self._disk is not None:
+            with self._disk_lock:
+                self._disk.close()
+            self._disk = None
+
+
+_cache = None
+
+
+# Singleton instance getter
+def get_prediction_cache():
+    global _cache
+    if _cache is None:
+        _cache = PredictionCache(
+            max_entries=settings.CACHE_MAX_ENTRIES if settings.CACHE_ENABLED else 0,
+            ttl=settings.CACHE_TTL,
+            disk_path=settings.CACHE_DISK_PATH if settings.CACHE_ENABLED else None,
+            disk_max_entries=settings.CACHE_DISK_MAX_ENTRIES
+        )
+    return _cache
@@ -0,0 +1,169 @@
+import os
+import logging
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+_cv2 = None
+
+
+def _get_cv2():
+    """Import OpenCV on first use so it does not slow down worker startup"""
+    global _cv2
+    if _cv2 is None:
+        import cv2
+        _cv2 = cv2
+    return _cv2
+
+# Model input size (height, width) and ImageNet normalization
+INPUT_SIZE = (224, 224)
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+def read_image_bytes(source):
+    """Return the encoded bytes of an image path, bytes buffer or binary file object"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return source
+
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            return f.read()
+
+    # Binary file object, e.g. the spooled file behind an UploadFile
+    source.seek(0)
+    return source.read()
+
+
+def decode_image(source):
+    """Decode an image with OpenCV into an RGB uint8 HWC array.
+
+    Returns the array and the size of the encoded image in bytes.
+    """
+    cv2 = _get_cv2()
+    data = read_image_bytes(source)
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode image")
+
+    # OpenCV decodes to BGR, the model was trained on RGB
+    cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+    return image, buffer.nbytes
+
+
+class OpenCVPreprocessor:
+    """Resize, normalize and HWC->CHW conversion written straight into float32 buffers.
+
+    Normalization is folded into a single multiply-add per channel:
+    (x / 255 - mean) / std == x * scale + offset.
+    """
+
+    def __init__(self, size=INPUT_SIZE):
+        self.size = size
+        self._scale = (1.0 / (255.0 * STD)).reshape(3, 1, 1)
+        self._offset = (-MEAN / STD).reshape(3, 1, 1)
+
+    def resize(self, image):
+        """Resize an RGB uint8 HWC image to the model input size"""
+        cv2 = _get_cv2()
+        height, width = self.size
+        # Area interpolation is closest to PIL's antialiased bilinear when shrinking
+        shrinking = image.shape[0] > height or image.shape[1] > width
+        interpolation = cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR
+        return cv2.resize(image, (width, height), interpolation=interpolation)
+
+    def preprocess_into(self, image, out):
+        """Write one RGB uint8 HWC image into a preallocated (3, H, W) float32 array"""
+        return self.normalize_into(self.resize(image), out)
+
+    def normalize_into(self, resized, out):
+        """Normalize an already resized RGB uint8 HWC image into a (3, H, W) float32 array"""
+        # Transposed view, no copy until the multiply writes into out
+        np.multiply(resized.transpose(2, 0, 1), self._scale, out=out)
+        np.add(out, self._offset, out=out)
+        return out
+
+    def allocate(self, batch_size: int):
+        """Allocate a contiguous (N, 3, H, W) float32 buffer"""
+        height, width = self.size
+        return np.empty((batch_size, 3, height, width), dtype=np.float32)
+
+    def preprocess(self, image):
+        """Preprocess one image into a (1, 3, H, W) tensor"""
+        buffer = self.allocate(1)
+        self.preprocess_into(image, buffer[0])
+        return torch.from_numpy(buffer)
+
+    def preprocess_batch(self, images, out=None):
+        """Preprocess a list of images into one contiguous (N, 3, H, W) tensor"""
+        if out is None:
+            out = self.allocate(len(images))
+        for i, image in enumerate(images):
+            self.preprocess_into(image, out[i])
+        return torch.from_numpy(out[:len(images)])
+
+
+# Test-time augmentation views, in the order they are added as more are requested
+TTA_VIEWS = (
+    "identity",
+    "hflip",
+    "center_crop",
+    "hflip_center_crop",
+    "crop_top_left",
+    "crop_top_right",
+    "crop_bottom_left",
+    "crop_bottom_right",
+)
+
+
+def build_tta_views(tensor, views, crop_scale=0.9):
+    """Stack augmented views of one preprocessed (1, 3, H, W) image into a (views, 3, H, W) batch.
+
+    Flips and crops work on the normalized tensor, so the image is decoded
+    and preprocessed only once. Crops cover crop_scale of each side and are
+    resized back to the model input size in a single interpolate call.
+    """
+    views = max(1, min(views, len(TTA_VIEWS)))
+    image = tensor[:1]
+    if views == 1:
+        return image
+
+    _, _, height, width = image.shape
+    crop_height, crop_width = int(round(height * crop_scale)), int(round(width * crop_scale))
+    bottom, right = height - crop_height, width - crop_width
+    offsets = {
+        "center": (bottom // 2, right // 2),
+        "top_left": (0, 0),
+        "top_right": (0, right),
+        "bottom_left": (bottom, 0),
+        "bottom_right": (bottom, right),
+    }
+    names = TTA_VIEWS[:views]
+    crop_names = [name.split("crop_", 1)[1] if name.startswith("crop_") else "center"
+                  for name in names if "crop" in name]
+
+    crops = {}
+    if crop_names:
+        stacked = torch.cat([
+            image[:, :, top:top + crop_height, left:left + crop_width]
+            for top, left in (offsets[name] for name in dict.fromkeys(crop_names))
+        ], dim=0)
+        resized = torch.nn.functional.interpolate(stacked, size=(height, width), mode="bilinear", align_corners=False)
+        crops = dict(zip(dict.fromkeys(crop_names), resized.split(1)))
+
+    batch = []
+    for name in names:
+        if name == "identity":
+            batch.append(image)
+        elif name == "hflip":
+            batch.append(image.flip(3))
+        elif name == "center_crop":
+            batch.append(crops["center"])
+        elif name == "hflip_center_crop":
+            batch.append(crops["center"].flip(3))
+        else:
+            batch.append(crops[name.split("crop_", 1)[1]])
+    return torch.cat(batch, dim=0)
@@ -0,0 +1,187 @@
+import datetime
+import logging
+
+from sqlalchemy import delete, func, select, text
+
+from app.models.database import (
+    CONFIDENCE_BUCKET_WIDTH,
+    LATENCY_BUCKET_BASE_MS,
+    LATENCY_BUCKET_GROWTH,
+    DailyLatencyHistogram,
+    DailyPredictionStats,
+    Feedback,
+    FeedbackStats,
+    Prediction,
+    StatsDelta,
+)
+from app.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+CLASSES = ("tumor", "no_tumor")
+LATENCY_PERCENTILES = (50, 95, 99)
+
+
+def latency_bucket_upper_ms(bucket: int) -> float:
+    """Upper bound of a processing time bucket in milliseconds"""
+    return LATENCY_BUCKET_BASE_MS * LATENCY_BUCKET_GROWTH ** bucket
+
+
+def histogram_percentiles(histogram, percentiles=LATENCY_PERCENTILES) -> dict:
+    """Percentiles from (bucket, count) pairs sorted by bucket.
+
+    Each is the upper bound of the bucket it falls in, so it overstates the
+    exact value by at most one bucket width (about 9%).
+    """
+    total = sum(count for _, count in histogram)
+    result = {}
+    if not total:
+        return result
+    for percentile in percentiles:
+        rank = percentile / 100.0 * total
+        seen = 0
+        for bucket, count in histogram:
+            seen += count
+            if seen >= rank:
+                result[f"p{percentile}"] = latency_bucket_upper_ms(bucket)
+                break
+    return result
+
+
+async def read_stats(session, days: int) -> dict:
+    """Model quality and latency summary from the stats aggregates.
+
+    Reads a bounded number of aggregate rows (per class, per confidence
+    bucket, per day and latency bucket), whatever the size of the
+    predictions and feedback tables.
+    """
+    since = datetime.datetime.utcnow().date() - datetime.timedelta(days=days - 1)
+
+    class_totals = (await session.execute(
+        select(
+            DailyPredictionStats.prediction,
+            func.sum(DailyPredictionStats.count),
+            func.sum(DailyPredictionStats.confidence_sum)
+        ).group_by(DailyPredictionStats.prediction)
+    )).all()
+    daily = (await session.execute(
+        select(DailyPredictionStats)
+        .where(DailyPredictionStats.day >= since)
+        .order_by(DailyPredictionStats.day)
+    )).scalars().all()
+    latency = (await session.execute(
+        select(DailyLatencyHistogram)
+        .where(DailyLatencyHistogram.day >= since)
+        .order_by(DailyLatencyHistogram.day, DailyLatencyHistogram.bucket)
+    )).scalars().all()
+    feedback = (await session.execute(
+        select(FeedbackStats).order_by(FeedbackStats.confidence_bucket)
+    )).scalars().all()
+
+    by_class = {
+        prediction: {"count": count, "mean_confidence": confidence_sum / count if count else None}
+        for prediction, count, confidence_sum in class_totals
+    }
+
+    # Binary task: an incorrect prediction means the other class was right
+    confusion = {predicted: {actual: 0 for actual in CLASSES} for predicted in CLASSES}
+    calibration = {}
+    for row in feedback:
+        if row.prediction in confusion:
+            other = CLASSES[1 - CLASSES.index(row.prediction)]
+            confusion[row.prediction][row.prediction] += row.correct
+            confusion[row.prediction][other] += row.incorrect
+        totals = calibration.setdefault(row.confidence_bucket, [0, 0, 0.0])
+        totals[0] += row.correct
+        totals[1] += row.incorrect
+        totals[2] += row.confidence_sum
+    correct = sum(totals[0] for totals in calibration.values())
+    total_feedback = correct + sum(totals[1] for totals in calibration.values())
+
+    days_summary = {}
+    for row in daily:
+        summary = days_summary.setdefault(row.day, {
+            "day": row.day.isoformat(), "predictions": 0, "by_class": {}, "processing_time_sum": 0.0
+        })
+        summary["predictions"] += row.count
+        summary["by_class"][row.prediction] = row.count
+        summary["processing_time_sum"] += row.processing_time_sum
+    histograms = {}
+    for row in latency:
+        histograms.setdefault(row.day, []).append((row.bucket, row.count))
+    for day, summary in days_summary.items():
+        processing_time_sum = summary.pop("processing_time_sum")
+        summary["latency_ms"] = {
+            "mean": processing_time_sum * 1000.0 / summary["predictions"] if summary["predictions"] else None,
+            **histogram_percentiles(histograms.get(day, []))
+        }
+
+    return {
+        "predictions": {
+            "total": sum(totals["count"] for totals in by_class.values()),
+            "by_class": by_class
+        },
+        "feedback": {
+            "total": total_feedback,
+            "correct": correct,
+            "incorrect": total_feedback - correct,
+            "accuracy": correct / total_feedback if total_feedback else None,
+            # confusion[predicted][actual]
+            "confusion": confusion
+        },
+        "calibration": [
+            {
+                "confidence_min": bucket * CONFIDENCE_BUCKET_WIDTH,
+                "confidence_max": (bucket + 1) * CONFIDENCE_BUCKET_WIDTH,
+                "feedback": bucket_correct + bucket_incorrect,
+                "accuracy": bucket_correct / (bucket_correct + bucket_incorrect),
+                "mean_confidence": confidence_sum / (bucket_correct + bucket_incorrect)
+            }
+            for bucket, (bucket_correct, bucket_incorrect, confidence_sum) in sorted(calibration.items())
+            if bucket_correct + bucket_incorrect
+        ],
+        "days": [days_summary[day] for day in sorted(days_summary)]
+    }
+
+
+async def rebuild_stats(engine, fetch_size: int = None) -> dict:
+    """Recompute the stats aggregates from the predictions and feedback tables.
+
+    Runs in one transaction that keeps writers out until it commits, so
+    rows flushed meanwhile are counted exactly once. Rows are streamed, so
+    memory only grows with the number of aggregate rows.
+    """
+    fetch_size = fetch_size or settings.EXPORT_FETCH_SIZE
+    delta = StatsDelta()
+    predictions = feedback = 0
+    async with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            await conn.execute(text("LOCK TABLE predictions, feedback IN SHARE MODE"))
+        # On SQLite the first delete takes the write lock
+        for table in (DailyPredictionStats, DailyLatencyHistogram, FeedbackStats):
+            await conn.execute(delete(table))
+
+        result = await conn.stream(
+            select(Prediction.timestamp, Prediction.prediction, Prediction.confidence, Prediction.processing_time)
+            .where(Prediction.timestamp.is_not(None), Prediction.prediction.is_not(None))
+            .execution_options(yield_per=fetch_size)
+        )
+        async for rows in result.partitions():
+            for row in rows:
+                delta.add_prediction(row.timestamp, row.prediction, row.confidence, row.processing_time)
+            predictions += len(rows)
+
+        result = await conn.stream(
+            select(Prediction.prediction, Prediction.confidence, Feedback.is_correct)
+            .join(Prediction, Feedback.prediction_id == Prediction.id)
+            .execution_options(yield_per=fetch_size)
+        )
+        async for rows in result.partitions():
+            for row in rows:
+                delta.add_feedback(row.prediction, row.confidence, row.is_correct)
+            feedback += len(rows)
+
+        await delta.apply(conn)
+
+    logger.info(f"Rebuilt stats from {predictions} predictions and {feedback} feedback rows")
+    return {"predictions": predictions, "feedback": feedback}
@@ -0,0 +1,222 @@
+import re
+import json
+import math
+import time
+import logging
+import threading
+
+from app.services.metrics import registry
+from app.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Clients that send this header are scheduled per session and, within the
+# limit of their address, rate limited per session
+SESSION_HEADER = b"x-session-id"
+SESSION_ID_PATTERN = re.compile(r"[0-9A-Za-z_-]{1,64}")
+
+RATE_LIMITED = registry.counter(
+    "brain_tumor_rate_limited_total",
+    "Requests rejected with 429 by path prefix and client kind",
+    labelnames=("path", "client")
+)
+
+
+def _header(scope, name: bytes):
+    for key, value in scope.get("headers", ()):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def session_id(scope):
+    """The client's X-Session-Id header, if it is a valid session id"""
+    value = _header(scope, SESSION_HEADER)
+    if value is not None and SESSION_ID_PATTERN.fullmatch(value.strip()):
+        return value.strip()
+    return None
+
+
+def client_address(scope, trust_proxy: bool = None) -> str:
+    """The address a request came from, as "ip:<address>" """
+    if trust_proxy is None:
+        trust_proxy = settings.RATE_LIMIT_TRUST_PROXY
+    if trust_proxy:
+        forwarded = _header(scope, b"x-forwarded-for")
+        if forwarded:
+            return f"ip:{forwarded.split(',')[0].strip()}"
+    client = scope.get("client")
+    return f"ip:{client[0]}" if client else "ip:unknown"
+
+
+def client_key(scope, trust_proxy: bool = None) -> str:
+    """Identify the client of a request for scheduling: "session:<id>" or "ip:<address>".
+
+    Session ids are chosen by the client, so they separate the sessions of
+    one client rather than authenticate it; rate limits always apply to
+    the address as well.
+    """
+    session = session_id(scope)
+    if session is not None:
+        return f"session:{session}"
+    return client_address(scope, trust_proxy)
+
+
+class TokenBucketLimiter:
+    """In-process token bucket per client.
+
+    Each client may make up to burst requests at once; tokens refill at
+    rate_per_minute / 60 per second. Buckets that have refilled completely
+    carry no state and are dropped, so memory is bounded by the number of
+    recently active clients. Limits are per worker process.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int, sweep_every: int = 1024):
+        self.rate = rate_per_minute / 60.0
+        self.burst = max(1, burst)
+        self._buckets = {}  # key -> [tokens, updated_at]
+        self._lock = threading.Lock()
+        self._sweep_every = sweep_every
+        self._calls = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    @property
+    def tracked_clients(self) -> int:
+        return len(self._buckets)
+
+    def acquire(self, key: str, cost: float = 1.0, now: float = None):
+        """Take cost tokens from the client's bucket.
+
+        Returns (allowed, retry_after, remaining): retry_after is the number
+        of seconds until the request would be allowed.
+        """
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = float(self.burst)
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+            if tokens >= cost:
+                tokens -= cost
+                allowed, retry_after = True, 0.0
+            else:
+                allowed, retry_after = False, (cost - tokens) / self.rate
+            self._buckets[key] = [tokens, now]
+
+            self._calls += 1
+            if self._calls >= self._sweep_every:
+                self._calls = 0
+                self._sweep(now)
+        return allowed, retry_after, tokens
+
+    def refund(self, key: str, cost: float = 1.0):
+        """Give back tokens taken by acquire() for a request that was rejected elsewhere"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + cost)
+
+    def _sweep(self, now: float):
+        """Drop buckets that would be full by now"""
+        full_after = self.burst / self.rate
+        idle = [key for key, (_, updated_at) in self._buckets.items() if now - updated_at >= full_after]
+        for key in idle:
+            del self._buckets[key]
+
+
+class RateLimitMiddleware:
+    """ASGI middleware enforcing rate limits on the configured path prefixes.
+
+    Every request takes a token from its address's bucket in address_limiter,
+    so rotating X-Session-Id gains nothing. Requests with a session id also
+    take one from the bucket of that session at that address in limiter,
+    which shares an address limit fairly between the sessions behind it.
+    Rejected requests get 429 with Retry-After before their body is read,
+    and are counted in brain_tumor_rate_limited_total.
+    """
+
+    def __init__(self, app, limiter: TokenBucketLimiter, path_prefixes=(), address_limiter: TokenBucketLimiter = None):
+        self.app = app
+        self.limiter = limiter
+        self.address_limiter = address_limiter or limiter
+        self.path_prefixes = tuple(path_prefixes)
+
+    def _limited_prefix(self, path: str):
+        for prefix in self.path_prefixes:
+            # Whole path segments only: /api/predict covers /api/predict/batch, not /api/predictions
+            if path == prefix or path.startswith(prefix.rstrip("/") + "/"):
+                return prefix
+        return None
+
+    async def _reject(self, send, retry_after: float, limit: float):
+        seconds = max(1, math.ceil(retry_after))
+        body = json.dumps({"detail": f"Rate limit exceeded, retry in {seconds} seconds"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(seconds).encode()),
+                (b"x-ratelimit-limit", str(round(limit)).encode()),
+                (b"x-ratelimit-remaining", b"0"),
+            ]
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (self.limiter.enabled or self.address_limiter.enabled):
+            await self.app(scope, receive, send)
+            return
+        prefix = self._limited_prefix(scope["path"])
+        if prefix is None or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        address = client_address(scope)
+        session = session_id(scope)
+        session_key = f"session:{address}/{session}" if session is not None else None
+        allowed, retry_after = True, 0.0
+        if session_key is not None and self.limiter.enabled:
+            allowed, retry_after, _ = self.limiter.acquire(session_key)
+            if not allowed:
+                RATE_LIMITED.inc(prefix, "session")
+                await self._reject(send, retry_after, self.limiter.rate * 60)
+                return
+        if self.address_limiter.enabled:
+            allowed, retry_after, _ = self.address_limiter.acquire(address)
+        if not allowed:
+            if session_key is not None and self.limiter.enabled:
+                self.limiter.refund(session_key)
+            RATE_LIMITED.inc(prefix, "ip")
+            await self._reject(send, retry_after, self.address_limiter.rate * 60)
+            return
+        await self.app(scope, receive, send)
+
+
+_limiter = None
+
+
+# Singleton instance getter
+def get_rate_limiter():
+    global _limiter
+    if _limiter is None:
+        _limiter = TokenBucketLimiter(settings.RATE_LIMIT, settings.RATE_LIMIT_BURST)
+    return _limiter
+
+
+_address_limiter = None
+
+
+# Singleton instance getter
+def get_address_rate_limiter():
+    global _address_limiter
+    if _address_limiter is None:
+        _address_limiter = TokenBucketLimiter(settings.RATE_LIMIT_PER_ADDRESS, settings.RATE_LIMIT_ADDRESS_BURST)
+    return _address_limiter
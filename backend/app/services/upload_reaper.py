@@ -0,0 +1,315 @@
+import os
+import time
+import asyncio
+import datetime
+import logging
+from collections import Counter
+
+from sqlalchemy import bindparam, delete, select, update
+
+from app.models.database import Prediction, StoredImage, async_session
+from app.services.executor import get_io_executor
+from app.services.image_store import get_image_store
+from app.utils.config import settings
+from app.utils.file_utils import (
+    expiry_cutoff_day,
+    iter_expired_uploads,
+    prune_empty_upload_dirs,
+    upload_file_path,
+)
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Bound on the number of filenames in one UPDATE ... WHERE filename IN (...)
+MARK_CHUNK_SIZE = 500
+
+
+class UploadReaper:
+    """Deletes expired uploads in small time-bounded slices.
+
+    Every CLEANUP_INTERVAL seconds the reaper walks the upload directory
+    lazily, taking at most REAPER_SLICE_MS of work (and REAPER_BATCH_SIZE
+    files) at a time in the io executor and pausing REAPER_PAUSE_MS between
+    slices. The matching Prediction rows get filename = NULL before their
+    files are removed, so history never links to a missing image. With
+    several workers, a lock file makes sure only one of them reaps.
+
+    Images in the content-addressed store are shared between predictions:
+    expired predictions release their reference, and an image is deleted
+    once nothing references it and it has not been uploaded again within
+    the grace period.
+    """
+
+    def __init__(self, upload_dir: str, max_age: int, interval: int, slice_ms: float,
+                 batch_size: int, pause_ms: float, session_factory=async_session,
+                 image_store=None, delete_grace: int = 0):
+        self._upload_dir = upload_dir
+        self._max_age = max_age
+        self._interval = interval
+        self._slice = max(1.0, slice_ms) / 1000.0
+        self._batch_size = max(1, batch_size)
+        self._pause = max(0.0, pause_ms) / 1000.0
+        self._session_factory = session_factory
+        self._image_store = image_store
+        self._delete_grace = delete_grace
+        self._worker = None
+        self._lock_file = None
+        self._last_run = {}
+
+    @property
+    def last_run(self) -> dict:
+        return dict(self._last_run)
+
+    def start(self):
+        """Start the periodic reaper on the running event loop"""
+        if self._interval <= 0 or self._max_age <= 0:
+            logger.info("Upload reaper disabled")
+            return
+        if self._worker is not None and not self._worker.done():
+            return
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        self._release_lock()
+
+    def _acquire_lock(self) -> bool:
+        """Non-blocking lock shared by all processes serving this upload directory"""
+        if fcntl is None:
+            return True
+        if self._lock_file is None:
+            self._lock_file = open(os.path.join(self._upload_dir, ".reaper.lock"), "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def _release_lock(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    async def _run(self):
+        while True:
+            try:
+                if self._acquire_lock():
+                    await self.run_once()
+                else:
+                    logger.debug("Another process is reaping uploads")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error reaping uploads: {str(e)}")
+            await asyncio.sleep(self._interval)
+
+    def _next_slice(self, expired) -> list:
+        """Pull expired paths from the walk until the slice's time or size budget is spent"""
+        deadline = time.perf_counter() + self._slice
+        batch = []
+        for relative_path in expired:
+            batch.append(relative_path)
+            if len(batch) >= self._batch_size or time.perf_counter() >= deadline:
+                break
+        return batch
+
+    def _delete(self, relative_paths) -> int:
+        deleted = 0
+        for relative_path in relative_paths:
+            try:
+                os.remove(upload_file_path(relative_path, self._upload_dir))
+                deleted += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Error deleting upload {relative_path}: {str(e)}")
+        return deleted
+
+    async def _mark_missing(self, relative_paths) -> int:
+        """Clear Prediction.filename for uploads that are about to be deleted"""
+        marked = 0
+        async with self._session_factory() as session:
+            for start in range(0, len(relative_paths), MARK_CHUNK_SIZE):
+                chunk = relative_paths[start:start + MARK_CHUNK_SIZE]
+                result = await session.execute(
+                    update(Prediction)
+                    .where(Prediction.filename.in_(chunk))
+                    .values(filename=None)
+                    .execution_options(synchronize_session=False)
+                )
+                marked += result.rowcount or 0
+            await session.commit()
+        return marked
+
+    async def _release_references(self, cutoff: datetime.datetime) -> int:
+        """Detach one batch of expired predictions from their stored images"""
+        async with self._session_factory() as session:
+            rows = (await session.execute(
+                select(Prediction.id, Prediction.image_hash)
+                .where(Prediction.image_hash.is_not(None), Prediction.timestamp < cutoff)
+                .order_by(Prediction.timestamp, Prediction.id)
+                .limit(self._batch_size)
+            )).all()
+            if not rows:
+                return 0
+            
+            await session.execute(
+                update(Prediction)
+                .where(Prediction.id.in_([row.id for row in rows]))
+                .values(filename=None, image_hash=None)
+                .execution_options(synchronize_session=False)
+            )
+            counts = Counter(row.image_hash for row in rows)
+            await session.execute(
+                update(StoredImage.__table__)
+                .where(StoredImage.__table__.c.sha256 == bindparam("b_sha256"))
+                .values(ref_count=StoredImage.__table__.c.ref_count - bindparam("b_count")),
+                [{"b_sha256": sha256, "b_count": count} for sha256, count in counts.items()]
+            )
+            await session.commit()
+        return len(rows)
+    
+    def _recently_touched(self, images) -> set:
+        """Hashes of unreferenced images that were stored again within the grace period"""
+        recent = set()
+        now = time.time()
+        for sha256, extension in images:
+            path = self._image_store.absolute(self._image_store.object_path(sha256, extension))
+            try:
+                if now - os.stat(path).st_mtime < self._delete_grace:
+                    recent.add(sha256)
+            except FileNotFoundError:
+                pass
+        return recent
+    
+    async def _delete_unreferenced(self) -> int:
+        """Delete one batch of images that no prediction references; returns the number removed"""
+        io_executor = get_io_executor()
+        async with self._session_factory() as session:
+            candidates = (await session.execute(
+                select(StoredImage.sha256, StoredImage.extension)
+                .where(StoredImage.ref_count <= 0)
+                .order_by(StoredImage.last_referenced_at)
+                .limit(self._batch_size)
+            )).all()
+            if not candidates:
+                return 0
+            
+            recent = await io_executor.run(self._recently_touched, candidates)
+            expired = [row.sha256 for row in candidates if row.sha256 not in recent]
+            if not expired:
+                return 0
+            
+            # Rows first, and only those still unreferenced; an upload in
+            # between recreates the row and refreshes the file's mtime
+            result = await session.execute(
+                delete(StoredImage)
+                .where(StoredImage.sha256.in_(expired), StoredImage.ref_count <= 0)
+                .returning(StoredImage.sha256, StoredImage.extension)
+            )
+            deleted = result.all()
+            await session.commit()
+        
+        def remove_files():
+            for sha256, extension in deleted:
+                self._image_store.delete(sha256, extension, grace_period=self._delete_grace)
+        
+        await io_executor.run(remove_files)
+        return len(deleted)
+    
+    async def _reap_stored_images(self, now: float, stats: dict):
+        """Release expired references, then delete images nobody references"""
+        cutoff = datetime.datetime.utcfromtimestamp(now - self._max_age)
+        while True:
+            released = await self._release_references(cutoff)
+            if not released:
+                break
+            stats["references_released"] += released
+            stats["slices"] += 1
+            await asyncio.sleep(self._pause)
+        
+        while True:
+            removed = await self._delete_unreferenced()
+            if not removed:
+                break
+            stats["images_deleted"] += removed
+            stats["slices"] += 1
+            await asyncio.sleep(self._pause)
+    
+    async def run_once(self) -> dict:
+        """One full pass over the upload directory, in slices"""
+        io_executor = get_io_executor()
+        started = time.perf_counter()
+        now = time.time()
+        stats = {
+            "deleted": 0, "rows_marked": 0, "references_released": 0, "images_deleted": 0,
+            "slices": 0, "dirs_removed": 0
+        }
+        
+        if self._image_store is not None:
+            await self._reap_stored_images(now, stats)
+
+        expired = iter_expired_uploads(self._upload_dir, self._max_age, now)
+        pending = None
+        try:
+            while True:
+                # Shielded: if this pass is cancelled, the io thread is still
+                # advancing the walk and must finish before it can be closed
+                pending = asyncio.ensure_future(io_executor.run(self._next_slice, expired))
+                batch = await asyncio.shield(pending)
+                if not batch:
+                    break
+                # Database first: a crash in between leaves an orphan file for
+                # the next pass rather than a row pointing at nothing
+                stats["rows_marked"] += await self._mark_missing(batch)
+                stats["deleted"] += await io_executor.run(self._delete, batch)
+                stats["slices"] += 1
+                await asyncio.sleep(self._pause)
+        finally:
+            if pending is not None and not pending.done():
+                await asyncio.gather(pending, return_exceptions=True)
+            expired.close()
+
+        stats["dirs_removed"] = await io_executor.run(
+            prune_empty_upload_dirs, expiry_cutoff_day(self._max_age, now), self._upload_dir
+        )
+        stats["seconds"] = time.perf_counter() - started
+        self._last_run = stats
+        logger.info(
+            f"Reaped {stats['deleted']} uploads and {stats['images_deleted']} stored images "
+            f"in {stats['slices']} slices ({stats['rows_marked']} predictions marked, "
+            f"{stats['references_released']} references released) in {stats['seconds']:.1f}s"
+        )
+        return stats
+
+
+_reaper = None
+
+
+# Singleton instance getter
+def get_upload_reaper():
+    global _reaper
+    if _reaper is None:
+        _reaper = UploadReaper(
+            settings.UPLOAD_DIR,
+            max_age=settings.MAX_FILE_AGE,
+            interval=settings.CLEANUP_INTERVAL,
+            slice_ms=settings.REAPER_SLICE_MS,
+            batch_size=settings.REAPER_BATCH_SIZE,
+            pause_ms=settings.REAPER_PAUSE_MS,
+            image_store=get_image_store(),
+            delete_grace=settings.IMAGE_DELETE_GRACE
+        )
+    return _reaper
@@ -1,12 +1,32 @@
+import io
 import os
 import time
 import logging
+import datetime
+import tarfile
+import zipfile
 from pathlib import Path
+from typing import Optional
 import shutil
+from PIL import Image
 from app.utils.config import settings
 
 logger = logging.getLogger(__name__)
 
+# Leading bytes of each accepted image format
+IMAGE_SIGNATURES = {
+    "png": b"\x89PNG\r\n\x1a\n",
+    "jpeg": b"\xff\xd8\xff",
+}
+SNIFF_BYTES = max(len(signature) for signature in IMAGE_SIGNATURES.values())
+
+class InvalidUploadError(Exception):
+    """Raised when an upload is rejected before it is decoded"""
+    
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
 def is_valid_file_extension(filename: str) -> bool:
     """Check if the file has an allowed extension"""
     return filename.split(".")[-1].lower() in settings.ALLOWED_EXTENSIONS
@@ -15,31 +35,267 @@ def is_valid_file_size(file_size: int) -> bool:
     """Check if the file size is within allowed limits"""
     return file_size <= settings.MAX_FILE_SIZE
 
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """Image format from the first bytes of a file, or None if it is not an accepted format"""
+    head = bytes(head[:SNIFF_BYTES])
+    for image_type, signature in IMAGE_SIGNATURES.items():
+        if head.startswith(signature):
+            return image_type
+    return None
+
+def check_image_header(data) -> tuple:
+    """Validate the format and dimensions of an encoded image without decoding its pixels.
+    
+    Returns (width, height). PIL opens images lazily, so only the header is
+    parsed here; the pixel data is decoded later by the preprocessing pipeline.
+    """
+    if sniff_image_type(data) is None:
+        raise InvalidUploadError("File is not a PNG or JPEG image", status_code=415)
+    
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+    except Image.DecompressionBombError:
+        raise InvalidUploadError(f"Image has more than {settings.MAX_IMAGE_PIXELS} pixels", status_code=413)
+    except Exception as e:
+        raise InvalidUploadError(f"Could not read image header: {str(e)}")
+    
+    if width <= 0 or height <= 0:
+        raise InvalidUploadError("Image has no pixels")
+    if width * height > settings.MAX_IMAGE_PIXELS:
+        raise InvalidUploadError(
+            f"Image is {width}x{height}, at most {settings.MAX_IMAGE_PIXELS} pixels are allowed",
+            status_code=413
+        )
+    return width, height
+
+def is_archive(filename: str) -> bool:
+    """Check if the file looks like a zip or tar archive of images"""
+    name = filename.lower()
+    return name.endswith((".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz"))
+
+def _archive_images(data: bytes, filename: str):
+    """Yield (name, size, read) for every allowed image in an in-memory zip or tar archive.
+    
+    Sizes come from the member headers; zipfile stops reading a member at its
+    declared size, so read() never returns more than size bytes.
+    """
+    if filename.lower().endswith(".zip"):
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not is_valid_file_extension(info.filename):
+                    continue
+                yield info.filename, info.file_size, lambda info=info: archive.read(info)
+    else:
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as archive:
+            for member in archive:
+                if not member.isfile() or not is_valid_file_extension(member.name):
+                    continue
+                yield member.name, member.size, lambda member=member: archive.extractfile(member).read()
+
+def count_archive_images(data: bytes, filename: str, max_files: int = None) -> int:
+    """Count the images iter_archive_images would yield, stopping after max_files.
+    
+    Only member headers are read. Raises InvalidUploadError (413) when the
+    images add up to more than MAX_BATCH_EXTRACTED_SIZE decompressed bytes,
+    so an archive that inflates far beyond its upload size is rejected
+    before anything is extracted.
+    """
+    if max_files is None:
+        max_files = settings.BATCH_MAX_FILES
+    
+    count = 0
+    total_size = 0
+    for _, size, _ in _archive_images(data, filename):
+        if not is_valid_file_size(size):
+            continue
+        if count >= max_files:
+            break
+        count += 1
+        total_size += size
+        if total_size > settings.MAX_BATCH_EXTRACTED_SIZE:
+            raise InvalidUploadError(
+                f"Archive images exceed {settings.MAX_BATCH_EXTRACTED_SIZE} bytes once extracted",
+                status_code=413
+            )
+    return count
+
+def iter_archive_images(data: bytes, filename: str, max_files: int = None):
+    """Yield (name, bytes) for every allowed image inside a zip or tar archive, in archive order.
+    
+    Members are decompressed one at a time as the generator is advanced.
+    Members larger than MAX_FILE_SIZE are skipped, at most max_files images
+    are yielded and extraction stops with InvalidUploadError (413) once
+    MAX_BATCH_EXTRACTED_SIZE bytes have been produced.
+    """
+    if max_files is None:
+        max_files = settings.BATCH_MAX_FILES
+    
+    count = 0
+    total_size = 0
+    for name, size, read in _archive_images(data, filename):
+        if count >= max_files:
+            break
+        if not is_valid_file_size(size):
+            logger.warning(f"Skipping {name}: larger than {settings.MAX_FILE_SIZE} bytes")
+            continue
+        image = read()
+        total_size += len(image)
+        if total_size > settings.MAX_BATCH_EXTRACTED_SIZE:
+            raise InvalidUploadError(
+                f"Archive images exceed {settings.MAX_BATCH_EXTRACTED_SIZE} bytes once extracted",
+                status_code=413
+            )
+        count += 1
+        yield os.path.basename(name), image
+
+def iter_archive_members(path: str):
+    """Yield (name, read) for every allowed image in a zip or tar archive on disk, in archive order.
+    
+    read() returns the member's bytes. Tar archives are streamed rather than
+    indexed, so read() only works until the next member is yielded.
+    """
+    if path.lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not is_valid_file_extension(info.filename):
+                    continue
+                yield info.filename, lambda info=info: archive.read(info)
+    else:
+        with tarfile.open(path, mode="r|*") as archive:
+            for member in archive:
+                if not member.isfile() or not is_valid_file_extension(member.name):
+                    continue
+                yield member.name, lambda member=member: archive.extractfile(member).read()
+
+def upload_file_path(relative_path: str, directory: str = None) -> str:
+    """Absolute path of an upload stored under its '/'-separated relative path"""
+    return os.path.join(directory or settings.UPLOAD_DIR, *relative_path.split("/"))
+
+def _numbered_dirs(path: str):
+    """(number, path) for numeric subdirectories, in ascending order"""
+    try:
+        with os.scandir(path) as entries:
+            found = [(int(entry.name), entry.path) for entry in entries
+                     if entry.name.isdigit() and entry.is_dir(follow_symlinks=False)]
+    except FileNotFoundError:
+        return []
+    return sorted(found)
+
+def _day_dirs(directory: str):
+    """(date, path) for every YYYY/MM/DD shard, oldest first.
+    
+    Legacy only: uploads go to the content-addressed image store, so no
+    date shards are written anymore. The walk expires the ones left from
+    before it and can be dropped once those are gone or migrated.
+    """
+    for year, year_path in _numbered_dirs(directory):
+        for month, month_path in _numbered_dirs(year_path):
+            for day, day_path in _numbered_dirs(month_path):
+                try:
+                    yield datetime.date(year, month, day), day_path
+                except ValueError:
+                    continue
+
+def iter_expired_uploads(directory: str = None, max_age: int = None, now: float = None):
+    """Yield the relative paths of uploads older than max_age seconds.
+    
+    A lazy os.scandir walk, so callers can consume it in small slices.
+    Whole days older than the cutoff are listed without a stat per file; the
+    walk stops at the first day that is newer than the cutoff. Flat files
+    from before sharding are checked by modification time. Images in the
+    content-addressed store are expired by reference count, not here.
+    """
+    directory = directory or settings.UPLOAD_DIR
+    max_age = settings.MAX_FILE_AGE if max_age is None else max_age
+    now = now or time.time()
+    cutoff = now - max_age
+    cutoff_day = expiry_cutoff_day(max_age, now)
+    
+    # Legacy flat files
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                continue
+            if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                yield entry.name
+    
+    # Date shards from before the image store
+    for day, day_path in _day_dirs(directory):
+        if day > cutoff_day:
+            return
+        whole_day = day < cutoff_day
+        prefix = f"{day:%Y/%m/%d}"
+        with os.scandir(day_path) as shards:
+            for shard in shards:
+                if not shard.is_dir(follow_symlinks=False):
+                    continue
+                with os.scandir(shard.path) as entries:
+                    for entry in entries:
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+                        if whole_day or entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                            yield f"{prefix}/{shard.name}/{entry.name}"
+
+def expiry_cutoff_day(max_age: int = None, now: float = None) -> datetime.date:
+    """UTC day containing the expiry cutoff; every earlier day is fully expired"""
+    max_age = settings.MAX_FILE_AGE if max_age is None else max_age
+    return datetime.datetime.utcfromtimestamp((now or time.time()) - max_age).date()
+
+def prune_empty_upload_dirs(until: datetime.date, directory: str = None) -> int:
+    """Remove empty shard, day, month and year directories for days before until.
+    
+    Only expired days are pruned, so directories that new uploads are about
+    to be written into are never removed.
+    """
+    directory = directory or settings.UPLOAD_DIR
+    removed = 0
+    
+    def try_rmdir(path):
+        nonlocal removed
+        try:
+            os.rmdir(path)
+            removed += 1
+        except OSError:
+            # Not empty, or already gone
+            pass
+    
+    for year, year_path in _numbered_dirs(directory):
+        for month, month_path in _numbered_dirs(year_path):
+            for day, day_path in _numbered_dirs(month_path):
+                try:
+                    if datetime.date(year, month, day) >= until:
+                        continue
+                except ValueError:
+                    continue
+                with os.scandir(day_path) as shards:
+                    shard_paths = [shard.path for shard in shards if shard.is_dir(follow_symlinks=False)]
+                for shard_path in shard_paths:
+                    try_rmdir(shard_path)
+                try_rmdir(day_path)
+            if (year, month) < (until.year, until.month):
+                try_rmdir(month_path)
+        if year < until.year:
+            try_rmdir(year_path)
+    return removed
+
 def clean_old_files(directory: str = None, max_age: int = None):
-    """Delete files older than max_age seconds"""
-    if directory is None:
-        directory = settings.UPLOAD_DIR
+    """Delete uploads older than max_age seconds in one pass.
     
-    if max_age is None:
-        max_age = settings.MAX_FILE_AGE
+    Does not touch the database; the API uses the background UploadReaper,
+    which also clears Prediction.filename for the deleted files.
+    """
+    directory = directory or settings.UPLOAD_DIR
     
     try:
-        now = time.time()
         count = 0
-        
-        for filename in os.listdir(directory):
-            file_path = os.path.join(directory, filename)
-            
-            # Skip directories
-            if os.path.isdir(file_path):
-                continue
-            
-            # Check file age
-            file_age = now - os.path.getmtime(file_path)
-            
-            if file_age > max_age:
-                os.remove(file_path)
+        for relative_path in iter_expired_uploads(directory, max_age):
+            try:
+                os.remove(upload_file_path(relative_path, directory))
                 count += 1
+            except FileNotFoundError:
+                pass
+        prune_empty_upload_dirs(expiry_cutoff_day(max_age), directory)
         
         logger.info(f"Cleaned {count} old files from {directory}")
         
@@ -0,0 +1,66 @@
+"""Build every inference backend, check parity against eager and time it.
+
+Usage (from the backend directory):
+    python -m benchmarks.backend_benchmark
+    python -m benchmarks.backend_benchmark --backends eager int8_static --batch-size 16
+"""
+import sys
+import time
+import argparse
+
+import torch
+
+from app.services.inference_backends import BACKENDS, PARITY_TOLERANCES, build_backend, parity_inputs
+from app.services.model_service import get_model_service, load_calibration_inputs
+from app.utils.config import settings
+
+
+def time_backend(backend, batch, repeat: int) -> float:
+    """Best-of-repeat seconds per forward pass, after one warmup pass"""
+    backend(batch)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        backend(batch)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--channels-last", action="store_true")
+    args = parser.parse_args(argv)
+
+    model_service = get_model_service()
+    model = model_service.eager_model
+    inputs = load_calibration_inputs()
+    if inputs is None:
+        inputs = parity_inputs()
+    batch = torch.randn(args.batch_size, 3, 224, 224, generator=torch.Generator().manual_seed(1))
+
+    failed = False
+    print(f"{'backend':<14}{'max_abs_diff':>14}{'tolerance':>11}{'agree':>8}{'ms/batch':>11}{'ms/image':>11}")
+    for name in args.backends:
+        backend, parity = build_backend(
+            name, model, settings.MODEL_PATH, model_service.model_version,
+            channels_last=args.channels_last, calibration=inputs
+        )
+        if backend.name != name:
+            print(f"{name:<14}{'build or parity check failed, see log':>55}")
+            failed = True
+            continue
+        if parity is None:
+            parity = {"max_abs_diff": 0.0, "class_agreement": 1.0, "tolerance": PARITY_TOLERANCES[name]}
+        seconds = time_backend(backend, batch, args.repeat)
+        print(
+            f"{name:<14}{parity['max_abs_diff']:>14.2e}{parity['tolerance']:>11.0e}"
+            f"{parity['class_agreement']:>8.2f}{seconds * 1000:>11.1f}{seconds * 1000 / args.batch_size:>11.2f}"
+        )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,32 @@
+"""Benchmark input images, either synthetic or read from a directory.
+
+Kept free of app imports so that benchmarks can set environment variables
+before the app's settings are loaded.
+"""
+import io
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def synthetic_images(count: int, seed: int = 0):
+    """Smooth grayscale-like scans of mixed sizes, encoded as PNG and JPEG"""
+    rng = np.random.default_rng(seed)
+    sizes = [(512, 512), (300, 280), (180, 200), (1024, 900)]
+    images = []
+    for i in range(count):
+        height, width = sizes[i % len(sizes)]
+        noise = (rng.random((height, width)) * 255).astype(np.uint8)
+        base = cv2.normalize(cv2.GaussianBlur(noise, (0, 0), 5), None, 0, 255, cv2.NORM_MINMAX)
+        rgb = np.stack([base, base, base], axis=-1)
+        buffer = io.BytesIO()
+        Image.fromarray(rgb).save(buffer, "PNG" if i % 2 == 0 else "JPEG")
+        images.append(buffer.getvalue())
+    return images
+
+
+def load_images(directory: str):
+    paths = sorted(p for p in Path(directory).rglob("*") if p.suffix.lower() in {".png", ".jpg", ".jpeg"})
+    return [p.read_bytes() for p in paths]
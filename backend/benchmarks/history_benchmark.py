@@ -0,0 +1,126 @@
+"""Compare history counting and pagination strategies on a large table.
+
+Seeds a database with --rows predictions (1M by default) and times the
+old path (load every row and len(), OFFSET paging) against COUNT(*) and
+keyset pagination on (timestamp, id).
+
+Usage (from the backend directory):
+    python -m benchmarks.history_benchmark
+    python -m benchmarks.history_benchmark --database-url sqlite+aiosqlite:///./history_bench.sqlite --rows 200000
+"""
+import sys
+import time
+import random
+import asyncio
+import argparse
+import datetime
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.api.routes import _count_query, _encode_cursor, _history_query
+from app.models.database import Base, Prediction, _create_missing_indexes
+
+DEFAULT_URL = "sqlite+aiosqlite:///./history_bench.sqlite"
+
+
+async def seed(engine, rows: int, sessions: int, chunk_size: int = 20000):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_create_missing_indexes)
+        existing = (await conn.execute(select(func.count()).select_from(Prediction))).scalar_one()
+    if existing >= rows:
+        print(f"Reusing {existing} seeded rows")
+        return
+
+    rng = random.Random(0)
+    start = datetime.datetime(2024, 1, 1)
+    print(f"Seeding {rows - existing} rows...")
+    seed_start = time.perf_counter()
+    for offset in range(existing, rows, chunk_size):
+        batch = []
+        for i in range(offset, min(rows, offset + chunk_size)):
+            probability = rng.random()
+            batch.append({
+                "filename": f"{i}.png",
+                "prediction": "tumor" if probability >= 0.5 else "no_tumor",
+                "confidence": max(probability, 1 - probability),
+                "probability": probability,
+                "processing_time": rng.uniform(0.01, 0.2),
+                "timestamp": start + datetime.timedelta(seconds=i * 30 + rng.randint(0, 29)),
+                "user_session": f"session-{rng.randrange(sessions)}",
+            })
+        async with engine.begin() as conn:
+            await conn.execute(insert(Prediction), batch)
+    print(f"Seeded in {time.perf_counter() - seed_start:.1f}s")
+
+
+async def timed(engine, query, repeat: int, scalars: bool = False):
+    """Best-of-repeat seconds and the result of the last run"""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        async with engine.connect() as conn:
+            rows = await conn.execute(query)
+            result = rows.scalars().all() if scalars else rows.all()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+async def run(args):
+    engine = create_async_engine(args.database_url)
+    await seed(engine, args.rows, args.sessions)
+
+    session = "session-42"
+    depth = args.rows // 2
+    results = []
+
+    # Counting
+    if not args.skip_legacy:
+        seconds, rows = await timed(engine, select(Prediction.__table__), 1)
+        results.append(("count: load all rows + len()", seconds, len(rows)))
+    seconds, rows = await timed(engine, _count_query(None), args.repeat, scalars=True)
+    results.append(("count: SELECT COUNT(*)", seconds, rows[0]))
+    seconds, rows = await timed(engine, _count_query(session), args.repeat, scalars=True)
+    results.append(("count: COUNT(*) for one session", seconds, rows[0]))
+
+    # Deep paging
+    offset_query = _history_query(None, None, depth, args.limit)
+    seconds, page = await timed(engine, offset_query, args.repeat)
+    results.append((f"page at row {depth}: OFFSET", seconds, len(page)))
+
+    # Build the cursor pointing just before the same page
+    _, previous = await timed(engine, _history_query(None, None, depth - 1, 1), 1)
+    cursor = _encode_cursor(previous[0].timestamp, previous[0].id)
+    seconds, keyset_page = await timed(engine, _history_query(None, cursor, 0, args.limit), args.repeat)
+    results.append((f"page at row {depth}: keyset cursor", seconds, len(keyset_page)))
+    if [row.id for row in page] != [row.id for row in keyset_page]:
+        print("WARNING: OFFSET and keyset pages differ")
+
+    # First page of one session
+    seconds, page = await timed(engine, _history_query(session, None, 0, args.limit), args.repeat)
+    results.append(("first page for one session", seconds, len(page)))
+
+    await engine.dispose()
+
+    print(f"{'query':<40}{'ms':>10}{'rows':>10}")
+    for name, seconds, count in results:
+        print(f"{name:<40}{seconds * 1000:>10.2f}{count:>10}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DEFAULT_URL)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--sessions", type=int, default=10_000)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--skip-legacy", action="store_true", help="Skip the slow load-everything count")
+    args = parser.parse_args(argv)
+    asyncio.run(run(args))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
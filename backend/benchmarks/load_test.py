@@ -0,0 +1,132 @@
+"""End-to-end load test of /api/predict against an in-process app.
+
+Starts the full app (lifespan included) in this process with a temporary
+SQLite database, so no outside services are needed, then sends --requests
+uploads at each --concurrency level through httpx's ASGI transport and
+reports latency percentiles, images/s and the mean time per pipeline stage.
+
+The prediction cache is disabled unless --cache is given, so every request
+goes through decode, preprocess and a forward pass.
+
+Usage (from the backend directory):
+    python -m benchmarks.load_test
+    python -m benchmarks.load_test --concurrency 1 16 64 --requests 256 --json load.json
+    python -m benchmarks.load_test --baseline benchmarks/baseline_load.json --max-regression 15
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+from benchmarks.data import load_images, synthetic_images
+from benchmarks.results import Results, add_arguments, finish, percentile
+
+
+def configure_environment(workdir: str, cache: bool):
+    """Settings are read at import time, so set them before importing the app"""
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(workdir, 'load_test.sqlite')}"
+    os.environ["UPLOAD_DIR"] = os.path.join(workdir, "uploads")
+    os.environ["SAVE_UPLOADS"] = "false"
+    os.environ["CACHE_ENABLED"] = "true" if cache else "false"
+    os.environ["CACHE_DISK_PATH"] = ""
+    # Every simulated client shares one address; 429s would stand in for real latencies
+    os.environ["RATE_LIMIT"] = "0"
+    os.environ["RATE_LIMIT_PER_ADDRESS"] = "0"
+
+
+async def run_level(client, images, concurrency: int, requests: int):
+    """Send requests uploads with at most concurrency in flight.
+
+    Latencies are those of 200 responses only; rejected requests return
+    early and would flatter the percentiles.
+    """
+    latencies = []
+    statuses = {}
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index
+        while next_index < requests:
+            index = next_index
+            next_index += 1
+            data = images[index % len(images)]
+            start = time.perf_counter()
+            response = await client.post("/api/predict", files={"file": (f"scan{index}.png", data, "image/png")})
+            if response.status_code == 200:
+                latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, statuses, time.perf_counter() - start
+
+
+def stage_means() -> dict:
+    """Mean seconds per pipeline stage so far, from the in-process metrics"""
+    from app.services.metrics import STAGE_SECONDS
+    means = {}
+    for labels, (counts, total) in list(STAGE_SECONDS._series.items()):
+        count = sum(counts)
+        if count:
+            means[labels[0]] = total / count
+    return means
+
+
+async def run(args, images) -> Results:
+    import httpx
+    from app.main import app
+
+    results = Results("load")
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://load", timeout=300) as client:
+            # Warm up the model, executors and connection pool
+            await run_level(client, images, min(4, max(args.concurrency)), args.warmup)
+
+            print(f"{'concurrency':<13}{'requests':>9}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'images/s':>10}")
+            for concurrency in args.concurrency:
+                latencies, statuses, elapsed = await run_level(client, images, concurrency, args.requests)
+                ok = statuses.get(200, 0)
+                p50, p95, p99 = (percentile(latencies, q) * 1000 for q in (0.50, 0.95, 0.99))
+                throughput = ok / elapsed
+                print(f"{concurrency:<13}{args.requests:>9}{args.requests - ok:>8}{p50:>9.1f}{p95:>9.1f}{p99:>9.1f}{throughput:>10.1f}")
+                if args.requests - ok:
+                    print(f"  status codes: {statuses}")
+                if latencies:
+                    results.add(f"load.c{concurrency}.p50_ms", p50)
+                    results.add(f"load.c{concurrency}.p95_ms", p95)
+                    results.add(f"load.c{concurrency}.p99_ms", p99)
+                results.add(f"load.c{concurrency}.images_per_s", throughput, better="higher")
+
+    print("\nmean time per stage (all levels, including warmup):")
+    for stage, seconds in stage_means().items():
+        print(f"  {stage:<14}{seconds * 1000:>9.2f} ms")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", help="Directory of PNG/JPEG images (default: synthetic)")
+    parser.add_argument("--count", type=int, default=32, help="Number of synthetic images")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=128, help="Requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=16)
+    parser.add_argument("--cache", action="store_true", help="Keep the prediction cache enabled")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    images = load_images(args.images) if args.images else synthetic_images(args.count)
+    if not images:
+        print("No images found")
+        return 1
+
+    with tempfile.TemporaryDirectory(prefix="load_test") as workdir:
+        configure_environment(workdir, args.cache)
+        results = asyncio.run(run(args, images))
+    return finish(results, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""Micro-benchmark ModelService preprocessing and inference.
+
+Times ModelService.preprocess_image over a pool of preprocessing threads,
+ModelService.predict_batch across batch sizes and torch intra-op thread
+counts, the single-image ModelService.predict path and its test-time
+augmentation mode (all views in one forward pass). Uses the model at
+MODEL_PATH (an untrained model when it is missing, which has the same cost).
+
+Usage (from the backend directory):
+    python -m benchmarks.model_benchmark
+    python -m benchmarks.model_benchmark --batch-sizes 1 8 32 --threads 1 4 --json model.json
+    python -m benchmarks.model_benchmark --baseline benchmarks/baseline_model.json --max-regression 10
+"""
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from app.services.model_service import get_model_service
+from benchmarks.data import load_images, synthetic_images
+from benchmarks.results import Results, add_arguments, finish
+
+
+def best_of(fn, repeat: int) -> float:
+    """Best-of-repeat seconds for fn(), after one warmup call"""
+    fn()
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def default_thread_counts():
+    cores = torch.get_num_threads()
+    counts = [1]
+    while counts[-1] * 2 <= cores:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cores:
+        counts.append(cores)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", help="Directory of PNG/JPEG images (default: synthetic)")
+    parser.add_argument("--count", type=int, default=32, help="Number of synthetic images")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--threads", type=int, nargs="+", help="Thread counts to try (default: 1, 2, 4 ... cores)")
+    parser.add_argument("--tta", type=int, nargs="+", default=[2, 4, 8], help="TTA view counts to time")
+    parser.add_argument("--repeat", type=int, default=5)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    images = load_images(args.images) if args.images else synthetic_images(args.count)
+    if not images:
+        print("No images found")
+        return 1
+
+    model_service = get_model_service()
+    thread_counts = args.threads or default_thread_counts()
+    default_threads = torch.get_num_threads()
+    results = Results("model")
+
+    print(f"backend: {model_service.backend_info['name']}, images: {len(images)}")
+
+    # Preprocessing over a thread pool, as the API's io executor runs it
+    print(f"\n{'preprocess threads':<20}{'ms/image':>10}{'images/s':>10}")
+    torch.set_num_threads(1)
+    for threads in thread_counts:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            seconds = best_of(lambda: list(pool.map(model_service.preprocess_image, images)), args.repeat)
+        per_image = seconds / len(images)
+        results.add(f"preprocess.threads_{threads}.ms_per_image", per_image * 1000)
+        print(f"{threads:<20}{per_image * 1000:>10.3f}{1 / per_image:>10.1f}")
+
+    # Forward passes across batch sizes and intra-op threads
+    tensors = [model_service.preprocess_image(data)["tensor"] for data in images]
+    print(f"\n{'torch threads':<15}{'batch':>7}{'ms/batch':>11}{'ms/image':>11}{'images/s':>10}")
+    for threads in thread_counts:
+        torch.set_num_threads(threads)
+        for batch_size in args.batch_sizes:
+            batch = torch.cat([tensors[i % len(tensors)] for i in range(batch_size)], dim=0)
+            seconds = best_of(lambda: model_service.predict_batch(batch), args.repeat)
+            per_image = seconds / batch_size
+            results.add(f"predict_batch.threads_{threads}.batch_{batch_size}.ms_per_image", per_image * 1000)
+            print(f"{threads:<15}{batch_size:>7}{seconds * 1000:>11.2f}{per_image * 1000:>11.3f}{1 / per_image:>10.1f}")
+
+    # Single-image end-to-end path (decode, preprocess, forward)
+    torch.set_num_threads(default_threads)
+    seconds = best_of(lambda: [model_service.predict(data) for data in images], args.repeat)
+    per_image = seconds / len(images)
+    results.add("predict.ms_per_image", per_image * 1000)
+    print(f"\npredict (single image, {default_threads} threads): {per_image * 1000:.3f} ms/image")
+    
+    # Extra latency of test-time augmentation over the single-view path
+    for views in args.tta:
+        seconds = best_of(lambda: [model_service.predict(data, views=views) for data in images], args.repeat)
+        tta_per_image = seconds / len(images)
+        results.add(f"predict.tta_{views}.ms_per_image", tta_per_image * 1000)
+        print(f"predict (tta={views}): {tta_per_image * 1000:.3f} ms/image, {tta_per_image / per_image:.2f}x single view")
+
+    return finish(results, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
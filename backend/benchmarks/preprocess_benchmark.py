@@ -0,0 +1,99 @@
+"""Compare the PIL/torchvision and OpenCV preprocessing pipelines.
+
+Reports per-image cost for both paths, the batched OpenCV path, and the
+numerical difference between their outputs.
+
+Usage (from the backend directory):
+    python -m benchmarks.preprocess_benchmark
+    python -m benchmarks.preprocess_benchmark --images path/to/scans --repeat 20
+"""
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from app.services.model_service import _open_image, build_pil_transform
+from app.services.preprocessing import OpenCVPreprocessor, decode_image
+from benchmarks.data import load_images, synthetic_images
+
+# Default parity tolerances, in normalized (post mean/std) units
+MAX_ABS_TOLERANCE = 0.25
+MEAN_ABS_TOLERANCE = 0.02
+
+
+def pil_preprocess(transform, data):
+    image, _ = _open_image(data)
+    return transform(image.convert("RGB")).unsqueeze(0)
+
+
+def opencv_preprocess(preprocessor, data):
+    image, _ = decode_image(data)
+    return preprocessor.preprocess(image)
+
+
+def time_per_image(fn, images, repeat: int) -> float:
+    """Best-of-repeat average seconds per image"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for data in images:
+            fn(data)
+        best = min(best, (time.perf_counter() - start) / len(images))
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", help="Directory of PNG/JPEG images (default: synthetic)")
+    parser.add_argument("--count", type=int, default=32, help="Number of synthetic images")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-abs", type=float, default=MAX_ABS_TOLERANCE)
+    parser.add_argument("--mean-abs", type=float, default=MEAN_ABS_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    images = load_images(args.images) if args.images else synthetic_images(args.count)
+    if not images:
+        print("No images found")
+        return 1
+
+    transform = build_pil_transform()
+    preprocessor = OpenCVPreprocessor()
+
+    # Parity check
+    max_abs = 0.0
+    mean_abs = []
+    for data in images:
+        reference = pil_preprocess(transform, data).numpy()
+        candidate = opencv_preprocess(preprocessor, data).numpy()
+        diff = np.abs(reference - candidate)
+        max_abs = max(max_abs, float(diff.max()))
+        mean_abs.append(float(diff.mean()))
+    mean_abs = float(np.mean(mean_abs))
+
+    # Timing
+    pil_time = time_per_image(lambda d: pil_preprocess(transform, d), images, args.repeat)
+    cv_time = time_per_image(lambda d: opencv_preprocess(preprocessor, d), images, args.repeat)
+    buffer = preprocessor.allocate(len(images))
+    best_batch = float("inf")
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        decoded = [decode_image(data)[0] for data in images]
+        preprocessor.preprocess_batch(decoded, out=buffer)
+        best_batch = min(best_batch, (time.perf_counter() - start) / len(images))
+
+    print(f"images:              {len(images)}")
+    print(f"pil per image:       {pil_time * 1000:.3f} ms")
+    print(f"opencv per image:    {cv_time * 1000:.3f} ms ({pil_time / cv_time:.2f}x)")
+    print(f"opencv batched:      {best_batch * 1000:.3f} ms/image ({pil_time / best_batch:.2f}x)")
+    print(f"max abs difference:  {max_abs:.4f} (tolerance {args.max_abs})")
+    print(f"mean abs difference: {mean_abs:.5f} (tolerance {args.mean_abs})")
+
+    if max_abs > args.max_abs or mean_abs > args.mean_abs:
+        print("FAIL: OpenCV pipeline is outside tolerance of the PIL pipeline")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
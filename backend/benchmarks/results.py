@@ -0,0 +1,145 @@
+"""Benchmark results: JSON output and regression checks against a baseline.
+
+A results file looks like:
+
+    {
+      "suite": "model",
+      "created": "2024-05-01T12:00:00",
+      "environment": {"python": "3.11.4", "torch": "2.1.0", "cpus": 8},
+      "metrics": {
+        "predict.batch_8.threads_4.ms_per_image": {"value": 3.1, "better": "lower"},
+        "load.images_per_s": {"value": 210.0, "better": "higher"}
+      }
+    }
+
+Usage (from the backend directory):
+    python -m benchmarks.results baseline.json current.json --max-regression 10
+"""
+import os
+import sys
+import json
+import argparse
+import datetime
+import platform
+
+
+def percentile(values, fraction: float) -> float:
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def environment() -> dict:
+    info = {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()}
+    try:
+        import torch
+        info["torch"] = torch.__version__
+        info["torch_threads"] = torch.get_num_threads()
+    except ImportError:
+        pass
+    return info
+
+
+class Results:
+    """Named measurements of one benchmark run"""
+
+    def __init__(self, suite: str):
+        self.suite = suite
+        self.metrics = {}
+
+    def add(self, name: str, value: float, better: str = "lower"):
+        if better not in ("lower", "higher"):
+            raise ValueError(f"better must be 'lower' or 'higher', got {better}")
+        self.metrics[name] = {"value": float(value), "better": better}
+
+    def to_dict(self) -> dict:
+        return {
+            "suite": self.suite,
+            "created": datetime.datetime.utcnow().isoformat(timespec="seconds"),
+            "environment": environment(),
+            "metrics": self.metrics,
+        }
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+        print(f"Wrote results to {path}")
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline: dict, current: dict, max_regression: float):
+    """Rows of (name, baseline, current, change %, regressed) for metrics present in both runs.
+
+    change % is positive when the current run is slower (or has lower
+    throughput) than the baseline.
+    """
+    rows = []
+    for name, base in sorted(baseline["metrics"].items()):
+        if name not in current["metrics"] or base["value"] == 0:
+            continue
+        value = current["metrics"][name]["value"]
+        if base["better"] == "lower":
+            change = (value - base["value"]) / base["value"] * 100
+        else:
+            change = (base["value"] - value) / base["value"] * 100
+        rows.append((name, base["value"], value, change, change > max_regression))
+    return rows
+
+
+def check_regression(current: dict, baseline_path: str, max_regression: float) -> bool:
+    """Print a comparison table; True when no metric regressed by more than max_regression percent"""
+    baseline = load(baseline_path)
+    rows = compare(baseline, current, max_regression)
+    missing = sorted(set(baseline["metrics"]) - set(current["metrics"]))
+
+    width = max([len(row[0]) for row in rows] + [6])
+    print(f"\nCompared with {baseline_path} (max regression {max_regression:.1f}%)")
+    print(f"{'metric':<{width}}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, base, value, change, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{name:<{width}}{base:>12.4g}{value:>12.4g}{change:>+9.1f}%{flag}")
+    for name in missing:
+        print(f"{name:<{width}}  missing from the current run")
+
+    regressions = [row for row in rows if row[4]]
+    if regressions:
+        print(f"FAIL: {len(regressions)} metric(s) regressed by more than {max_regression:.1f}%")
+        return False
+    print("OK: no regressions")
+    return True
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Output and regression options shared by the benchmark scripts"""
+    parser.add_argument("--json", dest="json_path", help="Write results to this JSON file")
+    parser.add_argument("--baseline", help="Compare against this results file and fail on regressions")
+    parser.add_argument("--max-regression", type=float, default=10.0,
+                        help="Allowed slowdown against the baseline, in percent")
+
+
+def finish(results: Results, args) -> int:
+    """Save and/or check results according to the shared arguments; returns the exit code"""
+    if args.json_path:
+        results.save(args.json_path)
+    if args.baseline:
+        return 0 if check_regression(results.to_dict(), args.baseline, args.max_regression) else 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--max-regression", type=float, default=10.0)
+    args = parser.parse_args(argv)
+    return 0 if check_regression(load(args.current), args.baseline, args.max_regression) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
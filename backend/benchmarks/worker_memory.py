@@ -0,0 +1,158 @@
+"""Measure per-worker memory for the pre-fork launcher against uvicorn --workers.
+
+Starts each deployment mode on a local port, sends a few predictions so
+every worker has run inference, then reads RSS, PSS and shared memory for
+each worker from /proc (Linux only). PSS splits shared pages between the
+processes that map them, so it shows the real cost of one extra worker.
+
+Usage (from the backend directory):
+    python -m benchmarks.worker_memory --workers 4
+"""
+import io
+import os
+import sys
+import time
+import signal
+import argparse
+import subprocess
+import urllib.request
+
+import numpy as np
+from PIL import Image
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = {
+    # One model copy per worker: uvicorn spawns fresh interpreters
+    "uvicorn": lambda port, workers: [
+        sys.executable, "-m", "uvicorn", "app.main:app",
+        "--port", str(port), "--workers", str(workers), "--log-level", "warning"
+    ],
+    # Model loaded once, workers forked from the parent
+    "prefork": lambda port, workers: [
+        sys.executable, "serve.py", "--port", str(port), "--workers", str(workers)
+    ],
+}
+
+
+def descendants(pid: int):
+    """All descendant pids of a process, read from /proc"""
+    found = []
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                children = [int(child) for child in f.read().split()]
+        except OSError:
+            children = []
+        found.extend(children)
+        pending.extend(children)
+    return found
+
+
+def is_worker(pid: int) -> bool:
+    """Skip helper processes such as the multiprocessing resource tracker"""
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return b"resource_tracker" not in f.read()
+    except OSError:
+        return False
+
+
+def memory_of(pid: int) -> dict:
+    """RSS, PSS and shared memory of a process in MiB"""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].rstrip(":") in ("Rss", "Pss", "Shared_Clean", "Shared_Dirty"):
+                values[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    return {
+        "rss": values.get("Rss", 0.0),
+        "pss": values.get("Pss", 0.0),
+        "shared": values.get("Shared_Clean", 0.0) + values.get("Shared_Dirty", 0.0),
+    }
+
+
+def sample_image() -> bytes:
+    buffer = io.BytesIO()
+    Image.fromarray((np.random.default_rng(0).random((256, 256, 3)) * 255).astype(np.uint8)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def post_image(port: int, data: bytes):
+    boundary = "benchmarkboundary"
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"scan.png\"\r\n"
+        f"Content-Type: image/png\r\n\r\n"
+    ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/api/predict",
+        data=body,
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+    )
+    with urllib.request.urlopen(request, timeout=60) as response:
+        response.read()
+
+
+def wait_healthy(port: int, timeout: float):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/api/health", timeout=1):
+                return
+        except OSError:
+            time.sleep(0.5)
+    raise TimeoutError(f"Server on port {port} did not become healthy")
+
+
+def measure(mode: str, port: int, workers: int, requests: int, timeout: float) -> list:
+    env = dict(os.environ, CACHE_ENABLED="false")
+    process = subprocess.Popen(MODES[mode](port, workers), cwd=BACKEND_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_healthy(port, timeout)
+        # Give every worker time to finish its startup hooks
+        time.sleep(2)
+        data = sample_image()
+        for _ in range(requests):
+            post_image(port, data)
+        pids = [pid for pid in descendants(process.pid) if is_worker(pid)]
+        return [memory_of(pid) for pid in pids]
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--requests", type=int, default=16, help="Predictions sent before measuring")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    args = parser.parse_args(argv)
+
+    print(f"{'mode':<10}{'procs':>6}{'rss/worker':>12}{'pss/worker':>12}{'shared/worker':>15}{'pss total':>11}  (MiB)")
+    for mode in args.modes:
+        stats = measure(mode, args.port, args.workers, args.requests, args.timeout)
+        if not stats:
+            print(f"{mode:<10} no worker processes found")
+            continue
+        count = len(stats)
+        print(
+            f"{mode:<10}{count:>6}"
+            f"{sum(s['rss'] for s in stats) / count:>12.1f}"
+            f"{sum(s['pss'] for s in stats) / count:>12.1f}"
+            f"{sum(s['shared'] for s in stats) / count:>15.1f}"
+            f"{sum(s['pss'] for s in stats):>11.1f}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
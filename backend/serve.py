@@ -0,0 +1,148 @@
+"""Production launcher.
+
+Loads the model once in the parent process, then forks worker processes
+that serve the API from a shared listening socket. Workers inherit the
+model weights copy-on-write (and the memory-mapped checkpoint pages are
+shared through the page cache), so N workers cost one copy of the weights
+instead of N.
+
+Usage (from the backend directory):
+    python serve.py --workers 4
+"""
+import os
+import gc
+import sys
+import time
+import signal
+import socket
+import logging
+import argparse
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger("serve")
+
+
+def threads_per_worker(workers: int, threads: int = 0) -> int:
+    """Intra-op threads per worker so that workers x threads matches the core count"""
+    if threads > 0:
+        return threads
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+
+def bind_socket(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock: socket.socket, app, threads: int):
+    """Body of a forked worker: size the torch thread pool and serve on the shared socket"""
+    import torch
+    import uvicorn
+
+    # Restore default signal handling, uvicorn installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Already fixed by an earlier parallel call
+        pass
+
+    logger.info(f"Worker {os.getpid()} serving with {threads} intra-op threads")
+    config = uvicorn.Config(app, log_level="info", lifespan="on")
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", os.cpu_count() or 1)))
+    parser.add_argument("--threads", type=int, default=int(os.getenv("THREADS_PER_WORKER", 0)),
+                        help="Intra-op threads per worker (default: cores / workers)")
+    args = parser.parse_args(argv)
+
+    threads = threads_per_worker(args.workers, args.threads)
+
+    # Import the app and load the model before forking so workers share them
+    start_time = time.perf_counter()
+    from app.main import app
+    from app.services.model_service import get_model_service
+    model_service = get_model_service()
+    logger.info(
+        f"Model preloaded in {time.perf_counter() - start_time:.2f}s "
+        f"(loaded={model_service.is_model_loaded()}, backend={model_service.backend_info['name']})"
+    )
+
+    # Move everything allocated so far out of the cyclic GC's reach, so
+    # collections in the workers do not touch (and copy) the shared pages
+    gc.collect()
+    gc.freeze()
+
+    sock = bind_socket(args.host, args.port)
+    logger.info(f"Listening on {args.host}:{args.port} with {args.workers} workers x {threads} threads")
+
+    workers = {}
+    shutting_down = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(sock, app, threads)
+            finally:
+                os._exit(0)
+        workers[pid] = time.time()
+
+    def stop(signum, _frame):
+        nonlocal shutting_down
+        shutting_down = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(args.workers):
+        spawn()
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = workers.pop(pid, None)
+        if started is None or shutting_down:
+            continue
+        logger.warning(f"Worker {pid} exited with status {status}, restarting")
+        # Avoid a tight restart loop when workers die right away
+        if time.time() - started < 1:
+            time.sleep(1)
+        spawn()
+
+    sock.close()
+    logger.info("All workers stopped")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
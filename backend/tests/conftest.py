@@ -0,0 +1,36 @@
+"""Shared test setup.
+
+Settings are read when app.utils.config is imported, so the environment
+points every path and the database at a temporary directory before any
+test module imports the app.
+"""
+import os
+import tempfile
+
+import pytest
+
+_workdir = tempfile.mkdtemp(prefix="brain-tumor-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{os.path.join(_workdir, 'test.sqlite')}")
+os.environ.setdefault("UPLOAD_DIR", os.path.join(_workdir, "uploads"))
+os.environ.setdefault("MODEL_PATH", os.path.join(_workdir, "model.pth"))
+os.environ.setdefault("EMBEDDING_INDEX_DIR", os.path.join(_workdir, "embeddings"))
+os.environ.setdefault("CACHE_DISK_PATH", "")
+os.environ.setdefault("ALLOW_UNTRAINED_MODEL", "true")
+os.environ.setdefault("MODEL_REGISTRY_POLL_INTERVAL", "0")
+os.environ.setdefault("WRITE_BEHIND_DEAD_LETTER_PATH", os.path.join(_workdir, "write_behind_failed.jsonl"))
+
+
+@pytest.fixture(scope="session")
+def workdir():
+    return _workdir
+
+
+@pytest.fixture(scope="session")
+def client():
+    """One app instance for the session; shutdown stops the shared executors"""
+    from fastapi.testclient import TestClient
+
+    from app.main import app
+
+    with TestClient(app) as test_client:
+        yield test_client
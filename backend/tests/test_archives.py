@@ -0,0 +1,78 @@
+import io
+import json
+import zipfile
+
+import pytest
+from PIL import Image
+
+from app.utils.config import settings
+from app.utils.file_utils import InvalidUploadError, count_archive_images, iter_archive_images
+
+
+def _png_bytes():
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32), (40, 40, 40)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _zip(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def extracted_limit(monkeypatch):
+    monkeypatch.setattr(settings, "MAX_BATCH_EXTRACTED_SIZE", 1024 * 1024)
+    return settings.MAX_BATCH_EXTRACTED_SIZE
+
+
+def test_members_are_extracted_lazily():
+    data = _zip([("a/1.png", _png_bytes()), ("notes.txt", b"x"), ("2.png", _png_bytes())])
+    assert count_archive_images(data, "study.zip") == 2
+    members = iter_archive_images(data, "study.zip")
+    name, image = next(members)
+    assert name == "1.png" and image == _png_bytes()
+    assert [name for name, _ in members] == ["2.png"]
+
+
+def test_count_stops_after_max_files():
+    data = _zip([(f"{i}.png", _png_bytes()) for i in range(5)])
+    assert count_archive_images(data, "study.zip", max_files=3) == 3
+    assert len(list(iter_archive_images(data, "study.zip", max_files=3))) == 3
+
+
+def test_decompression_bomb_is_rejected_from_headers(extracted_limit):
+    # Each member inflates to 512KB from a few hundred compressed bytes
+    data = _zip([(f"{i}.png", bytes(512 * 1024)) for i in range(4)])
+    assert len(data) < 16 * 1024
+    with pytest.raises(InvalidUploadError) as error:
+        count_archive_images(data, "study.zip")
+    assert error.value.status_code == 413
+
+
+def test_extraction_stops_at_the_limit(extracted_limit):
+    data = _zip([(f"{i}.png", bytes(512 * 1024)) for i in range(4)])
+    members = iter_archive_images(data, "study.zip")
+    assert len(next(members)[1]) == 512 * 1024
+    assert len(next(members)[1]) == 512 * 1024
+    with pytest.raises(InvalidUploadError):
+        next(members)
+
+
+def test_batch_endpoint_rejects_bomb_with_413(client, extracted_limit):
+    data = _zip([(f"{i}.png", bytes(512 * 1024)) for i in range(4)])
+    response = client.post("/api/predict/batch", files={"archive": ("study.zip", data, "application/zip")})
+    assert response.status_code == 413
+
+
+def test_batch_endpoint_streams_archive_slices(client):
+    data = _zip([(f"{i}.png", _png_bytes()) for i in range(3)])
+    response = client.post("/api/predict/batch", files={"archive": ("study.zip", data, "application/zip")})
+    assert response.status_code == 200
+    events = [json.loads(line) for line in response.text.splitlines() if line]
+    assert [event["success"] for event in events[:-1]] == [True] * 3
+    assert sorted(event["index"] for event in events[:-1]) == [0, 1, 2]
+    assert events[-1]["type"] == "study" and events[-1]["failed"] == 0
@@ -0,0 +1,150 @@
+import asyncio
+
+import pytest
+import torch
+
+from app.services.batch_scheduler import InferenceScheduler
+from app.services.executor import QueueFullError
+
+
+class FakeModelService:
+    """Scores each row with its value and records the rows of every forward pass"""
+
+    def __init__(self):
+        self.batches = []
+
+    def predict_scores(self, tensor, ensemble_rows, explain_rows):
+        values = [int(row.flatten()[0].item()) for row in tensor]
+        self.batches.append(values)
+        return {
+            "scores": [[float(value)] for value in values],
+            "cams": {},
+            "embeddings": None,
+            "model_version": "test",
+            "cache_version": "test"
+        }
+
+
+class InlineExecutor:
+    async def run(self, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+
+def _scheduler(**options):
+    model_service = FakeModelService()
+    options = {"max_batch_size": 2, "max_wait_ms": 50, **options}
+    return InferenceScheduler(model_service, InlineExecutor(), **options), model_service
+
+
+def _tensor(value, rows=1):
+    return torch.full((rows, 1, 2, 2), float(value))
+
+
+def test_concurrent_requests_share_a_forward_pass():
+    async def run():
+        scheduler, model_service = _scheduler(max_batch_size=4)
+        results = await asyncio.gather(*[scheduler.submit(_tensor(i)) for i in range(4)])
+        await scheduler.stop()
+        return results, model_service.batches
+
+    results, batches = asyncio.run(run())
+    assert batches == [[0, 1, 2, 3]]
+    assert [result["scores"] for result in results] == [[0.0], [1.0], [2.0], [3.0]]
+    assert all(result["batch_size"] == 4 for result in results)
+
+
+def test_single_request_is_not_stuck_behind_a_flooding_client():
+    async def run():
+        scheduler, model_service = _scheduler()
+        flood = [scheduler.submit(_tensor(i), flow="ip:flood") for i in range(8)]
+        single = scheduler.submit(_tensor(100), flow="ip:single")
+        await asyncio.gather(*flood, single)
+        await scheduler.stop()
+        return model_service.batches
+
+    batches = asyncio.run(run())
+    # First come first served would run it last, in the fifth batch
+    assert 100 in batches[0]
+    assert [value for batch in batches for value in batch if value != 100] == list(range(8))
+
+
+def test_weights_give_clients_proportional_shares():
+    async def run():
+        scheduler, model_service = _scheduler(weights={"session:heavy": 2})
+        heavy = [scheduler.submit(_tensor(i), flow="session:heavy") for i in range(6)]
+        light = [scheduler.submit(_tensor(100 + i), flow="session:light") for i in range(6)]
+        await asyncio.gather(*heavy, *light)
+        await scheduler.stop()
+        return model_service.batches
+
+    served = [value for batch in asyncio.run(run()) for value in batch]
+    first_six = served[:6]
+    assert sum(value < 100 for value in first_six) == 4
+
+
+def test_full_queue_rejects_new_requests():
+    async def run():
+        scheduler, _ = _scheduler(max_queue_size=2)
+        waiting = [asyncio.create_task(scheduler.submit(_tensor(i))) for i in range(2)]
+        # Both are queued; the worker has not run yet
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 2
+        with pytest.raises(QueueFullError) as error:
+            await scheduler.submit(_tensor(2))
+        results = await asyncio.gather(*waiting)
+        await scheduler.stop()
+        return error.value, results
+
+    error, results = asyncio.run(run())
+    assert error.retry_after >= 1
+    assert [result["scores"] for result in results] == [[0.0], [1.0]]
+
+
+def test_stop_fails_requests_still_queued():
+    async def run():
+        scheduler, _ = _scheduler()
+        waiting = asyncio.create_task(scheduler.submit(_tensor(0)))
+        await asyncio.sleep(0)
+        # Stop before the worker has taken the request
+        await scheduler.stop()
+        with pytest.raises(RuntimeError):
+            await waiting
+
+    asyncio.run(run())
+
+
+class SlowExecutor:
+    async def run(self, fn, *args, **kwargs):
+        await asyncio.sleep(0.1)
+        return fn(*args, **kwargs)
+
+
+def test_stop_fails_requests_being_collected():
+    async def run():
+        scheduler, _ = _scheduler(max_batch_size=4, max_wait_ms=5000)
+        waiting = asyncio.create_task(scheduler.submit(_tensor(0)))
+        await asyncio.sleep(0.05)
+        # The worker has taken the request and waits to fill the batch
+        assert scheduler.queue_depth == 0
+        await scheduler.stop()
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(run())
+
+
+def test_stop_fails_batches_waiting_for_a_slot():
+    async def run():
+        model_service = FakeModelService()
+        scheduler = InferenceScheduler(model_service, SlowExecutor(), max_batch_size=1, max_wait_ms=0)
+        running = asyncio.create_task(scheduler.submit(_tensor(0)))
+        waiting = asyncio.create_task(scheduler.submit(_tensor(1)))
+        await asyncio.sleep(0.05)
+        # The first batch holds the only slot, the second has been collected
+        assert scheduler.queue_depth == 0
+        await scheduler.stop()
+        assert (await running)["scores"] == [0.0]
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(run())
@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+from app.services.model_service import BrainTumorClassifier, read_checkpoint
+
+
+class TrainingConfig:
+    """Stands in for the arbitrary objects training scripts pickle into checkpoints"""
+    learning_rate = 0.001
+
+
+@pytest.fixture(scope="module")
+def state_dict():
+    return BrainTumorClassifier(pretrained=False).state_dict()
+
+
+def test_reads_memory_mapped_state_dict(tmp_path, state_dict):
+    path = str(tmp_path / "model.pth")
+    torch.save(state_dict, path)
+    loaded = read_checkpoint(path)
+    assert loaded.keys() == state_dict.keys()
+    assert torch.equal(loaded["backbone.fc.4.weight"], state_dict["backbone.fc.4.weight"])
+
+
+def test_reads_legacy_format_without_unpickling(tmp_path, state_dict):
+    path = str(tmp_path / "legacy.pth")
+    torch.save({"model_state_dict": state_dict}, path, _use_new_zipfile_serialization=False)
+    assert read_checkpoint(path, allow_pickle=False).keys() == state_dict.keys()
+
+
+def test_refuses_pickled_objects_unless_allowed(tmp_path, state_dict):
+    path = str(tmp_path / "training.pth")
+    torch.save({"model_state_dict": state_dict, "config": TrainingConfig()}, path)
+
+    with pytest.raises(ValueError, match="--allow-pickle"):
+        read_checkpoint(path, allow_pickle=False)
+    assert read_checkpoint(path, allow_pickle=True).keys() == state_dict.keys()
+
+
+def test_model_loads_with_assign(tmp_path, state_dict):
+    path = str(tmp_path / "model.pth")
+    torch.save(state_dict, path)
+    with torch.device("meta"):
+        model = BrainTumorClassifier(pretrained=False)
+    model.load_state_dict(read_checkpoint(path), assign=True)
+    assert not model.backbone.fc[4].weight.is_meta
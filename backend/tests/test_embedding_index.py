@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from app.build_embedding_index import build_index
+from app.services.embedding_index import EMBEDDING_DIM, EmbeddingStore, normalize
+
+VERSION = "test-version"
+
+
+@pytest.fixture
+def store(tmp_path):
+    """Three shards of random rows: two with ids in order, one with ids out of order"""
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((600, EMBEDDING_DIM)).astype(np.float32)
+    ids = np.arange(1000, 1600)
+    writers = [EmbeddingStore(str(tmp_path)) for _ in range(3)]
+    for index, (prediction_id, vector) in enumerate(zip(ids, vectors)):
+        if index >= 400:
+            break
+        writers[index % 2].add(VERSION, int(prediction_id), vector)
+    for prediction_id, vector in reversed(list(zip(ids[400:], vectors[400:]))):
+        writers[2].add(VERSION, int(prediction_id), vector)
+    for writer in writers:
+        writer.close()
+    # Rows are stored as float16
+    stored = normalize(normalize(vectors).astype(np.float16))
+    return EmbeddingStore(str(tmp_path), block_rows=64), ids, stored
+
+
+def _brute_force(ids, stored, queries, k):
+    scores = normalize(queries) @ stored.T
+    return [[int(ids[i]) for i in np.argsort(-row)[:k]] for row in scores]
+
+
+def test_get_resolves_candidates_in_priority_order(store):
+    embeddings, ids, stored = store
+    shards = embeddings._open_shards(VERSION)
+    assert sorted(shard.sorted for shard in shards) == [False, True, True]
+    for position in (0, 1, 399, 400, 599):
+        np.testing.assert_allclose(embeddings.get(VERSION, [ids[position]]), stored[position], atol=1e-3)
+    # The first candidate that has an embedding wins, wherever it is stored
+    np.testing.assert_allclose(embeddings.get(VERSION, [5, ids[450], ids[3]]), stored[450], atol=1e-3)
+    np.testing.assert_allclose(embeddings.get(VERSION, [ids[3], ids[450]]), stored[3], atol=1e-3)
+    assert embeddings.get(VERSION, [5, 6]) is None
+    assert embeddings.get("other-version", [ids[0]]) is None
+
+
+def test_flat_search_matches_brute_force(store):
+    embeddings, ids, stored = store
+    queries = stored[[7, 250, 500]] + 0.05
+    found = embeddings.search(VERSION, queries, 10)
+    assert found["index"] == "flat" and found["scanned"] == 600
+    assert [[i for i, _ in row] for row in found["results"]] == _brute_force(ids, stored, queries, 10)
+
+
+def test_ivf_search_matches_brute_force_when_every_list_is_probed(store, tmp_path):
+    embeddings, ids, stored = store
+    build_index(str(tmp_path / VERSION), lists=8, iterations=3)
+    queries = stored[[7, 250, 500]] + 0.05
+    found = embeddings.search(VERSION, queries, 10, probes=8)
+    assert found["index"] == "ivf"
+    assert [[i for i, _ in row] for row in found["results"]] == _brute_force(ids, stored, queries, 10)
+    # Fewer probes scan fewer rows and still find the query's own row
+    partial = embeddings.search(VERSION, stored[[250]], 1, probes=1)
+    assert partial["scanned"] < 600
+    assert partial["results"][0][0][0] == ids[250]
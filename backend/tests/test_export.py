@@ -0,0 +1,85 @@
+import asyncio
+import gc
+import io
+import json
+import time
+
+import pytest
+from fastapi import HTTPException, Request
+from PIL import Image
+
+from app.api import routes
+from app.utils.config import settings
+
+
+def _png_bytes(shade):
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32), (shade, shade, shade)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_export_streams_rows_and_frees_its_slot(client):
+    for shade in (10, 200):
+        response = client.post(
+            "/api/predict",
+            files={"file": ("scan.png", _png_bytes(shade), "image/png")},
+            headers={"X-Session-Id": "export-test"}
+        )
+        assert response.status_code == 200
+    # Past the write-behind delay, so the export includes both rows
+    time.sleep(settings.WRITE_BEHIND_MAX_DELAY_MS / 1000.0 + 0.1)
+
+    response = client.get("/api/predictions/export", params={"user_session": "export-test"})
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert len(rows) == 2 and {row["user_session"] for row in rows} == {"export-test"}
+    assert routes._exports_running == 0
+
+    response = client.get("/api/predictions/export", params={"user_session": "export-test", "format": "csv"})
+    assert response.text.splitlines()[0].split(",") == routes.EXPORT_FIELDS
+    assert len(response.text.splitlines()) == 3
+    assert routes._exports_running == 0
+
+
+def test_export_concurrency_limit(client, monkeypatch):
+    monkeypatch.setattr(settings, "EXPORT_MAX_CONCURRENT", 1)
+    running = routes._ExportSlot()
+    try:
+        response = client.get("/api/predictions/export")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "10"
+    finally:
+        running.release()
+    assert client.get("/api/predictions/export").status_code == 200
+    assert routes._exports_running == 0
+
+
+def test_export_slot_is_taken_before_streaming(monkeypatch):
+    monkeypatch.setattr(settings, "EXPORT_MAX_CONCURRENT", 1)
+    request = Request({"type": "http", "method": "GET", "path": "/api/predictions/export", "headers": []})
+
+    def export():
+        return asyncio.run(routes.export_predictions(
+            request, format="ndjson", user_session=None, start=None, end=None, prediction=None
+        ))
+
+    # Returned but not sent yet: the slot is already held
+    response = export()
+    assert routes._exports_running == 1
+    with pytest.raises(HTTPException) as error:
+        export()
+    assert error.value.status_code == 503
+    del response
+    gc.collect()
+    assert routes._exports_running == 0
+
+
+def test_unsent_export_response_releases_its_slot():
+    async def body():
+        yield b""
+
+    response = routes._ExportResponse(body(), routes._ExportSlot())
+    assert routes._exports_running == 1
+    del response
+    gc.collect()
+    assert routes._exports_running == 0
@@ -0,0 +1,64 @@
+import base64
+import datetime
+import os
+import sqlite3
+
+import pytest
+
+SESSION = "cursor-test"
+
+
+@pytest.fixture(scope="module")
+def seeded(client):
+    """25 predictions of one session, in pairs that share a timestamp"""
+    path = os.environ["DATABASE_URL"].split("///", 1)[1]
+    start = datetime.datetime(2024, 6, 1)
+    # The format SQLAlchemy stores DateTime in on SQLite
+    rows = [
+        (10 ** 12 + i, "tumor", 0.9, 0.9, 0.01,
+         (start + datetime.timedelta(seconds=i // 2)).strftime("%Y-%m-%d %H:%M:%S.%f"), SESSION)
+        for i in range(25)
+    ]
+    with sqlite3.connect(path) as conn:
+        conn.executemany(
+            "INSERT INTO predictions (id, prediction, confidence, probability, processing_time, timestamp, user_session) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+    # Newest first, ties broken by id
+    return [row[0] for row in sorted(rows, key=lambda row: (row[5], row[0]), reverse=True)]
+
+
+def test_cursor_pages_cover_every_row_once(client, seeded):
+    ids = []
+    cursor = None
+    while True:
+        params = {"user_session": SESSION, "limit": 10, "include_total": "false"}
+        if cursor:
+            params["cursor"] = cursor
+        page = client.get("/api/predictions", params=params).json()
+        assert page["total"] is None
+        ids += [prediction["id"] for prediction in page["predictions"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert ids == seeded
+
+
+def test_offset_pages_match_cursor_order(client, seeded):
+    page = client.get("/api/predictions", params={"user_session": SESSION, "limit": 10, "skip": 10}).json()
+    assert page["total"] == 25
+    assert [prediction["id"] for prediction in page["predictions"]] == seeded[10:20]
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"no separator").decode(),
+    base64.urlsafe_b64encode(b"2024-06-01T00:00:00|not-an-id").decode(),
+    base64.urlsafe_b64encode(b"yesterday|12").decode(),
+    base64.urlsafe_b64encode(b"\xff\xfe").decode(),
+])
+def test_invalid_cursor_is_rejected_with_400(client, cursor):
+    response = client.get("/api/predictions", params={"cursor": cursor})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor"
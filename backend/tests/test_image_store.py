@@ -0,0 +1,115 @@
+import io
+import os
+import asyncio
+import datetime
+
+import pytest
+from PIL import Image
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.models import database
+from app.models.database import Base, Prediction, StoredImage, WorkerIdLease, WriteBehindQueue
+from app.services.image_store import ImageStore, content_hash
+from app.services.upload_reaper import UploadReaper
+
+
+@pytest.fixture(autouse=True)
+def id_state(monkeypatch):
+    monkeypatch.setattr(database, "_id_state", {"pid": None, "worker": None, "expires": 0.0, "ms": 0, "seq": 0})
+
+
+def _jpeg(color=(120, 40, 200)):
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), color).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def _reaper(upload_dir, session_factory, image_store, max_age):
+    return UploadReaper(
+        str(upload_dir), max_age=max_age, interval=0, slice_ms=50, batch_size=1, pause_ms=0,
+        session_factory=session_factory, image_store=image_store, delete_grace=0
+    )
+
+
+def test_put_stores_the_same_bytes_once(tmp_path):
+    store = ImageStore(str(tmp_path), thumbnail_size=32, thumbnail_quality=80)
+    data = _jpeg()
+    sha256 = content_hash(data)
+
+    assert store.put(data, sha256, "jpg") is True
+    assert store.put(data, sha256, "jpg") is False
+    objects = [name for _, _, names in os.walk(tmp_path / "objects") for name in names]
+    assert objects == [f"{sha256}.jpg"]
+    with open(store.absolute(store.object_path(sha256, "jpg")), "rb") as f:
+        assert f.read() == data
+
+
+def test_delete_respects_the_grace_period(tmp_path):
+    store = ImageStore(str(tmp_path), thumbnail_size=32, thumbnail_quality=80)
+    data = _jpeg()
+    sha256 = content_hash(data)
+    store.store_upload(data, sha256, "jpg")
+
+    assert store.delete(sha256, "jpg", grace_period=3600) is False
+    assert os.path.exists(store.absolute(store.object_path(sha256, "jpg")))
+
+
+def test_image_survives_until_its_last_reference_is_released(tmp_path):
+    upload_dir = tmp_path / "uploads"
+    upload_dir.mkdir()
+    store = ImageStore(str(upload_dir), thumbnail_size=32, thumbnail_quality=80)
+    data = _jpeg()
+    sha256 = content_hash(data)
+    original = store.absolute(store.object_path(sha256, "jpg"))
+    thumbnail = store.absolute(store.thumbnail_path(sha256))
+    explanations = [store.put_explanation(sha256, version, b"overlay") for version in ("v1", "v2")]
+    now = datetime.datetime.utcnow()
+
+    async def run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'images.sqlite'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        await WorkerIdLease(engine, 60).acquire()
+        session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+        async def ref_count():
+            async with session_factory() as session:
+                return (await session.execute(
+                    select(StoredImage.ref_count).where(StoredImage.sha256 == sha256)
+                )).scalar_one_or_none()
+
+        # The same bytes uploaded twice: one object, two references
+        queue = WriteBehindQueue(engine, batch_size=100, max_delay_ms=10000)
+        for age in (datetime.timedelta(days=2), datetime.timedelta(hours=2)):
+            store.store_upload(data, sha256, "jpg")
+            queue.add_image_reference(sha256, "jpg", len(data))
+            queue.add_prediction(
+                prediction="tumor", confidence=0.9, probability=0.9, processing_time=0.01,
+                user_session="images", filename=store.object_path(sha256, "jpg"),
+                image_hash=sha256, timestamp=now - age
+            )
+        await queue.stop()
+        counts = [await ref_count()]
+
+        # Only the older prediction has expired
+        stats = await _reaper(upload_dir, session_factory, store, max_age=86400).run_once()
+        counts.append(await ref_count())
+        survived = [os.path.exists(path) for path in (original, thumbnail, *explanations)]
+        assert stats["references_released"] == 1 and stats["images_deleted"] == 0
+
+        stats = await _reaper(upload_dir, session_factory, store, max_age=3600).run_once()
+        counts.append(await ref_count())
+        assert stats["references_released"] == 1 and stats["images_deleted"] == 1
+
+        async with session_factory() as session:
+            hashes = (await session.execute(select(Prediction.image_hash, Prediction.filename))).all()
+        await engine.dispose()
+        return counts, survived, hashes
+
+    counts, survived, hashes = asyncio.run(run())
+    assert counts == [2, 1, None]
+    assert all(survived)
+    assert not any(os.path.exists(path) for path in (original, thumbnail, *explanations))
+    assert hashes == [(None, None), (None, None)]
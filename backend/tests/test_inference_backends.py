@@ -0,0 +1,48 @@
+import os
+
+import pytest
+import torch
+
+from app.services.inference_backends import artifact_path, build_backend, parity_inputs, split_outputs
+from app.services.model_service import BrainTumorClassifier
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    return BrainTumorClassifier(pretrained=False).eval()
+
+
+@pytest.mark.parametrize("name", ["torchscript", "int8_dynamic"])
+def test_saved_artifact_loads_back_and_passes_parity(tmp_path, model, name):
+    model_path = str(tmp_path / "model.pth")
+    inputs = parity_inputs(4)
+
+    built, parity = build_backend(name, model, model_path, "test", calibration=inputs, save_artifacts=True)
+    assert built.name == name
+    assert parity["passed"]
+    assert os.path.exists(artifact_path(model_path, "test", name))
+
+    # A fresh worker only reads the artifact; it must not fall back to eager
+    loaded, parity = build_backend(name, model, model_path, "test", calibration=inputs,
+                                   save_artifacts=False, verify_cached=True)
+    assert loaded.name == name
+    assert parity["passed"]
+
+
+def test_backend_returns_embeddings(tmp_path, model):
+    backend, _ = build_backend("torchscript", model, str(tmp_path / "model.pth"), "test",
+                               calibration=parity_inputs(2), save_artifacts=False)
+    inputs = parity_inputs(2, seed=1)
+    logits, embeddings = split_outputs(backend(inputs))
+    with torch.no_grad():
+        expected_logits, expected_embeddings = model.forward_with_embedding(inputs)
+    assert embeddings.shape == (2, 512)
+    assert torch.allclose(logits, expected_logits, atol=1e-4)
+    assert torch.allclose(embeddings, expected_embeddings, atol=1e-4)
+
+
+def test_unknown_backend_falls_back_to_eager(tmp_path, model):
+    backend, parity = build_backend("tensorrt", model, str(tmp_path / "model.pth"), "test")
+    assert backend.name == "eager"
+    assert parity is None
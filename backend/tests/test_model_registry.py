@@ -0,0 +1,90 @@
+import io
+import time
+
+import pytest
+import torch
+from PIL import Image
+
+from app.services.model_service import BrainTumorClassifier, get_model_service, read_model_version
+from app.utils.config import settings
+
+TOKEN = "registry-test-token"
+SESSION = "registry-test"
+
+
+@pytest.fixture
+def admin(client, monkeypatch):
+    """Admin headers; the model serving the shared app is put back afterwards"""
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", TOKEN)
+    model_service = get_model_service()
+    original = model_service.active_model
+    yield {"X-Admin-Token": TOKEN}
+    model_service.activate(original)
+
+
+@pytest.fixture
+def checkpoints(tmp_path):
+    paths = []
+    for seed in (1, 2):
+        torch.manual_seed(seed)
+        path = tmp_path / f"model-{seed}.pth"
+        torch.save(BrainTumorClassifier(pretrained=False).state_dict(), path)
+        paths.append(str(path))
+    return paths
+
+
+def _predict(client, shade):
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (shade, shade, shade)).save(buffer, "PNG")
+    response = client.post(
+        "/api/predict",
+        files={"file": ("scan.png", buffer.getvalue(), "image/png")},
+        headers={"X-Session-Id": SESSION}
+    )
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def _recorded_version(client, prediction_id):
+    # Wait out the write-behind delay so the history read flushes the row
+    time.sleep(settings.WRITE_BEHIND_MAX_DELAY_MS / 1000 + 0.05)
+    page = client.get("/api/predictions", params={"user_session": SESSION, "limit": 100}).json()
+    return {row["id"]: row["model_version"] for row in page["predictions"]}[prediction_id]
+
+
+def test_deploy_and_roll_back(client, admin, checkpoints):
+    first, second = (read_model_version(path) for path in checkpoints)
+
+    response = client.post("/api/admin/models", data={"path": checkpoints[0]}, headers=admin)
+    assert response.status_code == 200, response.text
+    assert response.json()["model"]["version"] == first
+    prediction = _predict(client, 10)
+    assert prediction["model_version"] == first
+    assert _recorded_version(client, prediction["prediction_id"]) == first
+
+    response = client.post("/api/admin/models", data={"path": checkpoints[1]}, headers=admin)
+    assert response.json()["model"]["version"] == second
+    prediction = _predict(client, 20)
+    assert prediction["model_version"] == second
+    assert _recorded_version(client, prediction["prediction_id"]) == second
+
+    # Roll back to the first version
+    response = client.post(f"/api/admin/models/{first}/activate", headers=admin)
+    assert response.status_code == 200, response.text
+    prediction = _predict(client, 30)
+    assert prediction["model_version"] == first
+    assert _recorded_version(client, prediction["prediction_id"]) == first
+
+    # And forward again
+    client.post(f"/api/admin/models/{second}/activate", headers=admin)
+    prediction = _predict(client, 40)
+    assert prediction["model_version"] == second
+    assert _recorded_version(client, prediction["prediction_id"]) == second
+
+    versions = {row["version"]: row for row in client.get("/api/admin/models", headers=admin).json()["versions"]}
+    assert versions[second]["active"] and not versions[first]["active"]
+    assert versions[first]["predictions"] == 2 and versions[second]["predictions"] == 2
+
+
+def test_unknown_version_cannot_be_activated(client, admin):
+    assert client.post("/api/admin/models/0123456789abcdef/activate", headers=admin).status_code == 404
@@ -0,0 +1,92 @@
+import os
+import sys
+import asyncio
+import datetime
+import subprocess
+
+import numpy as np
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.models import database
+from app.models.database import Base, WorkerIdLease, WriteBehindQueue
+from app.services.quality_stats import read_stats
+
+
+@pytest.fixture(autouse=True)
+def id_state(monkeypatch):
+    monkeypatch.setattr(database, "_id_state", {"pid": None, "worker": None, "expires": 0.0, "ms": 0, "seq": 0})
+
+
+def _rounded(value):
+    """Sums are added in a different order by the rebuild"""
+    if isinstance(value, float):
+        return round(value, 9)
+    if isinstance(value, dict):
+        return {key: _rounded(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_rounded(item) for item in value]
+    return value
+
+
+def test_incremental_stats_match_a_full_rebuild(tmp_path):
+    rng = np.random.default_rng(0)
+    today = datetime.datetime.utcnow().replace(hour=12, minute=0, second=0, microsecond=0)
+
+    database_url = f"sqlite+aiosqlite:///{tmp_path / 'stats.sqlite'}"
+
+    async def write_and_read():
+        engine = create_async_engine(database_url)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        await WorkerIdLease(engine, 60).acquire()
+        session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        queue = WriteBehindQueue(engine, batch_size=1000, max_delay_ms=10000)
+
+        prediction_ids = []
+        for flush in range(4):
+            for _ in range(30):
+                probability = float(rng.random())
+                prediction_ids.append(queue.add_prediction(
+                    prediction="tumor" if probability >= 0.5 else "no_tumor",
+                    confidence=max(probability, 1 - probability),
+                    probability=probability,
+                    processing_time=float(rng.lognormal(-4, 1)),
+                    user_session="stats",
+                    filename=None,
+                    timestamp=today - datetime.timedelta(days=int(rng.integers(0, 5)), minutes=int(rng.integers(0, 600)))
+                ))
+            # Feedback on rows written in earlier flushes and on rows in this one
+            for prediction_id in rng.choice(prediction_ids, 12, replace=False):
+                queue.add_feedback(prediction_id=int(prediction_id), is_correct=int(rng.random() < 0.8))
+            await queue.flush()
+        # Feedback on an unknown prediction is left out of both
+        queue.add_feedback(prediction_id=1, is_correct=1)
+        await queue.stop()
+
+        async with session_factory() as session:
+            stats = await read_stats(session, 7)
+        await engine.dispose()
+        return stats
+
+    async def read():
+        engine = create_async_engine(database_url)
+        async with AsyncSession(engine) as session:
+            stats = await read_stats(session, 7)
+        await engine.dispose()
+        return stats
+
+    incremental = asyncio.run(write_and_read())
+    subprocess.run(
+        [sys.executable, "-m", "app.rebuild_stats", "--fetch-size", "7"],
+        env={**os.environ, "DATABASE_URL": database_url},
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        check=True
+    )
+    rebuilt = asyncio.run(read())
+    assert incremental["predictions"]["total"] == 120
+    assert incremental["feedback"]["total"] == 48
+    assert len(incremental["days"]) == 5 and incremental["calibration"]
+    assert all("p95" in day["latency_ms"] for day in incremental["days"])
+    assert _rounded(incremental) == _rounded(rebuilt)
@@ -0,0 +1,94 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.services.rate_limit import RateLimitMiddleware, TokenBucketLimiter, client_key
+
+
+def _client(limiter, address_limiter):
+    app = FastAPI()
+
+    @app.post("/api/predict")
+    async def predict():
+        return {"ok": True}
+
+    @app.get("/api/predictions")
+    async def predictions():
+        return {"ok": True}
+
+    app.add_middleware(RateLimitMiddleware, limiter=limiter, path_prefixes=["/api/predict"],
+                       address_limiter=address_limiter)
+    return TestClient(app)
+
+
+def test_bucket_allows_burst_then_refills():
+    limiter = TokenBucketLimiter(rate_per_minute=60, burst=2)
+    assert limiter.acquire("a", now=0.0)[0]
+    assert limiter.acquire("a", now=0.0)[0]
+    allowed, retry_after, _ = limiter.acquire("a", now=0.0)
+    assert not allowed and retry_after == 1.0
+    assert limiter.acquire("a", now=1.0)[0]
+    # Other clients have their own bucket
+    assert limiter.acquire("b", now=1.0)[0]
+
+
+def test_rotating_session_ids_do_not_bypass_the_address_limit():
+    client = _client(TokenBucketLimiter(60, 5), TokenBucketLimiter(60, 3))
+    statuses = [
+        client.post("/api/predict", headers={"X-Session-Id": f"rotated-{i}"}).status_code
+        for i in range(10)
+    ]
+    assert statuses == [200] * 3 + [429] * 7
+
+
+def test_rejection_carries_retry_after():
+    client = _client(TokenBucketLimiter(60, 5), TokenBucketLimiter(30, 1))
+    assert client.post("/api/predict").status_code == 200
+    response = client.post("/api/predict")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+    assert response.headers["X-RateLimit-Limit"] == "30"
+    assert response.headers["X-RateLimit-Remaining"] == "0"
+    # Paths outside the prefix are not limited
+    assert client.get("/api/predictions").status_code == 200
+
+
+def test_sessions_share_the_address_limit_individually():
+    limiter = TokenBucketLimiter(60, 2)
+    client = _client(limiter, TokenBucketLimiter(60, 3))
+    first = [client.post("/api/predict", headers={"X-Session-Id": "first"}).status_code for _ in range(3)]
+    # The session runs out first, without using up the address
+    assert first == [200, 200, 429]
+    second = [client.post("/api/predict", headers={"X-Session-Id": "second"}).status_code for _ in range(2)]
+    assert second == [200, 429]
+    # The address rejected the last request, so its session token was refunded
+    assert limiter.acquire("session:ip:testclient/second", cost=1.0)[0]
+    assert not limiter.acquire("session:ip:testclient/second", cost=1.0)[0]
+
+
+def test_disabled_limiter_lets_everything_through():
+    client = _client(TokenBucketLimiter(0, 1), TokenBucketLimiter(0, 1))
+    assert all(client.post("/api/predict").status_code == 200 for _ in range(5))
+
+
+def test_session_is_still_the_scheduling_key():
+    scope = {"headers": [(b"x-session-id", b"abc")], "client": ("10.0.0.1", 1234)}
+    assert client_key(scope) == "session:abc"
+    assert client_key({"headers": [], "client": ("10.0.0.1", 1234)}) == "ip:10.0.0.1"
+
+
+def test_address_limiter_off_without_session():
+    client = _client(TokenBucketLimiter(60, 1), TokenBucketLimiter(0, 1))
+    assert all(client.post("/api/predict").status_code == 200 for _ in range(5))
+    # Sessions are still limited on their own
+    statuses = [client.post("/api/predict", headers={"X-Session-Id": "s"}).status_code for _ in range(2)]
+    assert statuses == [200, 429]
+
+
+def test_session_limiter_off_keeps_the_address_limit():
+    client = _client(TokenBucketLimiter(0, 1), TokenBucketLimiter(60, 2))
+    statuses = [
+        client.post("/api/predict", headers={"X-Session-Id": f"rotated-{i}"}).status_code
+        for i in range(4)
+    ]
+    assert statuses == [200, 200, 429, 429]
+    assert client.post("/api/predict").status_code == 429
@@ -0,0 +1,37 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.services import upload_reaper
+from app.services.upload_reaper import UploadReaper
+
+
+def test_cancel_waits_for_the_slice_in_progress(tmp_path, monkeypatch):
+    walking = threading.Event()
+    closed = []
+
+    def slow_walk(directory, max_age, now):
+        try:
+            walking.set()
+            time.sleep(0.3)
+            yield "old.jpg"
+        finally:
+            closed.append(True)
+
+    monkeypatch.setattr(upload_reaper, "iter_expired_uploads", slow_walk)
+    reaper = UploadReaper(str(tmp_path), max_age=60, interval=60, slice_ms=1000, batch_size=10, pause_ms=0)
+
+    async def run():
+        task = asyncio.get_running_loop().create_task(reaper.run_once())
+        while not walking.is_set():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        # Closing the walk while an io thread is inside it would raise
+        # "generator already executing" instead
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert closed == [True]
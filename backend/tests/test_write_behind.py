@@ -0,0 +1,282 @@
+import asyncio
+import json
+
+import pytest
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.models import database
+from app.models.database import (
+    ID_SEQUENCE_BITS,
+    ID_WORKERS,
+    Base,
+    IdWorker,
+    Prediction,
+    WorkerIdLease,
+    WriteBehindQueue,
+    generate_id,
+)
+from app.services.executor import QueueFullError
+
+
+@pytest.fixture(autouse=True)
+def id_state(monkeypatch):
+    """Leases in these tests must not replace the one the app holds"""
+    monkeypatch.setattr(database, "_id_state", {"pid": None, "worker": None, "expires": 0.0, "ms": 0, "seq": 0})
+
+
+def _engine(tmp_path, name="test.sqlite"):
+    return create_async_engine(f"sqlite+aiosqlite:///{tmp_path / name}")
+
+
+async def _create_tables(engine):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+def _prediction(**values):
+    return {
+        "prediction": "tumor",
+        "confidence": 0.9,
+        "probability": 0.9,
+        "processing_time": 0.01,
+        "user_session": "test",
+        "filename": None,
+        **values
+    }
+
+
+def _worker_of(prediction_id):
+    return (prediction_id >> ID_SEQUENCE_BITS) % ID_WORKERS
+
+
+def test_generate_id_refuses_without_a_lease():
+    with pytest.raises(RuntimeError):
+        generate_id()
+
+
+def test_leased_workers_generate_disjoint_ids(tmp_path):
+    async def run():
+        engine = _engine(tmp_path)
+        await _create_tables(engine)
+        first, second = WorkerIdLease(engine, 60), WorkerIdLease(engine, 60)
+        await first.acquire()
+        first_ids = [generate_id() for _ in range(5000)]
+        await second.acquire()
+        second_ids = [generate_id() for _ in range(5000)]
+        await engine.dispose()
+        return first, second, first_ids, second_ids
+
+    first, second, first_ids, second_ids = asyncio.run(run())
+    assert first.worker_id != second.worker_id
+    assert first_ids == sorted(first_ids) and second_ids == sorted(second_ids)
+    assert len(set(first_ids) | set(second_ids)) == 10000
+    assert {_worker_of(i) for i in first_ids} == {first.worker_id}
+    assert {_worker_of(i) for i in second_ids} == {second.worker_id}
+    assert max(second_ids) < 2 ** 53
+
+
+def test_released_and_lost_leases(tmp_path):
+    async def run():
+        engine = _engine(tmp_path)
+        await _create_tables(engine)
+        lease = WorkerIdLease(engine, 60)
+        released = await lease.acquire()
+        await lease.stop()
+        with pytest.raises(RuntimeError):
+            generate_id()
+
+        lease = WorkerIdLease(engine, 60)
+        held = await lease.acquire()
+        # Another process took the tag while this one could not renew
+        async with engine.begin() as conn:
+            await conn.execute(update(IdWorker).where(IdWorker.worker_id == held).values(owner="other"))
+        await lease.renew()
+        await engine.dispose()
+        return released, held, lease.worker_id
+
+    released, held, renewed = asyncio.run(run())
+    # The least recently released tag is claimed last
+    assert held != released
+    assert renewed not in (held, released)
+
+
+def test_flush_sets_rejected_rows_aside(tmp_path):
+    dead_letters = tmp_path / "failed.jsonl"
+
+    async def run():
+        engine = _engine(tmp_path)
+        await _create_tables(engine)
+        lease = WorkerIdLease(engine, 60)
+        await lease.acquire()
+        queue = WriteBehindQueue(engine, batch_size=100, max_delay_ms=10, dead_letter_path=str(dead_letters))
+        first = queue.add_prediction(**_prediction())
+        await queue.flush()
+        # Reusing a written id makes the bulk insert fail on the primary key
+        queue.add_prediction(**_prediction(id=first))
+        others = [queue.add_prediction(**_prediction()) for _ in range(3)]
+        await queue.flush()
+        async with engine.connect() as conn:
+            count = (await conn.execute(select(func.count()).select_from(Prediction))).scalar_one()
+        stats = queue.stats
+        await queue.stop()
+        await engine.dispose()
+        return first, others, count, stats, queue
+
+    first, others, count, stats, queue = asyncio.run(run())
+    assert count == 4
+    assert stats["pending"] == 0 and stats["rows_rejected"] == 1 and stats["errors"] == 1
+    assert not any(queue.has_pending_prediction(i) for i in [first] + others)
+    rejected = [json.loads(line) for line in dead_letters.read_text().splitlines()]
+    assert [(entry["table"], entry["row"]["id"]) for entry in rejected] == [("predictions", first)]
+
+
+def test_flush_requeues_rows_while_the_database_is_down(tmp_path):
+    async def run():
+        engine = _engine(tmp_path)
+        await _create_tables(engine)
+        lease = WorkerIdLease(engine, 60)
+        await lease.acquire()
+        # A directory cannot be opened as a database
+        (tmp_path / "down.sqlite").mkdir()
+        queue = WriteBehindQueue(_engine(tmp_path, "down.sqlite"), batch_size=100, max_delay_ms=10)
+        ids = [queue.add_prediction(**_prediction()) for _ in range(3)]
+        await queue.flush()
+        stats = queue.stats
+        pending = all(queue.has_pending_prediction(i) for i in ids)
+        queue._worker.cancel()
+        await engine.dispose()
+        return stats, pending
+
+    stats, pending = asyncio.run(run())
+    assert stats["pending"] == 3 and stats["rows_rejected"] == 0 and stats["errors"] == 1
+    assert pending
+
+
+def test_check_capacity_applies_backpressure(tmp_path):
+    async def run():
+        engine = _engine(tmp_path)
+        await _create_tables(engine)
+        lease = WorkerIdLease(engine, 60)
+        await lease.acquire()
+        queue = WriteBehindQueue(engine, batch_size=100, max_delay_ms=10, max_pending=2)
+        queue.check_capacity()
+        queue.add_prediction(**_prediction())
+        queue.add_prediction(**_prediction())
+        with pytest.raises(QueueFullError):
+            queue.check_capacity()
+        await queue.flush()
+        queue.check_capacity()
+        await queue.stop()
+        await engine.dispose()
+
+    asyncio.run(run())
+
+
+def test_readers_flush_only_stale_rows(tmp_path):
+    async def run():
+        engine = _engine(tmp_path)
+        await _create_tables(engine)
+        lease = WorkerIdLease(engine, 60)
+        await lease.acquire()
+        queue = WriteBehindQueue(engine, batch_size=100, max_delay_ms=10000)
+        queue.add_prediction(**_prediction())
+        await queue.flush_if_stale()
+        fresh = queue.pending_count
+        # As if the flush loop had fallen behind by more than the max delay
+        queue._oldest_pending -= 11
+        await queue.flush_if_stale()
+        stale = queue.pending_count
+        await queue.stop()
+        await engine.dispose()
+        return fresh, stale
+
+    assert asyncio.run(run()) == (1, 0)
+
+
+def _slow_writes(queue, monkeypatch, seconds=0.2):
+    write_batch = queue._write_batch
+
+    async def slow_write_batch(conn, batches, image_refs):
+        await asyncio.sleep(seconds)
+        await write_batch(conn, batches, image_refs)
+
+    monkeypatch.setattr(queue, "_write_batch", slow_write_batch)
+
+
+async def _count_predictions(engine):
+    async with engine.connect() as conn:
+        return (await conn.execute(select(func.count()).select_from(Prediction))).scalar_one()
+
+
+def test_stop_waits_for_the_flush_in_progress(tmp_path, monkeypatch):
+    async def run():
+        engine = _engine(tmp_path)
+        await _create_tables(engine)
+        await WorkerIdLease(engine, 60).acquire()
+        # A full batch makes the loop flush at once
+        queue = WriteBehindQueue(engine, batch_size=5, max_delay_ms=10)
+        _slow_writes(queue, monkeypatch)
+        for _ in range(5):
+            queue.add_prediction(**_prediction())
+        await asyncio.sleep(0.05)
+        assert queue.pending_count == 0
+        await queue.stop()
+        count = await _count_predictions(engine)
+        await engine.dispose()
+        return count
+
+    assert asyncio.run(run()) == 5
+
+
+def test_cancelled_flush_puts_its_rows_back(tmp_path, monkeypatch):
+    async def run():
+        engine = _engine(tmp_path)
+        await _create_tables(engine)
+        await WorkerIdLease(engine, 60).acquire()
+        queue = WriteBehindQueue(engine, batch_size=100, max_delay_ms=10000)
+        _slow_writes(queue, monkeypatch)
+        ids = [queue.add_prediction(**_prediction()) for _ in range(5)]
+        flush = asyncio.create_task(queue.flush())
+        await asyncio.sleep(0.05)
+        flush.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await flush
+        pending = queue.pending_count, all(queue.has_pending_prediction(i) for i in ids)
+        monkeypatch.undo()
+        await queue.stop()
+        count = await _count_predictions(engine)
+        await engine.dispose()
+        return pending, count
+
+    assert asyncio.run(run()) == ((5, True), 5)
+
+
+def test_rows_unwritten_at_shutdown_are_set_aside(tmp_path):
+    dead_letters = tmp_path / "failed.jsonl"
+
+    async def run():
+        engine = _engine(tmp_path)
+        await _create_tables(engine)
+        await WorkerIdLease(engine, 60).acquire()
+        (tmp_path / "down.sqlite").mkdir()
+        queue = WriteBehindQueue(_engine(tmp_path, "down.sqlite"), batch_size=100, max_delay_ms=10000,
+                                 dead_letter_path=str(dead_letters))
+        ids = [queue.add_prediction(**_prediction()) for _ in range(3)]
+        await queue.stop()
+        await engine.dispose()
+        return ids, queue.pending_count
+
+    ids, pending = asyncio.run(run())
+    assert pending == 0
+    assert [json.loads(line)["row"]["id"] for line in dead_letters.read_text().splitlines()] == ids
+
+
+def test_caller_supplied_ids_need_no_lease(tmp_path):
+    async def run():
+        queue = WriteBehindQueue(_engine(tmp_path), batch_size=100, max_delay_ms=10000)
+        assert queue.add_prediction(**_prediction(id=42)) == 42
+        assert queue.add_feedback(id=43, prediction_id=42, is_correct=1) == 43
+        queue._worker.cancel()
+
+    asyncio.run(run())